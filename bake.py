@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Bakes images for the deploy roles (like mesos_slave) of a configuration, so that
+# instances skip the package installs of default-init.bash.j2 when they boot.
+#
+#     python bake.py -c environments/leaf-dev.conf.yml -o images
+#     packer build images/mesos_slave.packer.json
+#     python bake.py -c environments/leaf-dev.conf.yml --record packer-manifest.json
+#
+# The first step writes a Packer definition for every deploy role the configuration
+# launches, with one builder per region. Their provisioner is default-init.bash.j2
+# rendered for the 'bake' phase, which only installs the packages. --record adds the
+# AMIs of a Packer manifest to the image catalog of the configuration:
+#
+#     images:
+#       baked: True
+#       catalog: images/cloud-dev.json
+#
+# With baked set the images in the catalog are added to RegionMap, and the roles that
+# have one in the region boot from it with user data rendered for the 'boot' phase.
+# Baked images are always EBS backed, they are built from the stock EBS image.
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+
+import config as cfn
+import generate
+
+# The manifest Packer writes the AMIs it built to
+MANIFEST = 'packer-manifest.json'
+
+
+def deploy_roles(components):
+    """Returns the deploy roles that the configuration launches instances as"""
+    generate.emit_template(components)
+    return list(cfn.deploy_roles)
+
+
+def stock_image(region):
+    """Returns the stock EBS image of a region that images are baked from"""
+    image = cfn.template.mappings['RegionMap'].get(region, {}).get(int(cfn.Amis.EBS))
+    if not image:
+        raise Exception("There is no stock EBS image for {0} in RegionMap".format(region))
+    return image
+
+
+def bake_script(deploy):
+    """Renders the provisioning script of a deploy role"""
+    return cfn.load_template("default-init.bash.j2",
+        {"env": cfn.CLOUDENV, "cloud": cfn.CLOUDNAME, "deploy": deploy, "phase": "bake"}
+    )
+
+
+def build_definition(deploy, regions, instance_type, script, manifest=MANIFEST):
+    """Returns the Packer definition baking the image of a deploy role in every region.
+    The image supports the enhanced networking of instance_type."""
+    networking = cfn.INSTANCE_TYPES[instance_type].enhanced_networking
+    builders = [{
+        'name': region,
+        'type': 'amazon-ebs',
+        'region': region,
+        'source_ami': stock_image(region),
+        'instance_type': instance_type,
+        'ssh_username': 'ubuntu',
+        'ami_name': '{0}-{1}-{2}-{{{{timestamp}}}}'.format(deploy, cfn.CLOUDNAME, cfn.CLOUDENV),
+        'sriov_support': networking is not None,
+        'ena_support': networking == 'ena',
+        'tags': {'Deploy': deploy, 'Cloud': cfn.CLOUDNAME, 'Env': cfn.CLOUDENV},
+    } for region in regions]
+
+    return {
+        'builders': builders,
+        'provisioners': [{
+            'type': 'shell',
+            'script': script,
+            'execute_command': "sudo -E bash '{{.Path}}'",
+        }],
+        'post-processors': [{
+            'type': 'manifest',
+            'output': manifest,
+            'custom_data': {'deploy': deploy},
+        }],
+    }
+
+
+def write_definitions(roles, regions, outdir, instance_type):
+    """Writes the provisioning script and Packer definition of every role to outdir,
+    returns the definition files"""
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    written = []
+    for deploy in roles:
+        script = os.path.join(outdir, '{0}.bake.bash'.format(deploy))
+        with open(script, 'w') as f:
+            f.write(bake_script(deploy))
+            f.write('\n')
+
+        definition = os.path.join(outdir, '{0}.packer.json'.format(deploy))
+        with open(definition, 'w') as f:
+            json.dump(build_definition(deploy, regions, instance_type, os.path.abspath(script),
+                                       os.path.join(os.path.abspath(outdir), MANIFEST)),
+                      f, indent=4, sort_keys=True, separators=(',', ': '))
+            f.write('\n')
+        written.append(definition)
+    return written
+
+
+def record(manifest, catalog):
+    """Adds the AMIs of a Packer manifest to the image catalog file, later builds of a
+    role replacing earlier ones. Returns the (region, deploy role, AMI) recorded."""
+    with open(manifest, 'r') as f:
+        builds = json.load(f).get('builds', [])
+
+    images = cfn.load_image_catalog(catalog)
+    recorded = []
+    for build in builds:
+        deploy = (build.get('custom_data') or {}).get('deploy')
+        if not deploy:
+            continue
+        # several regions are listed as region:ami,region:ami
+        for artifact in build['artifact_id'].split(','):
+            region, ami = artifact.split(':', 1)
+            images.setdefault(region, {})[deploy] = ami
+            recorded.append((region, deploy, ami))
+
+    directory = os.path.dirname(catalog)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(catalog, 'w') as f:
+        json.dump(images, f, indent=4, sort_keys=True, separators=(',', ': '))
+        f.write('\n')
+    return recorded
+
+
+def _create_parser():
+    parser = argparse.ArgumentParser(prog='bake.py')
+    parser.add_argument('-c', '--config', type=str, required=True, help='The configuration YAML file to bake images for')
+    parser.add_argument('-o', '--outdir', type=str, default='images',
+                        help='The directory to write the Packer definitions to (default: images)')
+    parser.add_argument('--regions', nargs='+', help='The regions to bake the images in (default: the region of the configuration)')
+    parser.add_argument('--instance-type', type=str, default='m4.large',
+                        help='The instance type the images are built on, they get its enhanced networking (default: m4.large)')
+    parser.add_argument('--record', type=str, metavar='MANIFEST',
+                        help='Add the images in this Packer manifest to the image catalog of the configuration')
+    parser.add_argument('--catalog', type=str, help='The image catalog file (default: images.catalog of the configuration)')
+    return parser
+
+
+if __name__ == '__main__':
+    args = _create_parser().parse_args()
+    ymlfile = generate._load_config(args.config)
+    cfn.initialize(ymlfile)
+
+    if args.record:
+        catalog = args.catalog or cfn.IMAGE_CATALOG
+        if not catalog:
+            raise Exception("{0} has no images catalog, pass --catalog".format(args.config))
+        for region, deploy, ami in record(args.record, catalog):
+            print("{0:<12} {1:<20} {2}".format(region, deploy, ami))
+        print("Recorded in {0}".format(catalog), file=sys.stderr)
+        sys.exit(0)
+
+    if args.instance_type not in cfn.INSTANCE_TYPES:
+        raise Exception("{0} is not in the instance catalog".format(args.instance_type))
+    roles = deploy_roles(ymlfile['components'])
+    for definition in write_definitions(roles, args.regions or [cfn.REGION], args.outdir, args.instance_type):
+        print(definition)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmarks the generator against synthetic workloads that are larger than any of
+# our environments (more availability zones, lots of queues, every component and
+# several VPCs) and compares the results with stored baselines. Nothing here talks
+# to AWS.
+#
+# Wall clock seconds depend on the machine and whatever else it is doing, so they are
+# only reported. Time is compared as relative_time: the seconds a scenario took over
+# the seconds a fixed calibration loop took in the same worker process.
+#
+#     python benchmark.py                     # run everything, fail on regressions
+#     python benchmark.py six-azs --repeat 9  # run a single scenario
+#     python benchmark.py --update-baselines  # store the current numbers
+
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from collections import OrderedDict
+from StringIO import StringIO
+
+try:
+    from importlib import reload
+except ImportError:
+    pass  # reload is a builtin on Python 2
+
+import config
+import generate
+import network
+import writer
+
+# Relative slowdowns smaller than this are noise at the sizes we run
+MIN_TIME_DELTA = 0.2
+
+# Rounds of the calibration loop, roughly as long as the baseline scenario takes
+CALIBRATION_ROUNDS = 2000
+
+# What generate.py prints when a component fails to emit its resources
+COMPONENT_FAILURE = 'Could not generation configuration'
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'baselines.json')
+
+ALL_COMPONENTS = ['application-support', 'babysitter', 'chef', 'deployer', 'docker-registry',
+                  'farragut_queues', 'jenkins', 'mesos', 'postgres', 'redshift', 'vpn', 'zookeeper']
+
+# vpcs is the number of separate VPC templates generated back to back and
+# queue_sets is the number of extra sets of farragut queues added to each
+SCENARIOS = OrderedDict([
+    ('baseline', dict(
+        description='An environment like leaf-dev',
+        azs=3, vpcs=1, queue_sets=0,
+        components=['babysitter', 'application-support', 'farragut_queues', 'postgres', 'vpn'])),
+    ('all-tiers', dict(
+        description='Every component enabled',
+        azs=3, vpcs=1, queue_sets=0, components=ALL_COMPONENTS)),
+    ('six-azs', dict(
+        description='Every component spread over six availability zones',
+        azs=6, vpcs=1, queue_sets=0, components=ALL_COMPONENTS)),
+    ('many-queues', dict(
+        description='Fifty sets of farragut queues (300 queues, their dead-letter queues and alarms)',
+        azs=3, vpcs=1, queue_sets=50, components=['babysitter', 'farragut_queues'])),
+    ('four-vpcs', dict(
+        description='Four VPCs with every component enabled',
+        azs=3, vpcs=4, queue_sets=0, components=ALL_COMPONENTS)),
+])
+
+
+class _ByteCounter(object):
+    """A stream that only counts what is written to it"""
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+
+def _synthetic_config(name, scenario, index):
+    return {
+        'infra': [{
+            'cloudname': 'bench{0}'.format(index),
+            'env': name.replace('-', ''),
+            'region': 'us-east-1',
+            'network': {
+                'cidr_16_prefix': '10.{0}'.format(100 + index),
+                'private_subnets': True,
+                'availability_zones': scenario['azs'],
+            },
+        }],
+        'components': scenario['components'],
+    }
+
+
+def _generate_vpc(name, scenario, index):
+    """Generates one VPC's template from scratch and returns (bytes, resources)"""
+    # The generator keeps its state in config and in the names the network and
+    # components import from it, so all of them are reloaded for every VPC
+    reload(config)
+    config.initialize(_synthetic_config(name, scenario, index))
+    reload(network)
+    for module in list(sys.modules):
+        if module.startswith('components.') or module.startswith('core.'):
+            del sys.modules[module]
+
+    generate.emit_template(scenario['components'])
+
+    env = config.CLOUDENV
+    for idx in range(scenario['queue_sets']):
+        config.CLOUDENV = '{0}{1}'.format(env, idx)
+        sys.modules.pop('components.farragut_queues', None)
+        generate._emit_component_configurations('components', components=['farragut_queues'])
+    config.CLOUDENV = env
+
+    counter = _ByteCounter()
+    writer.write_template(config.template, counter)
+    return counter.size, len(config.template.resources)
+
+
+def _calibrate():
+    """Times a fixed amount of dict building and JSON encoding, the kind of work the
+    generator does, to measure how fast this machine is right now"""
+    start = time.time()
+    for idx in range(CALIBRATION_ROUNDS):
+        document = {'Type': 'AWS::EC2::Instance', 'Properties': dict(('Key{0}'.format(k), str(k * idx)) for k in range(20))}
+        json.dumps(document, sort_keys=True)
+    return time.time() - start
+
+
+def _run_scenario(name):
+    """Runs a scenario. This is always called in a fresh worker process."""
+    scenario = SCENARIOS[name]
+    calibration = _calibrate()
+    stderr = sys.stderr
+    sys.stderr = StringIO()
+    try:
+        start = time.time()
+        outputs = [_generate_vpc(name, scenario, idx) for idx in range(scenario['vpcs'])]
+        elapsed = time.time() - start
+        messages = sys.stderr.getvalue()
+    finally:
+        sys.stderr = stderr
+
+    # A component that fails is only reported by the generator, and makes the
+    # scenario look faster than it is
+    failures = [line for line in messages.splitlines() if line.startswith(COMPONENT_FAILURE)]
+    if failures:
+        raise Exception("Scenario {0} failed:\n  {1}".format(name, '\n  '.join(failures)))
+
+    return {
+        'seconds': elapsed,
+        'relative_time': elapsed / calibration,
+        'peak_memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'bytes': sum(o[0] for o in outputs),
+        'resources': sum(o[1] for o in outputs),
+    }
+
+
+def run(names, repeat=5):
+    """Runs the scenarios, each repetition in its own process, keeping the run with the
+    lowest relative time"""
+    results = OrderedDict()
+    for name in names:
+        runs = []
+        for _ in range(repeat):
+            pool = multiprocessing.Pool(processes=1, maxtasksperchild=1)
+            try:
+                runs.append(pool.apply(_run_scenario, (name,)))
+            finally:
+                pool.close()
+                pool.join()
+        results[name] = min(runs, key=lambda r: r['relative_time'])
+        results[name]['peak_memory_kb'] = max(r['peak_memory_kb'] for r in runs)
+        print("{0:<14} {1:>9.4f}s {2:>7.2f}x {3:>10} KB {4:>10} bytes {5:>6} resources".format(
+            name, results[name]['seconds'], results[name]['relative_time'], results[name]['peak_memory_kb'],
+            results[name]['bytes'], results[name]['resources']), file=sys.stderr)
+    return results
+
+
+def compare(results, baselines, tolerances):
+    """Compares results with the baselines. Returns a list of regression messages."""
+    regressions = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            print("{0}: no baseline stored".format(name), file=sys.stderr)
+            continue
+        for metric, tolerance in tolerances.items():
+            if metric not in baseline:
+                print("{0}: no baseline stored for {1}".format(name, metric), file=sys.stderr)
+                continue
+            limit = baseline[metric] * (1 + tolerance)
+            if metric == 'relative_time':
+                limit = max(limit, baseline[metric] + MIN_TIME_DELTA)
+            if result[metric] > limit:
+                regressions.append("{0}: {1} is {2} against a baseline of {3} (limit {4:.4g})".format(
+                    name, metric, result[metric], baseline[metric], limit))
+    return regressions
+
+
+def _create_parser():
+    parser = argparse.ArgumentParser(prog='benchmark.py')
+    parser.add_argument('scenarios', nargs='*', help='Scenarios to run (default: all of {0})'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs per scenario, the fastest one (relative to calibration) counts')
+    parser.add_argument('--baselines', type=str, default=BASELINES, help='The baselines file to compare against')
+    parser.add_argument('--update-baselines', action='store_true', help='Store the results as the new baselines')
+    parser.add_argument('--report', type=str, help='Write the results as JSON to this file')
+    parser.add_argument('--time-tolerance', type=float, default=0.5, help='Allowed slowdown of relative_time (default: 0.5)')
+    parser.add_argument('--memory-tolerance', type=float, default=0.25, help='Allowed relative memory growth (default: 0.25)')
+    parser.add_argument('--size-tolerance', type=float, default=0.1, help='Allowed relative template growth (default: 0.1)')
+    return parser
+
+
+if __name__ == '__main__':
+    args = _create_parser().parse_args()
+    names = args.scenarios or list(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            raise Exception("Unknown scenario {0}, pick from {1}".format(name, ', '.join(SCENARIOS)))
+
+    results = run(names, repeat=args.repeat)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines, 'r') as f:
+            baselines = json.load(f)
+
+    if args.update_baselines:
+        baselines.update(results)
+        if not os.path.isdir(os.path.dirname(args.baselines)):
+            os.makedirs(os.path.dirname(args.baselines))
+        with open(args.baselines, 'w') as f:
+            json.dump(baselines, f, indent=4, sort_keys=True)
+        print("Stored baselines for {0} in {1}".format(', '.join(names), args.baselines), file=sys.stderr)
+        sys.exit(0)
+
+    regressions = compare(results, baselines, {
+        'relative_time': args.time_tolerance,
+        'peak_memory_kb': args.memory_tolerance,
+        'bytes': args.size_tolerance,
+        'resources': args.size_tolerance,
+    })
+    if regressions:
+        print("\nPERFORMANCE REGRESSION", file=sys.stderr)
+        for regression in regressions:
+            print("  " + regression, file=sys.stderr)
+        sys.exit(1)
+    print("\nNo regressions against {0}".format(args.baselines), file=sys.stderr)
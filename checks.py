@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Checks that run over the finished template (as plain JSON data) before it is
+# written. Every check returns a list of warnings, run() collects them all.
+
+import json
+
+import config as cfn
+import userdata
+
+
+def _ref(value):
+    """Returns the name value refers to through Ref, or None"""
+    if isinstance(value, dict) and len(value) == 1 and 'Ref' in value:
+        return value['Ref']
+    return None
+
+
+def _zone(resource):
+    """Returns a comparable form of a resource's availability zone, or None"""
+    zone = resource.get('Properties', {}).get('AvailabilityZone')
+    return json.dumps(zone, sort_keys=True) if zone is not None else None
+
+
+def _zone_name(zone):
+    """Turns the Fn::Join(AWS::Region, zone) of a subnet back into something readable"""
+    value = json.loads(zone)
+    if isinstance(value, dict) and 'Fn::Join' in value:
+        return ''.join(p if not isinstance(p, dict) else '<{0}>'.format(_ref(p) or '?') for p in value['Fn::Join'][1])
+    return str(value)
+
+
+def _nat_subnet(resources, title):
+    """Returns the subnet a NAT instance or NAT gateway sits in"""
+    properties = resources.get(title, {}).get('Properties', {})
+    if 'SubnetId' in properties:
+        return _ref(properties['SubnetId'])
+    for interface in properties.get('NetworkInterfaces', []):
+        if 'SubnetId' in interface:
+            return _ref(interface['SubnetId'])
+    return None
+
+
+def cross_zone_routes(tdict):
+    """Flags subnets whose default route goes through a NAT in another availability zone"""
+    resources = tdict.get('Resources', {})
+
+    # route table -> the NATs its routes go through
+    nats = {}
+    for title, resource in resources.items():
+        if resource['Type'] != 'AWS::EC2::Route':
+            continue
+        properties = resource.get('Properties', {})
+        table = _ref(properties.get('RouteTableId'))
+        nat = _ref(properties.get('InstanceId')) or _ref(properties.get('NatGatewayId'))
+        if table and nat:
+            nats.setdefault(table, []).append(nat)
+
+    warnings = []
+    for title, resource in sorted(resources.items()):
+        if resource['Type'] != 'AWS::EC2::SubnetRouteTableAssociation':
+            continue
+        subnet = _ref(resource['Properties'].get('SubnetId'))
+        table = _ref(resource['Properties'].get('RouteTableId'))
+        zone = _zone(resources.get(subnet, {}))
+        for nat in nats.get(table, []):
+            nat_zone = _zone(resources.get(_nat_subnet(resources, nat), {}))
+            if zone and nat_zone and zone != nat_zone:
+                warnings.append("{0} in {1} routes through {2} in {3} (route table {4})".format(
+                    subnet, _zone_name(zone), nat, _zone_name(nat_zone), table))
+    return warnings
+
+
+def _instance_type(tdict, resource):
+    """Returns the instance type of an instance, following a Ref to the default of a parameter"""
+    value = resource.get('Properties', {}).get('InstanceType')
+    parameter = _ref(value)
+    if parameter:
+        return tdict.get('Parameters', {}).get(parameter, {}).get('Default')
+    return value if isinstance(value, basestring) else None
+
+
+def nat_throughput(tdict):
+    """Flags NATs that can't carry the egress expected through each zone (NAT_EXPECTED_EGRESS)"""
+    if not cfn.NAT_EXPECTED_EGRESS:
+        return []
+    resources = tdict.get('Resources', {})
+
+    nats = set()
+    for resource in resources.values():
+        if resource['Type'] == 'AWS::EC2::Route':
+            properties = resource.get('Properties', {})
+            nats.add(_ref(properties.get('InstanceId')) or _ref(properties.get('NatGatewayId')))
+
+    warnings = []
+    for nat in sorted(n for n in nats if n in resources):
+        resource = resources[nat]
+        if resource['Type'] == 'AWS::EC2::NatGateway':
+            name, capacity = 'NAT gateway', cfn.NAT_GATEWAY_MBPS
+        else:
+            name = _instance_type(tdict, resource)
+            capacity = cfn.INSTANCE_TYPES[name].network_mbps if name in cfn.INSTANCE_TYPES else None
+        if capacity is None:
+            warnings.append("{0} is a {1}, whose network throughput isn't known".format(nat, name))
+        elif capacity < cfn.NAT_EXPECTED_EGRESS:
+            warnings.append("{0} ({1}) carries about {2} Mbit/s, but {3} Mbit/s of egress is expected through it".format(
+                nat, name, capacity, cfn.NAT_EXPECTED_EGRESS))
+    return warnings
+
+
+def user_data_size(tdict):
+    """Flags user data over the userdata.MAX_USER_DATA bytes EC2 accepts"""
+    return ["{0} has {1} bytes of user data, EC2 takes at most {2} (try user_data: gzip)".format(
+        title, size, userdata.MAX_USER_DATA) for title, size in sorted(userdata.sizes(tdict)) if size > userdata.MAX_USER_DATA]
+
+
+CHECKS = [cross_zone_routes, nat_throughput, user_data_size]
+
+
+def run(tdict):
+    """Runs every check, returns all of their warnings"""
+    warnings = []
+    for check in CHECKS:
+        warnings.extend(check(tdict))
+    return warnings
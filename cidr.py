@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This module hands out the subnets of a VPC's address space. The space is tracked as
+# a bitmap of /28 blocks (the smallest subnet AWS allows), so allocating a subnet of
+# any size is a matter of finding a free, aligned run of bits.
+#
+# Every allocation has a name (like 'worker-a'). Allocations can be loaded from and
+# saved to a JSON file, which keeps the subnets that already exist where they are
+# when the layout grows.
+
+import json
+import os
+import socket
+import struct
+from collections import OrderedDict
+
+# The smallest subnet AWS allows
+BLOCK_PREFIX = 28
+
+
+def _to_int(address):
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+
+def _to_address(value):
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+
+def parse(cidr):
+    """Returns the network address (as an int) and prefix length of a CIDR block"""
+    address, prefix = cidr.split('/')
+    prefix = int(prefix)
+    network = _to_int(address)
+    if network & ((1 << (32 - prefix)) - 1):
+        raise Exception("{0} is not aligned to its /{1} boundary".format(cidr, prefix))
+    return network, prefix
+
+
+def format_cidr(network, prefix):
+    return '{0}/{1}'.format(_to_address(network), prefix)
+
+
+def read_allocations(filename):
+    """Returns the allocations saved in filename (name -> cidr), if it exists"""
+    if not filename or not os.path.exists(filename):
+        return OrderedDict()
+    with open(filename, 'r') as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+
+class AddressSpace(object):
+    """The address space of a VPC and the subnets allocated in it"""
+    def __init__(self, cidr):
+        self.cidr = cidr
+        self.network, self.prefix = parse(cidr)
+        if self.prefix > BLOCK_PREFIX:
+            raise Exception("{0} is smaller than a /{1}".format(cidr, BLOCK_PREFIX))
+        self.blocks = 1 << (BLOCK_PREFIX - self.prefix)
+        self.bitmap = 0
+        self.allocations = OrderedDict()
+
+    def _blocks(self, cidr):
+        """Returns the first block and the number of blocks of a subnet in this space"""
+        network, prefix = parse(cidr)
+        if prefix > BLOCK_PREFIX:
+            raise Exception("{0} is smaller than a /{1}".format(cidr, BLOCK_PREFIX))
+        if prefix < self.prefix or (network >> (32 - self.prefix)) != (self.network >> (32 - self.prefix)):
+            raise Exception("{0} is not inside {1}".format(cidr, self.cidr))
+        return (network - self.network) >> (32 - BLOCK_PREFIX), 1 << (BLOCK_PREFIX - prefix)
+
+    def _mask(self, start, count):
+        return ((1 << count) - 1) << start
+
+    def is_free(self, cidr):
+        start, count = self._blocks(cidr)
+        return not self.bitmap & self._mask(start, count)
+
+    def overlapping(self, cidr):
+        """Returns the names of the allocations that overlap cidr"""
+        start, count = self._blocks(cidr)
+        mask = self._mask(start, count)
+        return [name for name, allocated in self.allocations.items() if self._mask(*self._blocks(allocated)) & mask]
+
+    def reserve(self, name, cidr):
+        """Allocates exactly cidr to name"""
+        if name in self.allocations:
+            raise Exception("{0} already has {1}".format(name, self.allocations[name]))
+        start, count = self._blocks(cidr)
+        if not self.is_free(cidr):
+            raise Exception("{0} for {1} overlaps {2}".format(cidr, name, ', '.join(self.overlapping(cidr))))
+        self.bitmap |= self._mask(start, count)
+        self.allocations[name] = cidr
+        return cidr
+
+    def release(self, name):
+        start, count = self._blocks(self.allocations.pop(name))
+        self.bitmap &= ~self._mask(start, count)
+
+    def allocate(self, name, prefix, preferred=None):
+        """Allocates a /prefix subnet to name: the one it already has, preferred if that
+        is free, or else the first free one"""
+        if name in self.allocations:
+            return self.allocations[name]
+        if preferred and parse(preferred)[1] == prefix and self.is_free(preferred):
+            return self.reserve(name, preferred)
+
+        count = 1 << (BLOCK_PREFIX - prefix)
+        mask = (1 << count) - 1
+        for start in range(0, self.blocks, count):
+            if not (self.bitmap >> start) & mask:
+                return self.reserve(name, format_cidr(self.network + (start << (32 - BLOCK_PREFIX)), prefix))
+        raise Exception("{0} has no free /{1} left for {2}".format(self.cidr, prefix, name))
+
+    def allocate_all(self, requests):
+        """Allocates a list of (name, prefix, preferred) requests. Preferred subnets are
+        handed out before anything is placed freely, so a request can't take the place
+        another one prefers. Returns name -> cidr."""
+        for name, prefix, preferred in requests:
+            if name not in self.allocations and preferred and parse(preferred)[1] == prefix and self.is_free(preferred):
+                self.reserve(name, preferred)
+        return OrderedDict((name, self.allocate(name, prefix)) for name, prefix, _ in requests)
+
+    def used(self):
+        """Returns the number of allocated addresses"""
+        return bin(self.bitmap).count('1') << (32 - BLOCK_PREFIX)
+
+    def size(self):
+        return 1 << (32 - self.prefix)
+
+    def largest_free(self):
+        """Returns the prefix length of the largest subnet that can still be allocated, or None"""
+        for prefix in range(self.prefix, BLOCK_PREFIX + 1):
+            count = 1 << (BLOCK_PREFIX - prefix)
+            mask = (1 << count) - 1
+            if any(not (self.bitmap >> start) & mask for start in range(0, self.blocks, count)):
+                return prefix
+        return None
+
+    def report(self):
+        """Returns a one line summary of how much of the space is in use"""
+        largest = self.largest_free()
+        return "{0}: {1} subnets, {2} of {3} addresses allocated ({4:.1f}%), largest free subnet {5}".format(
+            self.cidr, len(self.allocations), self.used(), self.size(), 100.0 * self.used() / self.size(),
+            '/{0}'.format(largest) if largest is not None else 'none')
+
+    def load(self, filename, requests=None):
+        """Reserves the allocations saved in filename. With requests (name -> prefix),
+        only the allocations that are still requested with the same size are kept."""
+        self.reserve_saved(read_allocations(filename), requests)
+
+    def reserve_saved(self, saved, requests=None):
+        """Reserves saved allocations (name -> cidr), like load()"""
+        for name, cidr in saved.items():
+            if requests is not None and requests.get(name) != parse(cidr)[1]:
+                continue
+            self.reserve(name, cidr)
+
+    def save(self, filename):
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(filename, 'w') as f:
+            json.dump(self.allocations, f, indent=4, separators=(',', ': '))
+            f.write('\n')
@@ -6,13 +6,7 @@
 import json
 
 from troposphere import Parameter, Ref, FindInMap, Base64, GetAtt, Tags
-import troposphere.autoscaling as autoscaling
-from troposphere.autoscaling import EC2_INSTANCE_TERMINATE, EC2_INSTANCE_LAUNCH, EC2_INSTANCE_LAUNCH_ERROR, EC2_INSTANCE_TERMINATE_ERROR
-import troposphere.cloudwatch as cloudwatch
 import troposphere.ec2 as ec2
-import troposphere.sns as sns
-import troposphere.sqs as sqs
-import troposphere.iam as iam
 
 import config as cfn
 from config import CIDR_PREFIX, VPC_NAME, CLOUDNAME, CLOUDENV, ASSUME_ROLE_POLICY, template
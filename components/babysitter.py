@@ -3,15 +3,10 @@
 
 # This module creates the babysitter instance and services
 
-import json
-
-from troposphere import Parameter, Ref, FindInMap, Base64, GetAtt, Tags
+from troposphere import Ref, GetAtt, Tags
 import troposphere.autoscaling as autoscaling
 from troposphere.autoscaling import EC2_INSTANCE_TERMINATE, EC2_INSTANCE_LAUNCH, EC2_INSTANCE_LAUNCH_ERROR, EC2_INSTANCE_TERMINATE_ERROR
-import troposphere.cloudwatch as cloudwatch
 import troposphere.ec2 as ec2
-import troposphere.sns as sns
-import troposphere.sqs as sqs
 import troposphere.iam as iam
 
 import config as cfn
@@ -20,14 +15,7 @@ from config import USE_PRIVATE_SUBNETS, DEFAULT_ROUTE
 
 def emit_configuration():
     # Parameters here
-    babysitter_instance_class = template.add_parameter(
-        Parameter(
-            'BabysitterInstanceType', Type='String', Default='t2.micro',
-            Description='Chef babysitter instance type',
-            AllowedValues=cfn.usable_instances(),
-            ConstraintDescription='Instance size must be a valid instance type'
-        )
-    )
+    babysitter_instance_class = cfn.instance_type_parameter('Babysitter', 't2.micro', 'Chef babysitter instance type')
 
     # babysitter IAM role
     babysitter_role_name = '.'.join(['babysitter', CLOUDNAME, CLOUDENV])
@@ -39,18 +27,17 @@ def emit_configuration():
             Policies=[
                 iam.Policy(
                     PolicyName='BabySitterPolicy',
-                    PolicyDocument=json.loads(cfn.load_template("babysitter_policy.json.j2",
+                    PolicyDocument=cfn.load_json_template("babysitter_policy.json.j2",
                         {"env": CLOUDENV, "cloud": CLOUDNAME, "region": "us-west-2"}
-                    ))
+                    )
                 ),
                 iam.Policy(
                     PolicyName='BabySitterDefaultPolicy',
-                    PolicyDocument=json.loads(cfn.load_template("default_policy.json.j2",
+                    PolicyDocument=cfn.load_json_template("default_policy.json.j2",
                         {"env": CLOUDENV, "cloud": CLOUDNAME, "region": "us-west-2"}
-                    ))
+                    )
                 )
-            ],
-            DependsOn=cfn.vpcs[0].title
+            ]
         )
     )
 
@@ -63,9 +50,7 @@ def emit_configuration():
         )
     )
 
-    babysitter_user_data = cfn.load_template("default-init.bash.j2",
-            {"env": CLOUDENV, "cloud": CLOUDNAME, "deploy": "babysitter"}
-    )
+    babysitter_user_data = cfn.user_data("babysitter")
 
     ingress_rules = [
         ec2.SecurityGroupRule(
@@ -87,8 +72,9 @@ def emit_configuration():
     launch_cfg = template.add_resource(
         autoscaling.LaunchConfiguration(
             "BabysitterLaunchConfiguration",
-            ImageId=FindInMap('RegionMap', Ref("AWS::Region"), int(cfn.Amis.EBS)),
+            ImageId=cfn.image_id("babysitter", cfn.Amis.EBS),
             InstanceType=Ref(babysitter_instance_class),
+            EbsOptimized=cfn.ebs_optimized(babysitter_instance_class),
             IamInstanceProfile=Ref(babysitter_instance_profile),
             AssociatePublicIpAddress=not USE_PRIVATE_SUBNETS,
             BlockDeviceMappings=[
@@ -102,7 +88,7 @@ def emit_configuration():
             KeyName=Ref(cfn.keyname),
             SecurityGroups=[Ref(security_group)],
             DependsOn=[babysitter_instance_profile.title, security_group.title],
-            UserData=Base64(babysitter_user_data)
+            UserData=babysitter_user_data
         )
     )
 
@@ -3,9 +3,7 @@
 
 # Create Chef stuff
 
-import json
-
-from troposphere import Ref, Parameter, FindInMap, Base64, Equals, Join
+from troposphere import Ref, FindInMap, Base64, Equals, Join
 from troposphere.s3 import Bucket
 from troposphere.iam import Role, Group, PolicyType, Policy, InstanceProfile
 from troposphere.ec2 import SecurityGroupRule, SecurityGroup, SecurityGroupIngress
@@ -21,20 +19,13 @@ def emit_configuration():
     vpc = cfn.vpcs[0]
     region = Ref("AWS::Region")
 
-    chefserver_instance_class = template.add_parameter(
-        Parameter(
-            'ChefServerInstanceType', Type='String', Default='t2.medium',
-            Description='Chef Server instance type',
-            AllowedValues=cfn.usable_instances(),
-            ConstraintDescription='Instance size must be a valid instance type'
-        )
-    )
+    chefserver_instance_class = cfn.instance_type_parameter('ChefServer', 't2.medium', 'Chef Server instance type')
 
     # Create IAM role for the chefserver instance
     # load the policies
-    default_policy = json.loads(cfn.load_template("default_policy.json.j2",
+    default_policy = cfn.load_json_template("default_policy.json.j2",
         {"env": CLOUDENV, "cloud": CLOUDNAME, "region": "us-east-1"}
-    ))
+    )
 
     chefserver_role_name = '.'.join(['chefserver', CLOUDNAME, CLOUDENV])
     chefserver_iam_role = template.add_resource(
@@ -45,18 +36,15 @@ def emit_configuration():
             Policies=[
                 Policy(
                     PolicyName="ChefServerPolicy",
-                    PolicyDocument=json.loads(
-                        cfn.load_template("chefserver_policy.json.j2",
-                            {"env": CLOUDENV, "cloud": CLOUDNAME, "region": "us-east-1"}
-                        )
+                    PolicyDocument=cfn.load_json_template("chefserver_policy.json.j2",
+                        {"env": CLOUDENV, "cloud": CLOUDNAME, "region": "us-east-1"}
                     )
                 ),
                 Policy(
                     PolicyName="ChefserverDefaultPolicy",
                     PolicyDocument=default_policy
                 )
-            ],
-            DependsOn=vpc.title
+            ]
         )
     )
 
@@ -95,6 +83,7 @@ def emit_configuration():
         chefserver_name,
         DependsOn=vpc.title,
         InstanceType=Ref(chefserver_instance_class),
+        EbsOptimized=cfn.ebs_optimized(chefserver_instance_class),
         KeyName=Ref(cfn.keyname),
         SourceDestCheck=False,
         ImageId=FindInMap('RegionMap', region, int(cfn.Amis.EBS)),
@@ -4,6 +4,7 @@
 from troposphere import Ref, Parameter, FindInMap, Base64, Equals, Join
 from troposphere.s3 import Bucket
 
+import config as cfn
 from config import template, CLOUDNAME, CLOUDENV
 
 def emit_configuration():
@@ -36,4 +37,5 @@ def emit_configuration():
             Condition=condition_name
         )
     )
+    cfn.add_s3_bucket(bucket_name)
 
@@ -3,9 +3,7 @@
 
 # This module creates the docker registry's dependencies like S3 buckets
 
-import json
-
-from troposphere import Ref, Parameter, FindInMap, Base64, Equals, Join
+from troposphere import Ref, Parameter, Equals, Join
 from troposphere.s3 import Bucket
 from troposphere.autoscaling import LaunchConfiguration, AutoScalingGroup, NotificationConfiguration
 from troposphere.ec2 import SecurityGroupRule, SecurityGroup, SecurityGroupIngress
@@ -18,13 +16,7 @@ from config import template, CLOUDNAME, CLOUDENV, CIDR_PREFIX, ASSUME_ROLE_POLIC
 def emit_configuration():
     vpc = cfn.vpcs[0]
 
-    instance_class = template.add_parameter(
-        Parameter(
-            'RegistryInstanceType', Type='String', Default='m3.medium',
-            Description='Registry instance type',
-            AllowedValues=cfn.usable_instances(),
-        )
-    )
+    instance_class = cfn.instance_type_parameter('Registry', 'm3.medium', 'Registry instance type')
 
     create_bucket = template.add_parameter(
         Parameter(
@@ -56,6 +48,8 @@ def emit_configuration():
             Condition=condition_name
         )
     )
+    # the registry's storage backend
+    cfn.add_s3_bucket(bucket_name)
 
     ingress_rules = [
         SecurityGroupRule(
@@ -75,9 +69,9 @@ def emit_configuration():
 
     policy_vars = { "env": CLOUDENV, "cloud": CLOUDNAME, "region": "us-east-1" }
     # IAM role for docker registry
-    policy = json.loads(cfn.load_template("registry_policy.json.j2", policy_vars))
+    policy = cfn.load_json_template("registry_policy.json.j2", policy_vars)
 
-    default_policy = json.loads(cfn.load_template("default_policy.json.j2", policy_vars))
+    default_policy = cfn.load_json_template("default_policy.json.j2", policy_vars)
 
     iam_role = template.add_resource(
         Role(
@@ -93,8 +87,7 @@ def emit_configuration():
                     PolicyName="RegistryPolicy",
                     PolicyDocument=policy
                 )
-            ],
-            DependsOn=vpc.title
+            ]
         )
     )
 
@@ -107,21 +100,20 @@ def emit_configuration():
         )
     )
 
-    user_data = cfn.load_template("default-init.bash.j2",
-        {"env": CLOUDENV, "cloud": CLOUDNAME, "deploy": "docker_registry"}
-    )
+    user_data = cfn.user_data("docker_registry")
 
     launch_config = template.add_resource(
         LaunchConfiguration(
             "RegistryLaunchConfiguration",
-            ImageId=FindInMap('RegionMap', Ref("AWS::Region"), int(cfn.Amis.INSTANCE)),
+            ImageId=cfn.image_id("docker_registry", cfn.Amis.INSTANCE),
             InstanceType=Ref(instance_class),
+            EbsOptimized=cfn.ebs_optimized(instance_class),
             IamInstanceProfile=Ref(instance_profile),
             KeyName=Ref(cfn.keyname),
             SecurityGroups=[Ref(sg)],
             DependsOn=[instance_profile.title, sg.title],
             AssociatePublicIpAddress=False,
-            UserData=Base64(user_data)
+            UserData=user_data
         )
     )
 
@@ -2,36 +2,109 @@
 # -*- coding: utf-8 -*-
 
 # This module creates the queues that farragut requires
+#
+# The queues come from the queues section of the YAML (or DEFAULT_QUEUES), every
+# setting a queue leaves out from queue_defaults (or config.QUEUE_SETTINGS). Names
+# get the environment appended. Consumers long-poll for wait seconds, a message that
+# was received max_receives times moves to the queue's dead-letter queue, and alarms
+# go off when more than backlog messages wait or the oldest one is over max_age
+# seconds old (and when anything lands in the dead-letter queue). The alarms notify
+# alarm_topic, or else the alert topic of the stack.
 
 from collections import namedtuple
 
 from troposphere import Parameter, Ref, FindInMap, Base64, GetAtt, Tags
-from troposphere.sqs import QueuePolicy, Queue
+from troposphere.cloudwatch import Alarm, MetricDimension
+from troposphere.sqs import QueuePolicy, Queue, RedrivePolicy
 
 import config as cfn
 from config import CIDR_PREFIX, VPC_NAME, CLOUDNAME, CLOUDENV, ASSUME_ROLE_POLICY
 from config import template
 
-QueueConfig = namedtuple('QueueConfig', ['name', 'visibility', 'retention', 'max_size'])
+QueueConfig = namedtuple('QueueConfig', ['name', 'visibility', 'retention', 'max_size', 'wait', 'max_receives',
+                                         'dlq_retention', 'backlog', 'max_age', 'alarm_topic'])
+
+DEFAULT_QUEUES = [
+    {'name': 'farragut-aggregate', 'visibility': 1800},
+    {'name': 'farragut-hourly', 'visibility': 180},
+    {'name': 'farragut-leaf-site'},
+    {'name': 'farragut-leaf'},
+    {'name': 'farragut', 'visibility': 1800},
+    {'name': 'farragut-import'},
+]
+
+
+def queue_config(spec):
+    """Returns the QueueConfig of a queue, config.initialize has checked its settings"""
+    settings = cfn.queue_settings(spec)
+    settings['name'] = '{0}-{1}'.format(spec['name'], CLOUDENV)
+    return QueueConfig(**settings)
+
+
+def _alarm(title, description, queue, metric, threshold, actions):
+    return Alarm(
+        title,
+        AlarmDescription=description,
+        Namespace='AWS/SQS',
+        MetricName=metric,
+        Dimensions=[
+            MetricDimension(
+                Name='QueueName',
+                Value=GetAtt(queue, "QueueName")
+            )
+        ],
+        Statistic='Maximum',
+        Period='300',
+        EvaluationPeriods='1',
+        Threshold=str(threshold),
+        ComparisonOperator='GreaterThanThreshold',
+        AlarmActions=actions,
+    )
 
 
 def emit_configuration():
-    # Build the 6 sqs queues for farragut
-    queues = [
-        QueueConfig('farragut-aggregate-{0}'.format(CLOUDENV), 1800, 345600, 262144),
-        QueueConfig('farragut-hourly-{0}'.format(CLOUDENV), 180, 345600, 262144),
-        QueueConfig('farragut-leaf-site-{0}'.format(CLOUDENV), 30, 345600, 262144),
-        QueueConfig('farragut-leaf-{0}'.format(CLOUDENV), 30, 345600, 262144),
-        QueueConfig('farragut-{0}'.format(CLOUDENV), 1800, 345600, 262144),
-        QueueConfig('farragut-import-{0}'.format(CLOUDENV), 30, 345600, 262144)
-    ]
+    # Build the sqs queues for farragut
+    queues = [queue_config(spec) for spec in (cfn.QUEUES or DEFAULT_QUEUES)]
+
     for q in queues:
-        template.add_resource(
+        redrive = None
+        if q.max_receives:
+            dead_letters = template.add_resource(
+                Queue(
+                    cfn.sanitize_id(q.name, 'dlq'),
+                    MessageRetentionPeriod=q.dlq_retention,
+                    MaximumMessageSize=q.max_size,
+                    QueueName='{0}-dlq'.format(q.name)
+                )
+            )
+            redrive = RedrivePolicy(deadLetterTargetArn=GetAtt(dead_letters, "Arn"), maxReceiveCount=q.max_receives)
+
+        queue_args = {'RedrivePolicy': redrive} if redrive else {}
+        queue = template.add_resource(
             Queue(
                 cfn.sanitize_id(q.name),
                 VisibilityTimeout=q.visibility,
                 MessageRetentionPeriod=q.retention,
                 MaximumMessageSize=q.max_size,
-                QueueName=q.name
+                ReceiveMessageWaitTimeSeconds=q.wait,
+                QueueName=q.name,
+                **queue_args
             )
         )
+
+        actions = [q.alarm_topic or Ref(cfn.alert_topic)]
+        if q.backlog:
+            template.add_resource(_alarm(
+                cfn.sanitize_id(q.name, 'BacklogAlarm'),
+                'Alarm if more than {0} messages wait in {1}'.format(q.backlog, q.name),
+                queue, 'ApproximateNumberOfMessagesVisible', q.backlog, actions))
+        if q.max_age:
+            template.add_resource(_alarm(
+                cfn.sanitize_id(q.name, 'AgeAlarm'),
+                'Alarm if the oldest message in {0} is over {1} seconds old'.format(q.name, q.max_age),
+                queue, 'ApproximateAgeOfOldestMessage', q.max_age, actions))
+        if q.max_receives:
+            template.add_resource(_alarm(
+                cfn.sanitize_id(q.name, 'DeadLetterAlarm'),
+                'Alarm if messages land in {0}-dlq'.format(q.name),
+                dead_letters, 'ApproximateNumberOfMessagesVisible', 0, actions))
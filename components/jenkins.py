@@ -3,15 +3,10 @@
 
 # This module creates the jenkins instance and services
 
-import json
-
-from troposphere import Parameter, Ref, FindInMap, Base64, GetAtt, Tags
+from troposphere import Ref, GetAtt, Tags, Join
 import troposphere.autoscaling as autoscaling
 from troposphere.autoscaling import EC2_INSTANCE_TERMINATE, EC2_INSTANCE_LAUNCH, EC2_INSTANCE_LAUNCH_ERROR, EC2_INSTANCE_TERMINATE_ERROR
-import troposphere.cloudwatch as cloudwatch
 import troposphere.ec2 as ec2
-import troposphere.sns as sns
-import troposphere.sqs as sqs
 import troposphere.iam as iam
 
 import config as cfn
@@ -20,14 +15,10 @@ from config import USE_PRIVATE_SUBNETS, DEFAULT_ROUTE
 
 def emit_configuration():
     # Parameters here
-    jenkins_instance_class = template.add_parameter(
-        Parameter(
-            'JenkinsInstanceType', Type='String', Default='t2.micro',
-            Description='Chef jenkins instance type',
-            AllowedValues=cfn.usable_instances(),
-            ConstraintDescription='Instance size must be a valid instance type'
-        )
-    )
+    jenkins_instance_class = cfn.instance_type_parameter('Jenkins', 't2.micro', 'Chef jenkins instance type')
+
+    # jenkins pushes the images it builds to the docker registry's bucket
+    cfn.add_s3_bucket(Join('.', ['docker-registry', CLOUDNAME, Ref("AWS::Region"), CLOUDENV, 'leafme']))
 
     # jenkins IAM role
     jenkins_role_name = '.'.join(['jenkins', CLOUDNAME, CLOUDENV])
@@ -39,18 +30,17 @@ def emit_configuration():
             Policies=[
                 iam.Policy(
                     PolicyName='JenkinsPolicy',
-                    PolicyDocument=json.loads(cfn.load_template("jenkins_policy.json.j2",
+                    PolicyDocument=cfn.load_json_template("jenkins_policy.json.j2",
                         {"env": CLOUDENV, "cloud": CLOUDNAME, "region": "us-east-1"}
-                    ))
+                    )
                 ),
                 iam.Policy(
                     PolicyName='JenkinsDefaultPolicy',
-                    PolicyDocument=json.loads(cfn.load_template("default_policy.json.j2",
+                    PolicyDocument=cfn.load_json_template("default_policy.json.j2",
                         {"env": CLOUDENV, "cloud": CLOUDNAME, "region": "us-east-1"}
-                    ))
+                    )
                 )
-            ],
-            DependsOn=cfn.vpcs[0].title
+            ]
         )
     )
 
@@ -63,9 +53,7 @@ def emit_configuration():
         )
     )
 
-    jenkins_user_data = cfn.load_template("default-init.bash.j2",
-            {"env": CLOUDENV, "cloud": CLOUDNAME, "deploy": "jenkins"}
-    )
+    jenkins_user_data = cfn.user_data("jenkins")
 
     ingress_rules = [
         ec2.SecurityGroupRule(
@@ -87,8 +75,9 @@ def emit_configuration():
     launch_cfg = template.add_resource(
         autoscaling.LaunchConfiguration(
             "JenkinsLaunchConfiguration",
-            ImageId=FindInMap('RegionMap', Ref("AWS::Region"), int(cfn.Amis.EBS)),
+            ImageId=cfn.image_id("jenkins", cfn.Amis.EBS),
             InstanceType=Ref(jenkins_instance_class),
+            EbsOptimized=cfn.ebs_optimized(jenkins_instance_class),
             IamInstanceProfile=Ref(jenkins_instance_profile),
             AssociatePublicIpAddress=not USE_PRIVATE_SUBNETS,
             BlockDeviceMappings=[
@@ -102,7 +91,7 @@ def emit_configuration():
             KeyName=Ref(cfn.keyname),
             SecurityGroups=[Ref(security_group)],
             DependsOn=[jenkins_instance_profile.title, security_group.title],
-            UserData=Base64(jenkins_user_data)
+            UserData=jenkins_user_data
         )
     )
 
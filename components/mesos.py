@@ -3,10 +3,7 @@
 
 # Create Mesos cluster
 
-import json
-
-from troposphere import Ref, Parameter, FindInMap, Base64, Equals, Join
-from troposphere.s3 import Bucket
+from troposphere import Ref, Equals, Join
 from troposphere.iam import Role, Group, PolicyType, Policy, InstanceProfile
 from troposphere.ec2 import SecurityGroupRule, SecurityGroup, SecurityGroupIngress
 from troposphere.autoscaling import LaunchConfiguration, AutoScalingGroup, NotificationConfiguration
@@ -20,14 +17,7 @@ def emit_configuration():
     vpc = cfn.vpcs[0]
     region = Ref("AWS::Region")
 
-    mesos_instance_class = template.add_parameter(
-        Parameter(
-            'MesosInstanceType', Type='String', Default='m3.large',
-            Description='Mesos instance type (for workers and masters)',
-            AllowedValues=cfn.usable_instances(),
-            ConstraintDescription='Instance size must be a valid instance type'
-        )
-    )
+    mesos_instance_class = cfn.instance_type_parameter('Mesos', 'm3.large', 'Mesos instance type (for workers and masters)')
 
     ingress_rules = [
         SecurityGroupRule(
@@ -58,13 +48,13 @@ def emit_configuration():
         )
     )
 
-    default_policy = json.loads(cfn.load_template("default_policy.json.j2",
+    default_policy = cfn.load_json_template("default_policy.json.j2",
         {"env": CLOUDENV, "cloud": CLOUDNAME, "region": "us-east-1"}
-    ))
+    )
 
-    mesos_policy = json.loads(cfn.load_template("mesos_policy.json.j2",
+    mesos_policy = cfn.load_json_template("mesos_policy.json.j2",
         {"env": CLOUDENV, "cloud": CLOUDNAME, "region": "us-east-1"}
-    ))
+    )
 
     # IAM role here
     iam_role = template.add_resource(
@@ -81,8 +71,7 @@ def emit_configuration():
                     PolicyName='MesosIamPolicy',
                     PolicyDocument=mesos_policy
                 )
-            ],
-            DependsOn=vpc.title
+            ]
         )
     )
 
@@ -97,22 +86,21 @@ def emit_configuration():
     )
 
     # UserData here
-    master_user_data = cfn.load_template("default-init.bash.j2",
-        {"env": CLOUDENV, "cloud": CLOUDNAME, "deploy": "mesos_master"}
-    )
+    master_user_data = cfn.user_data("mesos_master")
 
     # LaunchConfiguration for master mesos
     master_launch_configuration = template.add_resource(
         LaunchConfiguration(
             "MesosMasterLaunchConfiguration",
-            ImageId=FindInMap('RegionMap', region, int(cfn.Amis.INSTANCE)),
+            ImageId=cfn.image_id("mesos_master", cfn.Amis.INSTANCE),
             InstanceType=Ref(mesos_instance_class),
+            EbsOptimized=cfn.ebs_optimized(mesos_instance_class),
             IamInstanceProfile=Ref(instance_profile),
             KeyName=Ref(cfn.keyname),
             SecurityGroups=[Ref(mesos_security_group)],
             DependsOn=[instance_profile.title, mesos_security_group.title],
             AssociatePublicIpAddress=False,
-            UserData=Base64(master_user_data)
+            UserData=master_user_data
         )
     )
 
@@ -138,33 +126,33 @@ def emit_configuration():
     )
 
     # Worker Mesos
-    worker_user_data = cfn.load_template("default-init.bash.j2",
-        {"env": CLOUDENV, "cloud": CLOUDNAME, "deploy": "mesos_slave"}
-    )
+    worker_user_data = cfn.user_data("mesos_slave")
 
     worker_launch_configuration = template.add_resource(
         LaunchConfiguration(
             "MesosWorkerLaunchConfiguration",
-            ImageId=FindInMap('RegionMap', region, int(cfn.Amis.INSTANCE)),
+            ImageId=cfn.image_id("mesos_slave", cfn.Amis.INSTANCE),
             InstanceType=Ref(mesos_instance_class),
+            EbsOptimized=cfn.ebs_optimized(mesos_instance_class),
             IamInstanceProfile=Ref(instance_profile),
             KeyName=Ref(cfn.keyname),
             SecurityGroups=[Ref(mesos_security_group)],
             DependsOn=[instance_profile.title, mesos_security_group.title],
             AssociatePublicIpAddress=False,
-            UserData=Base64(worker_user_data)
+            UserData=worker_user_data
         )
     )
 
+    # At least one worker per availability zone, and up to four in each but no fewer
+    # than 12, the maximum from before the zones were configurable (unless the scaling
+    # section of the YAML sizes the group)
+    zone_count = len(cfn.get_availability_zones())
     worker_asg_name = '.'.join(['mesos-worker', CLOUDNAME, CLOUDENV]),
     worker_asg = template.add_resource(
         AutoScalingGroup(
             "MesosWorkerASG",
             AvailabilityZones=cfn.get_asg_azs(),
-            DesiredCapacity="3",
             LaunchConfigurationName=Ref(worker_launch_configuration),
-            MinSize="3",
-            MaxSize="12",
             NotificationConfiguration=NotificationConfiguration(
                 TopicARN=Ref(cfn.alert_topic),
                 NotificationTypes=[
@@ -172,7 +160,11 @@ def emit_configuration():
                 ]
             ),
             VPCZoneIdentifier=[Ref(sn) for sn in cfn.get_vpc_subnets(vpc, cfn.SubnetTypes.WORKER)],
-            DependsOn=[sn.title for sn in cfn.get_vpc_subnets(vpc, cfn.SubnetTypes.WORKER)]
+            DependsOn=[sn.title for sn in cfn.get_vpc_subnets(vpc, cfn.SubnetTypes.WORKER)],
+            **cfn.asg_capacity('MesosWorker', max(3, zone_count), max(12, 4 * zone_count))
         )
     )
 
+    # Grows and shrinks with load when the scaling section of the YAML has MesosWorker
+    cfn.add_scaling_policies(worker_asg)
+
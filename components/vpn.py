@@ -3,10 +3,7 @@
 
 # Create VPN stuff
 
-import json
-
-from troposphere import Ref, Parameter, FindInMap, Base64, Equals, Join
-from troposphere.s3 import Bucket
+from troposphere import Ref, Equals, Join
 import troposphere.autoscaling as autoscaling
 
 from troposphere.autoscaling import EC2_INSTANCE_TERMINATE, EC2_INSTANCE_LAUNCH, EC2_INSTANCE_LAUNCH_ERROR, EC2_INSTANCE_TERMINATE_ERROR
@@ -23,14 +20,7 @@ def emit_configuration():
     vpc = cfn.vpcs[0]
     region = Ref("AWS::Region")
 
-    vpn_instance_class = template.add_parameter(
-        Parameter(
-            'VPNInstanceType', Type='String', Default='m3.medium',
-            Description='VPN instance type',
-            AllowedValues=cfn.usable_instances(),
-            ConstraintDescription='Instance size must be a valid instance type'
-        )
-    )
+    vpn_instance_class = cfn.instance_type_parameter('VPN', 'm3.medium', 'VPN instance type')
 
     vpn_ingress_rules = [
         SecurityGroupRule(
@@ -49,13 +39,13 @@ def emit_configuration():
     )
 
     # IAM role for vpn
-    vpn_policy = json.loads(cfn.load_template("vpn_policy.json.j2",
+    vpn_policy = cfn.load_json_template("vpn_policy.json.j2",
         {"env": CLOUDENV, "cloud": CLOUDNAME, "region": "us-west-2"}
-    ))
+    )
 
-    default_policy = json.loads(cfn.load_template("default_policy.json.j2",
+    default_policy = cfn.load_json_template("default_policy.json.j2",
         {"env": CLOUDENV, "cloud": CLOUDNAME, "region": "us-west-2"}
-    ))
+    )
 
     vpn_role_name = '.'.join(['vpn', CLOUDNAME, CLOUDENV])
     vpn_iam_role = template.add_resource(
@@ -72,8 +62,7 @@ def emit_configuration():
                     PolicyName="VPNPolicy",
                     PolicyDocument=vpn_policy
                 )
-            ],
-            DependsOn=vpc.title
+            ]
         )
     )
 
@@ -86,22 +75,21 @@ def emit_configuration():
         )
     )
 
-    vpn_user_data = cfn.load_template("default-init.bash.j2",
-        {"env": CLOUDENV, "cloud": CLOUDNAME, "deploy": "vpn"}
-    )
+    vpn_user_data = cfn.user_data("vpn")
 
     # Launch Configuration for vpns
     vpn_launchcfg = template.add_resource(
         LaunchConfiguration(
             "VPNLaunchConfiguration",
-            ImageId=FindInMap('RegionMap', region, int(cfn.Amis.INSTANCE)),
+            ImageId=cfn.image_id("vpn", cfn.Amis.INSTANCE),
             InstanceType=Ref(vpn_instance_class),
+            EbsOptimized=cfn.ebs_optimized(vpn_instance_class),
             IamInstanceProfile=Ref(vpn_instance_profile),
             KeyName=Ref(cfn.keyname),
             SecurityGroups=[Ref(vpn_sg)],
             DependsOn=[vpn_instance_profile.title, vpn_sg.title],
             AssociatePublicIpAddress=True,
-            UserData=Base64(vpn_user_data)
+            UserData=vpn_user_data
         )
     )
 
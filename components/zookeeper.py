@@ -3,9 +3,7 @@
 
 # This module creates zookeeper stuff
 
-import json
-
-from troposphere import Ref, Parameter, FindInMap, Base64, Equals, Join
+from troposphere import Ref, Parameter, Equals, Join
 from troposphere.s3 import Bucket
 import troposphere.autoscaling as autoscaling
 from troposphere.autoscaling import EC2_INSTANCE_TERMINATE, EC2_INSTANCE_LAUNCH, EC2_INSTANCE_LAUNCH_ERROR, EC2_INSTANCE_TERMINATE_ERROR
@@ -21,14 +19,7 @@ def emit_configuration():
     vpc = cfn.vpcs[0]
     region = Ref("AWS::Region")
 
-    zookeeper_instance_class = template.add_parameter(
-        Parameter(
-            'ZookeeperInstanceType', Type='String', Default='m3.medium',
-            Description='Zookeeper instance type',
-            AllowedValues=cfn.usable_instances(),
-            ConstraintDescription='Instance size must be a valid instance type'
-        )
-    )
+    zookeeper_instance_class = cfn.instance_type_parameter('Zookeeper', 'm3.medium', 'Zookeeper instance type')
 
     create_zookeeper_bucket = template.add_parameter(
         Parameter(
@@ -97,6 +88,8 @@ def emit_configuration():
             Condition="ZookeeperBucketCondition"
         )
     )
+    # Exhibitor keeps its config and backups here
+    cfn.add_s3_bucket(zookeeper_bucket_name)
 
     zookeeper_role_name = '.'.join(['zookeeper', CLOUDNAME, CLOUDENV])
     zookeeper_iam_role = template.add_resource(
@@ -107,18 +100,17 @@ def emit_configuration():
             Policies=[
                 Policy(
                     PolicyName="ZookeeperDefaultPolicy",
-                    PolicyDocument=json.loads(cfn.load_template("default_policy.json.j2",
+                    PolicyDocument=cfn.load_json_template("default_policy.json.j2",
                         {"env": CLOUDENV, "cloud": CLOUDNAME, "region": "us-east-1" }
-                    ))
+                    )
                 ),
                 Policy(
                     PolicyName="ZookeeperPolicy",
-                    PolicyDocument=json.loads(cfn.load_template("zookeeper_policy.json.j2",
+                    PolicyDocument=cfn.load_json_template("zookeeper_policy.json.j2",
                         {"env": CLOUDENV, "cloud": CLOUDNAME, "region": "us-east-1"}
-                    ))
+                    )
                 )
-            ],
-            DependsOn=vpc.title
+            ]
         )
     )
 
@@ -131,22 +123,21 @@ def emit_configuration():
         )
     )
 
-    zookeeper_user_data = cfn.load_template("default-init.bash.j2",
-            {"env": CLOUDENV, "cloud": CLOUDNAME, "deploy": "zookeeper"}
-    )
+    zookeeper_user_data = cfn.user_data("zookeeper")
 
     # Launch Configuration for zookeepers
     zookeeper_launchcfg = template.add_resource(
         LaunchConfiguration(
             "ZookeeperLaunchConfiguration",
-            ImageId=FindInMap('RegionMap', region, int(cfn.Amis.INSTANCE)),
+            ImageId=cfn.image_id("zookeeper", cfn.Amis.INSTANCE),
             InstanceType=Ref(zookeeper_instance_class),
+            EbsOptimized=cfn.ebs_optimized(zookeeper_instance_class),
             IamInstanceProfile=Ref(zookeeper_instance_profile),
             AssociatePublicIpAddress=not USE_PRIVATE_SUBNETS,
             KeyName=Ref(cfn.keyname),
             SecurityGroups=[Ref(zookeeper_sg)],
             DependsOn=[zookeeper_instance_profile.title, zookeeper_sg.title],
-            UserData=Base64(zookeeper_user_data)
+            UserData=zookeeper_user_data
         )
     )
 
@@ -1,13 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import copy
+import json
 import os
-import yaml
-from collections import defaultdict
+from collections import defaultdict, namedtuple, OrderedDict
 
-import jinja2
 from enum import IntEnum
-from troposphere import Template, Join, Ref
+from troposphere import Template, Join, Ref, FindInMap, Parameter, Base64, Equals, If
+
+import cidr
+import scaling
+import userdata
 
 
 def sanitize_id(*args):
@@ -31,6 +35,57 @@ REGION = 'us-west-2'
 USE_PRIVATE_SUBNETS = True
 VPC_NAME = sanitize_id(CLOUDNAME, CLOUDENV)
 
+# Subnet type (platform, database, vpn, public, master, worker) -> prefix length,
+# for the types that don't use the default size (see network.SUBNET_LAYOUT)
+SUBNET_SIZES = {}
+
+# A JSON file the subnet allocations are kept in between runs, if any
+SUBNET_ALLOCATIONS = None
+
+# The services (s3, dynamodb) that get a gateway VPC endpoint on the private route
+# tables, and the buckets the S3 endpoint allows besides the ones components declare
+VPC_ENDPOINTS = []
+VPC_ENDPOINT_BUCKETS = []
+
+# NAT instances ('instance') or managed NAT gateways ('gateway'), the default type of
+# the NAT instances and the egress (in Mbit/s) expected through each zone's NAT at peak
+NAT_MODE = 'instance'
+NAT_INSTANCE_TYPE = 't2.micro'
+NAT_EXPECTED_EGRESS = None
+
+# Whether instances boot from the images bake.py built for their deploy role, and the
+# JSON file those images are recorded in (region -> deploy role -> AMI)
+BAKED_IMAGES = False
+IMAGE_CATALOG = None
+
+# How user data is shipped: the init script of each role ('script'), or a gzipped
+# cloud-init archive of the settings of the role and a script all roles share ('gzip')
+USER_DATA_FORMAT = 'script'
+USER_DATA_FORMATS = ('script', 'gzip')
+
+# Auto scaling group (title without 'ASG', like MesosWorker) -> its size, cooldown and
+# scaling policies, see scaling.py
+SCALING = {}
+
+# The farragut queues and the settings every queue gets unless it has its own, see
+# components/farragut_queues.py (None keeps the queues farragut always had)
+QUEUES = None
+QUEUE_DEFAULTS = {}
+
+# The settings of a queue and their defaults. Alarms notify alarm_topic, or the alert
+# topic of the stack when it is left out.
+QUEUE_SETTINGS = {
+    'visibility': 30,
+    'retention': 345600,
+    'max_size': 262144,
+    'wait': 20,
+    'max_receives': 5,
+    'dlq_retention': 1209600,
+    'backlog': 1000,
+    'max_age': 3600,
+    'alarm_topic': None,
+}
+
 
 def initialize(config):
     global CIDR_PREFIX
@@ -39,6 +94,23 @@ def initialize(config):
     global USE_PRIVATE_SUBNETS
     global REGION
     global VPC_NAME
+    global SUBNET_SIZES
+    global SUBNET_ALLOCATIONS
+    global VPC_ENDPOINTS
+    global VPC_ENDPOINT_BUCKETS
+    global NAT_MODE
+    global NAT_INSTANCE_TYPE
+    global NAT_EXPECTED_EGRESS
+    global INSTANCE_REQUIREMENTS
+    global BAKED_IMAGES
+    global IMAGE_CATALOG
+    global USER_DATA_FORMAT
+    global SCALING
+    global QUEUES
+    global QUEUE_DEFAULTS
+    global baked_amis
+    global saved_subnet_allocations
+    global availability_zones
     infra = config['infra'][0]
 
     CIDR_PREFIX = infra['network']['cidr_16_prefix']
@@ -47,6 +119,36 @@ def initialize(config):
     USE_PRIVATE_SUBNETS = infra['network']['private_subnets']
     REGION = infra['region']
     VPC_NAME = sanitize_id(CLOUDNAME, CLOUDENV)
+    SUBNET_SIZES = infra['network'].get('subnet_sizes') or {}
+    SUBNET_ALLOCATIONS = infra['network'].get('subnet_allocations')
+    saved_subnet_allocations = cidr.read_allocations(SUBNET_ALLOCATIONS)
+    VPC_ENDPOINTS = infra['network'].get('vpc_endpoints') or []
+    VPC_ENDPOINT_BUCKETS = infra['network'].get('vpc_endpoint_buckets') or []
+    NAT_MODE = infra['network'].get('nat', 'instance')
+    NAT_INSTANCE_TYPE = infra['network'].get('nat_instance_type', 't2.micro')
+    NAT_EXPECTED_EGRESS = infra['network'].get('expected_egress_mbps')
+    INSTANCE_REQUIREMENTS = infra.get('instance_types') or {}
+    BAKED_IMAGES = (infra.get('images') or {}).get('baked', False)
+    IMAGE_CATALOG = (infra.get('images') or {}).get('catalog')
+    if BAKED_IMAGES and not IMAGE_CATALOG:
+        raise Exception("Booting from baked images needs an images catalog file")
+    baked_amis = load_image_catalog(IMAGE_CATALOG) if BAKED_IMAGES else {}
+    for region, amis in baked_amis.items():
+        template.mappings['RegionMap'].setdefault(region, {}).update(
+            (baked_image_key(deploy), ami) for deploy, ami in amis.items())
+    USER_DATA_FORMAT = infra.get('user_data', 'script')
+    if USER_DATA_FORMAT not in USER_DATA_FORMATS:
+        raise Exception("user_data is one of {0}, not {1}".format(', '.join(USER_DATA_FORMATS), USER_DATA_FORMAT))
+    SCALING = infra.get('scaling') or {}
+    QUEUES = infra.get('queues')
+    QUEUE_DEFAULTS = infra.get('queue_defaults') or {}
+    check_queue_settings('queue_defaults', QUEUE_DEFAULTS)
+    for spec in QUEUES or []:
+        if not isinstance(spec, dict) or not spec.get('name'):
+            raise Exception("Every queue in queues needs a name")
+        check_queue_settings(spec['name'], dict(spec, name=None))
+    availability_zones = select_availability_zones(REGION, infra['network'].get('availability_zones'))
+    template.add_description(DESCRIPTION.format(len(availability_zones)))
 
 
 ASSUME_ROLE_POLICY = {
@@ -60,29 +162,218 @@ ASSUME_ROLE_POLICY = {
     }]
 }
 
-ALLOWED_INSTANCE_SIZES = ['t2.micro', 't2.small', 't2.medium', 'm3.medium',
-        'm3.large', 'm3.xlarge', 'm3.2xlarge', 'c3.large', 'c3.xlarge', 'c3.2xlarge']
+# What an instance type offers: vCPUs, memory (GiB), the network throughput it sustains
+# (Mbit/s), whether EBS optimization is unavailable ('no'), can be turned on ('optional')
+# or is always on ('default'), its instance store disks (count, GB each), its enhanced
+# networking (None, 'sriov' or 'ena') and whether it is burstable.
+InstanceType = namedtuple('InstanceType', 'vcpus memory network_mbps ebs_optimized instance_store enhanced_networking burstable')
+
+def _types(family, ebs_optimized, enhanced_networking, sizes):
+    """Returns the (name, InstanceType) of every size of a family. ebs_optimized may be
+    a function of the size."""
+    types = []
+    for size, vcpus, memory, mbps, disks in sizes:
+        ebs = ebs_optimized(size) if callable(ebs_optimized) else ebs_optimized
+        types.append(('{0}.{1}'.format(family, size),
+                      InstanceType(vcpus, memory, mbps, ebs, disks, enhanced_networking, family == 't2')))
+    return types
+
+# The instance types components can use. AWS only publishes network tiers like 'Low to
+# Moderate' for the smaller types, their throughput here is what they hold up to over
+# time (t2s less once their CPU credits run out) and only meant for rough sizing.
+INSTANCE_TYPES = OrderedDict(
+    _types('t2', 'no', None, [
+        ('micro', 1, 1, 60, (0, 0)),
+        ('small', 1, 2, 125, (0, 0)),
+        ('medium', 2, 4, 250, (0, 0)),
+        ('large', 2, 8, 300, (0, 0)),
+        ('xlarge', 4, 16, 500, (0, 0)),
+        ('2xlarge', 8, 32, 700, (0, 0)),
+    ]) +
+    _types('m3', lambda size: 'optional' if size in ('xlarge', '2xlarge') else 'no', None, [
+        ('medium', 1, 3.75, 300, (1, 4)),
+        ('large', 2, 7.5, 500, (1, 32)),
+        ('xlarge', 4, 15, 700, (2, 40)),
+        ('2xlarge', 8, 30, 1000, (2, 80)),
+    ]) +
+    _types('m4', 'default', 'sriov', [
+        ('large', 2, 8, 450, (0, 0)),
+        ('xlarge', 4, 16, 750, (0, 0)),
+        ('2xlarge', 8, 32, 1000, (0, 0)),
+        ('4xlarge', 16, 64, 2000, (0, 0)),
+        ('10xlarge', 40, 160, 10000, (0, 0)),
+    ]) +
+    _types('m4', 'default', 'ena', [
+        ('16xlarge', 64, 256, 20000, (0, 0)),
+    ]) +
+    _types('c3', lambda size: 'optional' if size in ('xlarge', '2xlarge', '4xlarge') else 'no', 'sriov', [
+        ('large', 2, 3.75, 500, (2, 16)),
+        ('xlarge', 4, 7.5, 700, (2, 40)),
+        ('2xlarge', 8, 15, 1000, (2, 80)),
+        ('4xlarge', 16, 30, 2000, (2, 160)),
+        ('8xlarge', 32, 60, 10000, (2, 320)),
+    ]) +
+    _types('c4', 'default', 'sriov', [
+        ('large', 2, 3.75, 500, (0, 0)),
+        ('xlarge', 4, 7.5, 750, (0, 0)),
+        ('2xlarge', 8, 15, 1000, (0, 0)),
+        ('4xlarge', 16, 30, 2000, (0, 0)),
+        ('8xlarge', 36, 60, 10000, (0, 0)),
+    ]) +
+    _types('r3', lambda size: 'optional' if size in ('xlarge', '2xlarge', '4xlarge') else 'no', 'sriov', [
+        ('large', 2, 15.25, 500, (1, 32)),
+        ('xlarge', 4, 30.5, 700, (1, 80)),
+        ('2xlarge', 8, 61, 1000, (1, 160)),
+        ('4xlarge', 16, 122, 2000, (1, 320)),
+        ('8xlarge', 32, 244, 10000, (2, 320)),
+    ]) +
+    _types('r4', 'default', 'ena', [
+        ('large', 2, 15.25, 750, (0, 0)),
+        ('xlarge', 4, 30.5, 1250, (0, 0)),
+        ('2xlarge', 8, 61, 2500, (0, 0)),
+        ('4xlarge', 16, 122, 5000, (0, 0)),
+        ('8xlarge', 32, 244, 10000, (0, 0)),
+        ('16xlarge', 64, 488, 20000, (0, 0)),
+    ]) +
+    _types('i3', 'default', 'ena', [
+        ('large', 2, 15.25, 750, (1, 475)),
+        ('xlarge', 4, 30.5, 1250, (1, 950)),
+        ('2xlarge', 8, 61, 2500, (1, 1900)),
+        ('4xlarge', 16, 122, 5000, (2, 1900)),
+        ('8xlarge', 32, 244, 10000, (4, 1900)),
+        ('16xlarge', 64, 488, 20000, (8, 1900)),
+    ])
+)
+
+# The instance type parameter name (like Mesos for MesosInstanceType) -> an instance
+# type, or the minimums (min_vcpus, min_memory) its type has to meet
+INSTANCE_REQUIREMENTS = {}
 
 def usable_instances():
     """Retrieve list of AWS instance sizes that can be used"""
-    return ALLOWED_INSTANCE_SIZES
+    return list(INSTANCE_TYPES)
+
+def select_instance_types(min_vcpus=0, min_memory=0):
+    """Returns the instance types with at least min_vcpus and min_memory GiB, the
+    smallest (non-burstable) type first"""
+    matching = [t for t, c in INSTANCE_TYPES.items() if c.vcpus >= min_vcpus and c.memory >= min_memory]
+    return sorted(matching, key=lambda t: (INSTANCE_TYPES[t].burstable, INSTANCE_TYPES[t].vcpus, INSTANCE_TYPES[t].memory))
+
+def instance_type_parameter(name, default, description):
+    """Adds the <name>InstanceType parameter. The instance_types section of the YAML can
+    set its default (name: m4.large) or ask for a minimum size (name: {min_vcpus: 4,
+    min_memory: 16}), which only allows the types that are large enough and defaults to
+    the smallest of them."""
+    requirement = INSTANCE_REQUIREMENTS.get(name) or {}
+    if not isinstance(requirement, dict):
+        requirement = {'instance_type': requirement}
+
+    allowed = select_instance_types(requirement.get('min_vcpus', 0), requirement.get('min_memory', 0))
+    if not allowed:
+        raise Exception("There is no instance type for {0} with {1}".format(name, requirement))
+    if requirement.get('instance_type'):
+        default = requirement['instance_type']
+    elif default in INSTANCE_TYPES and default not in allowed:
+        default = allowed[0]
+    if default not in allowed:
+        raise Exception("{0} is not an instance type {1} can use".format(default, name))
+
+    return template.add_parameter(
+        Parameter(
+            '{0}InstanceType'.format(name), Type='String', Default=default,
+            Description=description,
+            AllowedValues=[t for t in INSTANCE_TYPES if t in allowed],
+            ConstraintDescription='Instance size must be a valid instance type'
+        )
+    )
+
+def ebs_optimized(parameter):
+    """Returns the EbsOptimized of instances whose type is the instance type parameter:
+    true whenever the type supports it, and left out otherwise. Types that don't support
+    it keep the template they had before EbsOptimized was set at all, so that existing
+    launch configurations and instances aren't replaced."""
+    condition = sanitize_id(parameter.title, 'EbsOptimized')
+    if condition not in template.conditions:
+        template.add_condition(condition, Equals(FindInMap('InstanceTypes', Ref(parameter), 'EbsOptimized'), 'true'))
+    return If(condition, 'true', Ref('AWS::NoValue'))
+
+# What a managed NAT gateway handles before it has to be split up
+NAT_GATEWAY_MBPS = 10000
 
 Amis = IntEnum('Amis', 'NAT EBS INSTANCE')
 SubnetTypes = IntEnum('SubnetTypes', 'PUBLIC PLATFORM WORKER VPN MASTER DATABASE')
 
-# This is just hardcoded in right now, and really only fits us-east-1's mold
+# The availability zones of the regions we know of. Which zones an account can use
+# differs between accounts, so the YAML can list them explicitly.
+REGION_AVAILABILITY_ZONES = {
+    'us-east-1': ['a', 'b', 'c', 'd', 'e', 'f'],
+    'us-west-1': ['b', 'c'],
+    'us-west-2': ['a', 'b', 'c', 'd'],
+    'eu-west-1': ['a', 'b', 'c'],
+    'eu-central-1': ['a', 'b', 'c'],
+    'ap-northeast-1': ['a', 'c', 'd'],
+    'ap-southeast-1': ['a', 'b', 'c'],
+    'ap-southeast-2': ['a', 'b', 'c'],
+    'sa-east-1': ['a', 'b', 'c'],
+}
+
+# The number of availability zones a VPC spans unless the YAML says otherwise
+DEFAULT_AVAILABILITY_ZONE_COUNT = 3
+
 availability_zones = ['a', 'b', 'c']
 
+def select_availability_zones(region, setting=None):
+    """Picks the availability zones of a region. setting is the availability_zones
+    value of the network configuration: a list of zone letters, the number of zones
+    to take from REGION_AVAILABILITY_ZONES, or None for the default number of zones."""
+    if isinstance(setting, list):
+        if not setting or len(set(setting)) != len(setting):
+            raise Exception("availability_zones needs distinct zones, got {0}".format(setting))
+        return [str(zone) for zone in setting]
+
+    known = REGION_AVAILABILITY_ZONES.get(region, ['a', 'b', 'c'])
+    if setting is None:
+        return known[:DEFAULT_AVAILABILITY_ZONE_COUNT]
+    if setting > len(known):
+        raise Exception("{0} only has {1} availability zones ({2}), not {3}".format(
+            region, len(known), ', '.join(known), setting))
+    return known[:setting]
+
 def get_availability_zones():
     return availability_zones
 
 def get_asg_azs():
     return [Join('', [Ref('AWS::Region'), az]) for az in availability_zones]
 
+def asg_capacity(name, min_size, max_size):
+    """Returns the size properties of the <name>ASG auto scaling group. A group with
+    scaling policies in SCALING gets no DesiredCapacity, so stack updates leave the
+    number of instances it scaled to alone."""
+    spec = SCALING.get(name)
+    if not spec:
+        return {'DesiredCapacity': str(min_size), 'MinSize': str(min_size), 'MaxSize': str(max_size)}
+    min_size, max_size = spec.get('min_size', min_size), spec.get('max_size', max_size)
+    if min_size > max_size:
+        raise Exception("{0} can't scale between {1} and {2} instances".format(name, min_size, max_size))
+    capacity = {'MinSize': str(min_size), 'MaxSize': str(max_size)}
+    if 'cooldown' in spec:
+        capacity['Cooldown'] = str(spec['cooldown'])
+    return capacity
+
+def add_scaling_policies(asg):
+    """Adds the scaling policies and alarms SCALING has for an auto scaling group"""
+    name = asg.title[:-len('ASG')] if asg.title.endswith('ASG') else asg.title
+    spec = SCALING.get(name)
+    if not spec:
+        return []
+    return [template.add_resource(r) for r in scaling.policies(name, asg, spec)]
+
+DESCRIPTION = 'This is a cloudformation script that creates our specific VPCs. Each VPC spans {0} availability zones.'
+
 # Initialize the Cloudformation template
 template = Template()
 template.add_version('2010-09-09')
-template.add_description('This is a cloudformation script that creates our specific VPCs. Each VPC spans 3 availability zones.')
+template.add_description(DESCRIPTION.format(len(availability_zones)))
 
 # These are all Ubuntu 14.04 AMIs (see: http://cloud-images.ubuntu.com/locator/ec2/)
 template.add_mapping('RegionMap',
@@ -101,15 +392,115 @@ template.add_mapping('RegionMap',
         }
 )
 
+template.add_mapping('InstanceTypes', dict(
+    (name, {'EbsOptimized': 'false' if capabilities.ebs_optimized == 'no' else 'true'})
+    for name, capabilities in INSTANCE_TYPES.items()
+))
+
 keyname = None
 
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib', 'templates')
+
+# The maximum number of rendered templates that are memoized per process
+TEMPLATE_CACHE_SIZE = 256
+
+# Process-wide jinja2 environment, built lazily by _template_environment()
+_j2env = None
+_bytecode_cache_dir = None
+
+# Memoized render output (and parsed JSON) keyed by template name and vardict
+_rendered_templates = OrderedDict()
+_parsed_templates = OrderedDict()
+
+template_cache_stats = {'hits': 0, 'misses': 0}
+
+# When this is a set, the name of every template that gets loaded is added to it
+template_reads = None
+
+
+def configure_template_cache(bytecode_dir=None, size=None):
+    """Configures the template engine. If bytecode_dir is given, compiled templates
+    are persisted there so subsequent runs skip parsing and compiling entirely.
+    This resets the environment and the render cache."""
+    global _j2env
+    global _bytecode_cache_dir
+    global TEMPLATE_CACHE_SIZE
+
+    _bytecode_cache_dir = bytecode_dir
+    if size is not None:
+        TEMPLATE_CACHE_SIZE = size
+    _j2env = None
+    _rendered_templates.clear()
+    _parsed_templates.clear()
+
+
+def _template_environment():
+    global _j2env
+    if _j2env is None:
+        # jinja2 is only imported once a template is actually needed
+        import jinja2
+
+        bytecode_cache = None
+        if _bytecode_cache_dir:
+            if not os.path.isdir(_bytecode_cache_dir):
+                os.makedirs(_bytecode_cache_dir)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(_bytecode_cache_dir)
+
+        _j2env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(TEMPLATE_DIR),
+            trim_blocks=True,
+            bytecode_cache=bytecode_cache
+        )
+    return _j2env
+
+
+def _freeze(value):
+    """Turns a vardict (or anything in it) into something hashable"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _memoize(cache, key, value):
+    cache[key] = value
+    while len(cache) > TEMPLATE_CACHE_SIZE:
+        cache.popitem(last=False)
+    return value
+
+
 def load_template(filename, vardict):
-    """Loads a template from the filesystem and renders it with variables replaced"""
-    j2env = jinja2.Environment(loader=jinja2.FileSystemLoader('{0}/lib/templates'.format(
-        os.path.dirname(__file__),
-        trim_blocks=True
-    )))
-    return j2env.get_template(filename).render(vardict)
+    """Loads a template from the filesystem and renders it with variables replaced.
+
+    Rendered output is memoized per (filename, vardict), so components that render
+    the same template with the same variables only pay for it once."""
+    if template_reads is not None:
+        template_reads.add(filename)
+
+    key = (filename, _freeze(vardict))
+    if key in _rendered_templates:
+        template_cache_stats['hits'] += 1
+        return _rendered_templates[key]
+
+    template_cache_stats['misses'] += 1
+    rendered = _template_environment().get_template(filename).render(vardict)
+    return _memoize(_rendered_templates, key, rendered)
+
+
+def load_json_template(filename, vardict):
+    """Loads a JSON template (like an IAM policy) and returns it parsed.
+
+    Callers get their own copy of the document so they are free to modify it."""
+    if template_reads is not None:
+        template_reads.add(filename)
+
+    key = (filename, _freeze(vardict))
+    if key in _parsed_templates:
+        template_cache_stats['hits'] += 1
+    else:
+        _memoize(_parsed_templates, key, json.loads(load_template(filename, vardict)))
+    return copy.deepcopy(_parsed_templates[key])
 
 
 # This is a list of VPCs that will be used by cloudformation
@@ -122,6 +513,27 @@ vpc_subnets = defaultdict(lambda: defaultdict(list))
 # The SNS topic that will be used to alert of instance termination
 alert_topic = None
 
+# The cidr.AddressSpace of the VPC, once network has laid out the subnets
+address_space = None
+
+# The subnet allocations saved in SUBNET_ALLOCATIONS when the run started (name -> cidr)
+saved_subnet_allocations = dict()
+
+# Maps the title of every resource to the emitter (network or a component) that created it
+resource_owners = dict()
+
+# The route tables of the private subnets, one per availability zone
+private_route_tables = list()
+
+# The names of the S3 buckets instances read from or write to, see add_s3_bucket()
+s3_buckets = list()
+
+# The deploy roles (like mesos_slave) instances are launched as, see image_id()
+deploy_roles = list()
+
+# The images baked for the deploy roles, region -> deploy role -> AMI
+baked_amis = dict()
+
 
 def add_vpc_subnets(vpc, identifier, subnets):
     """Associate subnets with a VPC based on the subnet type"""
@@ -133,6 +545,84 @@ def get_vpc_subnets(vpc, identifier):
     return tuple(vpc_subnets[vpc][identifier])
 
 
+def load_image_catalog(filename):
+    """Returns the baked images recorded in filename (region -> deploy role -> AMI)"""
+    if not filename or not os.path.exists(filename):
+        return {}
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def baked_image_key(deploy):
+    """The RegionMap key of the baked image of a deploy role"""
+    return sanitize_id('baked', deploy)
+
+
+def image_id(deploy, stock):
+    """Returns the AMI instances of a deploy role boot from: the image baked for it if
+    BAKED_IMAGES is on and there is one for the region, else the stock Amis image"""
+    if deploy not in deploy_roles:
+        deploy_roles.append(deploy)
+    if BAKED_IMAGES and deploy in baked_amis.get(REGION, {}):
+        return FindInMap('RegionMap', Ref('AWS::Region'), baked_image_key(deploy))
+    return FindInMap('RegionMap', Ref('AWS::Region'), int(stock))
+
+
+def init_script(deploy):
+    """Renders the user data of a deploy role. Instances booting from a baked image
+    skip the package installs the image already went through."""
+    vardict = {"env": CLOUDENV, "cloud": CLOUDNAME, "deploy": deploy}
+    if BAKED_IMAGES and deploy in baked_amis.get(REGION, {}):
+        vardict["phase"] = "boot"
+    return load_template("default-init.bash.j2", vardict)
+
+
+def user_data(deploy):
+    """Returns the UserData of a deploy role in USER_DATA_FORMAT. A gzip archive holds
+    the role's settings and the shared script, which is rendered once for all roles."""
+    if USER_DATA_FORMAT == 'script':
+        return Base64(init_script(deploy))
+
+    vardict = {"settings": userdata.SETTINGS_FILE}
+    if BAKED_IMAGES and deploy in baked_amis.get(REGION, {}):
+        vardict["phase"] = "boot"
+    return userdata.archive([
+        ('cloud-config', userdata.settings({'ENV': CLOUDENV, 'CLOUDNAME': CLOUDNAME, 'DEPLOY': deploy})),
+        ('x-shellscript', load_template("default-init.bash.j2", vardict)),
+    ])
+
+
+def check_queue_settings(name, settings):
+    """Raises if the queue settings (of a queue or queue_defaults) aren't valid. This
+    runs when the configuration is read, since a failing component leaves its queues
+    out of the template, and deploying that would delete them."""
+    unknown = set(settings) - set(QUEUE_SETTINGS) - set(['name'])
+    if unknown:
+        raise Exception("{0} has unknown queue settings: {1}".format(name, ', '.join(sorted(unknown))))
+    for key, value in settings.items():
+        if key not in ('name', 'alarm_topic') and not isinstance(value, int):
+            raise Exception("{0} of {1} is a number of seconds, bytes or messages, not {2}".format(key, name, value))
+    if not 0 <= settings.get('wait', 0) <= 20:
+        raise Exception("{0} can long-poll for 0 to 20 seconds, not {1}".format(name, settings['wait']))
+    if settings.get('max_receives') and not 1 <= settings['max_receives'] <= 1000:
+        raise Exception("{0} can move messages to its dead-letter queue after 1 to 1000 receives, not {1}".format(
+            name, settings['max_receives']))
+
+
+def queue_settings(spec):
+    """Returns every setting of a queue from the YAML, falling back to QUEUE_DEFAULTS
+    and QUEUE_SETTINGS"""
+    settings = dict(QUEUE_SETTINGS, **QUEUE_DEFAULTS)
+    settings.update(spec)
+    return settings
+
+
+def add_s3_bucket(name):
+    """Declares a bucket (a name or a Join) that instances use, so the S3 VPC endpoint
+    lets requests for it through"""
+    s3_buckets.append(name)
+
+
 class CloudState(object):
     _state = {}
     def __new__(cls, *args, **kwargs):
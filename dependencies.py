@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This module works out the order CloudFormation has to create the resources of a
+# template in. CloudFormation creates every resource whose dependencies are done in
+# parallel, so each DependsOn that isn't needed serializes the stack for nothing.
+#
+# A DependsOn is redundant when the dependency is already implied: the resource
+# refers to its target through Ref or Fn::GetAtt, or the target is reached through
+# another of its dependencies. prune() drops those and critical_path() reports the
+# longest chain of resources that still has to be created one after the other.
+#
+# References inside Fn::If and paths through resources with a Condition are not
+# counted as implying anything, since those may not exist when the stack is created.
+
+
+def _depends_on(resource):
+    depends = resource.get('DependsOn', [])
+    return [depends] if not isinstance(depends, list) else list(depends)
+
+
+def _references(value, found):
+    """Adds the names value refers to through Ref and Fn::GetAtt to found"""
+    if isinstance(value, dict):
+        if 'Ref' in value and len(value) == 1:
+            found.add(value['Ref'])
+        elif 'Fn::GetAtt' in value:
+            found.add(value['Fn::GetAtt'][0])
+        elif 'Fn::If' in value:
+            # only the condition name is certain to be evaluated
+            return
+        for v in value.values():
+            _references(v, found)
+    elif isinstance(value, list):
+        for v in value:
+            _references(v, found)
+
+
+def graph(tdict):
+    """Returns title -> (referenced resources, DependsOn entries) for every resource"""
+    resources = tdict.get('Resources', {})
+    edges = {}
+    for title, resource in resources.items():
+        found = set()
+        _references(dict((k, v) for k, v in resource.items() if k != 'DependsOn'), found)
+        edges[title] = (set(r for r in found if r in resources and r != title), _depends_on(resource))
+    return edges
+
+
+def _dependencies(edges, title):
+    refs, depends = edges[title]
+    return refs | set(d for d in depends if d in edges)
+
+
+def _reachable(edges, conditional):
+    """Returns title -> every resource it transitively waits for through unconditional resources"""
+    reach = {}
+
+    def visit(title, path):
+        if title in reach:
+            return reach[title]
+        if title in path:
+            raise Exception("Circular dependency between {0}".format(', '.join(sorted(path))))
+        path.add(title)
+        result = set()
+        for dependency in _dependencies(edges, title):
+            result.add(dependency)
+            if dependency not in conditional:
+                result |= visit(dependency, path)
+        path.discard(title)
+        reach[title] = result
+        return result
+
+    for title in sorted(edges):
+        visit(title, set())
+    return reach
+
+
+def redundant(tdict):
+    """Returns title -> the DependsOn entries of that resource that are already implied"""
+    edges = graph(tdict)
+    conditional = set(t for t, r in tdict.get('Resources', {}).items() if 'Condition' in r)
+    reach = _reachable(edges, conditional)
+
+    found = {}
+    for title in sorted(edges):
+        refs, depends = edges[title]
+        for target in depends:
+            others = (refs | set(depends)) - set([target])
+            implied = target in refs or any(
+                target in reach[o] for o in others if o in edges and o not in conditional)
+            if implied:
+                found.setdefault(title, []).append(target)
+    return found
+
+
+def prune(tdict):
+    """Drops the redundant DependsOn entries from tdict (in place). Returns how many were dropped."""
+    resources = tdict.get('Resources', {})
+    dropped = 0
+    for title, targets in redundant(tdict).items():
+        remaining = [d for d in _depends_on(resources[title]) if d not in targets]
+        dropped += len(targets)
+        if not remaining:
+            del resources[title]['DependsOn']
+        elif len(remaining) == 1:
+            resources[title]['DependsOn'] = remaining[0]
+        else:
+            resources[title]['DependsOn'] = remaining
+    return dropped
+
+
+def critical_path(tdict, weight=None):
+    """Returns (cost, titles) of the most expensive chain of resources that have to be
+    created one after the other. weight(title, resource) is the cost of a resource
+    and defaults to 1, which makes the cost the number of resources on the path."""
+    resources = tdict.get('Resources', {})
+    edges = graph(tdict)
+    weight = weight or (lambda title, resource: 1)
+    best = {}
+
+    def visit(title):
+        if title not in best:
+            cost, path = 0, []
+            for dependency in sorted(_dependencies(edges, title)):
+                candidate = visit(dependency)
+                if candidate[0] > cost:
+                    cost, path = candidate
+            best[title] = (cost + weight(title, resources[title]), path + [title])
+        return best[title]
+
+    paths = [visit(title) for title in sorted(resources)]
+    return max(paths, key=lambda p: p[0]) if paths else (0, [])
+
+
+def levels(tdict):
+    """Returns the number of resources CloudFormation can work on at once in every
+    wave of creation, assuming all resources take the same time"""
+    edges = graph(tdict)
+    depth = {}
+
+    def visit(title):
+        if title not in depth:
+            depth[title] = 1 + max([visit(d) for d in _dependencies(edges, title)] or [0])
+        return depth[title]
+
+    counts = {}
+    for title in edges:
+        counts[visit(title)] = counts.get(visit(title), 0) + 1
+    return [counts[level] for level in sorted(counts)]
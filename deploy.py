@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Creates or updates a stack through a change set and follows its events until the
+# stack settles, then reports how long every resource took.
+#
+#     python deploy.py --stack-name infratest --template-url https://.../infratest.template \
+#         --parameter KeyName=infra
+#
+# Events are polled with a backoff that starts short and grows while nothing
+# happens, and drops back as soon as new events show up. --endpoint-url points the
+# deployer at a local stand-in for CloudFormation (e.g. moto_server) instead of AWS.
+
+from __future__ import print_function
+
+import argparse
+import sys
+import time
+from datetime import datetime
+
+# The longest a template passed as TemplateBody can be, larger ones need a URL
+MAX_TEMPLATE_BODY = 51200
+
+SUCCEEDED = ('CREATE_COMPLETE', 'UPDATE_COMPLETE', 'DELETE_COMPLETE')
+FAILED = ('CREATE_FAILED', 'ROLLBACK_COMPLETE', 'ROLLBACK_FAILED', 'DELETE_FAILED',
+          'UPDATE_ROLLBACK_COMPLETE', 'UPDATE_ROLLBACK_FAILED')
+
+# Stacks in this state were never created (only a change set was), or have to be
+# deleted before they can be created again
+NOT_CREATED = ('REVIEW_IN_PROGRESS',)
+DEAD = ('ROLLBACK_COMPLETE', 'ROLLBACK_FAILED', 'DELETE_COMPLETE')
+
+
+class Backoff(object):
+    """Poll intervals that grow by factor while nothing changes, up to maximum seconds"""
+    def __init__(self, minimum=2.0, maximum=30.0, factor=1.5, sleep=time.sleep):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.interval = minimum
+        self._sleep = sleep
+
+    def wait(self, progressed):
+        """Sleeps before the next poll, progressed says if the last poll found anything new"""
+        if progressed:
+            self.interval = self.minimum
+        else:
+            self.interval = min(self.interval * self.factor, self.maximum)
+        self._sleep(self.interval)
+
+
+def client(region, endpoint_url=None):
+    """Returns a CloudFormation client. boto3 is only needed for deploying, so it is
+    imported here rather than for every run of the generator."""
+    import boto3
+    return boto3.client('cloudformation', region_name=region, endpoint_url=endpoint_url)
+
+
+def stack_status(cf, stack_name):
+    """Returns the status of a stack or None if it doesn't exist"""
+    from botocore.exceptions import ClientError
+    try:
+        stacks = cf.describe_stacks(StackName=stack_name)['Stacks']
+    except ClientError, e:
+        if 'does not exist' in str(e):
+            return None
+        raise
+    return stacks[0]['StackStatus'] if stacks else None
+
+
+def _template_args(template_body=None, template_url=None):
+    if template_url:
+        return {'TemplateURL': template_url}
+    if len(template_body) > MAX_TEMPLATE_BODY:
+        raise Exception("The template is {0} bytes, templates over {1} bytes have to be uploaded and passed by URL".format(
+            len(template_body), MAX_TEMPLATE_BODY))
+    return {'TemplateBody': template_body}
+
+
+def _wait_for_change_set(cf, stack_name, change_set_name, backoff):
+    while True:
+        change_set = cf.describe_change_set(StackName=stack_name, ChangeSetName=change_set_name)
+        if change_set['Status'] not in ('CREATE_PENDING', 'CREATE_IN_PROGRESS'):
+            return change_set
+        backoff.wait(False)
+
+
+def create_change_set(cf, stack_name, parameters, template_body=None, template_url=None,
+                      capabilities=('CAPABILITY_IAM',), backoff=None):
+    """Creates a change set for the stack and waits for it. Returns the change set, or
+    None if the template doesn't change anything."""
+    status = stack_status(cf, stack_name)
+    if status in DEAD:
+        raise Exception("Stack {0} is in state {1} and has to be deleted first".format(stack_name, status))
+    change_set_type = 'CREATE' if status is None or status in NOT_CREATED else 'UPDATE'
+
+    change_set_name = '{0}-{1}'.format(stack_name, datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+    args = _template_args(template_body, template_url)
+    cf.create_change_set(
+        StackName=stack_name,
+        ChangeSetName=change_set_name,
+        ChangeSetType=change_set_type,
+        Parameters=[{'ParameterKey': k, 'ParameterValue': v} for k, v in sorted(parameters.items())],
+        Capabilities=list(capabilities),
+        **args
+    )
+    change_set = _wait_for_change_set(cf, stack_name, change_set_name, backoff or Backoff(minimum=1.0, maximum=5.0))
+    if change_set['Status'] == 'FAILED':
+        reason = change_set.get('StatusReason', '')
+        if "didn't contain changes" in reason or 'No updates' in reason:
+            cf.delete_change_set(StackName=stack_name, ChangeSetName=change_set_name)
+            return None
+        raise Exception("Change set {0} failed: {1}".format(change_set_name, reason))
+    return change_set
+
+
+def print_change_set(change_set, stream):
+    print("Change set {0} ({1} changes):".format(change_set['ChangeSetName'], len(change_set['Changes'])), file=stream)
+    for change in change_set['Changes']:
+        rc = change['ResourceChange']
+        replacement = ' (replacement: {0})'.format(rc['Replacement']) if rc.get('Replacement') else ''
+        print("  {0:<7} {1} [{2}]{3}".format(rc['Action'], rc['LogicalResourceId'], rc['ResourceType'], replacement),
+              file=stream)
+
+
+def _new_events(cf, stack_name, seen):
+    """Returns the events that aren't in seen yet, oldest first. describe_stack_events
+    returns the newest events first, so paging stops at the first event already seen."""
+    events, token = [], None
+    while True:
+        kwargs = {'StackName': stack_name}
+        if token:
+            kwargs['NextToken'] = token
+        page = cf.describe_stack_events(**kwargs)
+        for event in page['StackEvents']:
+            if event['EventId'] in seen:
+                return list(reversed(events))
+            events.append(event)
+        token = page.get('NextToken')
+        if not token:
+            return list(reversed(events))
+
+
+def event_ids(cf, stack_name):
+    """Returns the ids of all events the stack has had so far"""
+    return set(event['EventId'] for event in _new_events(cf, stack_name, set()))
+
+
+def tail_events(cf, stack_name, seen, stream, backoff=None):
+    """Prints the events of the stack that aren't in seen until it settles. Returns the
+    final status of the stack and title -> seconds for every resource that was worked on."""
+    backoff = backoff or Backoff()
+    seen, started, durations = set(seen), {}, {}
+
+    while True:
+        events = _new_events(cf, stack_name, seen)
+        for event in events:
+            seen.add(event['EventId'])
+            title, status = event['LogicalResourceId'], event['ResourceStatus']
+            print("{0} {1:<40} {2}{3}".format(
+                event['Timestamp'].strftime('%H:%M:%S'), title, status,
+                ' ({0})'.format(event['ResourceStatusReason']) if event.get('ResourceStatusReason') else ''), file=stream)
+            if status.endswith('_IN_PROGRESS'):
+                started.setdefault(title, event['Timestamp'])
+            elif title in started:
+                durations[title] = (event['Timestamp'] - started[title]).total_seconds()
+
+            if title == stack_name and event['ResourceType'] == 'AWS::CloudFormation::Stack' and (
+                    status in SUCCEEDED or status in FAILED):
+                return status, durations
+        backoff.wait(bool(events))
+
+
+def deploy(cf, stack_name, parameters, template_body=None, template_url=None, execute=True, stream=sys.stderr):
+    """Creates or updates the stack through a change set and waits for it to settle.
+    Returns the final status (None if nothing changed) and title -> seconds."""
+    change_set = create_change_set(cf, stack_name, parameters, template_body, template_url)
+    if change_set is None:
+        print("Stack {0} is up to date".format(stack_name), file=stream)
+        return None, {}
+    print_change_set(change_set, stream)
+    if not execute:
+        return change_set['Status'], {}
+
+    # the events of earlier deploys are skipped
+    seen = event_ids(cf, stack_name)
+    cf.execute_change_set(StackName=stack_name, ChangeSetName=change_set['ChangeSetName'])
+    return tail_events(cf, stack_name, seen, stream)
+
+
+def print_durations(durations, stream):
+    """Prints how long every resource took, slowest first"""
+    print("\n{0:<40} {1:>8}".format('resource', 'seconds'), file=stream)
+    for title, seconds in sorted(durations.items(), key=lambda d: d[1], reverse=True):
+        print("{0:<40} {1:>8.0f}".format(title, seconds), file=stream)
+
+
+def parse_parameters(values):
+    parameters = {}
+    for value in values or []:
+        if '=' not in value:
+            raise Exception("Parameters are passed as KEY=VALUE, not {0}".format(value))
+        key, value = value.split('=', 1)
+        parameters[key] = value
+    return parameters
+
+
+def _create_parser():
+    parser = argparse.ArgumentParser(prog='deploy.py')
+    parser.add_argument('--stack-name', type=str, required=True, help='The stack to create or update')
+    parser.add_argument('--template-file', type=str, help='The template to deploy, if it is small enough to pass directly')
+    parser.add_argument('--template-url', type=str, help='The S3 URL of the uploaded template to deploy')
+    parser.add_argument('--parameter', action='append', metavar='KEY=VALUE', help='A stack parameter, can be repeated')
+    parser.add_argument('--region', type=str, default='us-east-1', help='The region to deploy in (default: us-east-1)')
+    parser.add_argument('--endpoint-url', type=str, help='Talk to this CloudFormation endpoint, e.g. a local moto_server')
+    parser.add_argument('--no-execute', action='store_true', help='Only create and print the change set')
+    return parser
+
+
+if __name__ == '__main__':
+    args = _create_parser().parse_args()
+    if bool(args.template_file) == bool(args.template_url):
+        raise Exception("Pass exactly one of --template-file and --template-url")
+
+    body = None
+    if args.template_file:
+        with open(args.template_file, 'r') as f:
+            body = f.read()
+
+    start = time.time()
+    status, durations = deploy(client(args.region, args.endpoint_url), args.stack_name, parse_parameters(args.parameter),
+                               template_body=body, template_url=args.template_url, execute=not args.no_execute)
+    if durations:
+        print_durations(durations, sys.stderr)
+    print("\n{0} after {1:.0f} seconds".format(status or 'No changes', time.time() - start), file=sys.stderr)
+    sys.exit(1 if status in FAILED else 0)
@@ -5,11 +5,14 @@ trap "trap - SIGTERM && kill -- -$$" SIGINT SIGTERM EXIT
 
 set -ue
 
+# the region to deploy to, e.g. REGION=us-west-2 ./deploy_singularity.sh
+region=${REGION:-us-east-1}
+
 # find the VPN server
 find_vpn_server() {
     # use the aws cli to find our active VPN server
     local ret=0
-    local json=$(aws --region us-east-1 ec2 describe-instances --filters "Name=tag:Deploy,Values=vpn" "Name=instance-state-name,Values=running") || ret=$?
+    local json=$(aws --region ${region} ec2 describe-instances --filters "Name=tag:Deploy,Values=vpn" "Name=instance-state-name,Values=running") || ret=$?
 
     local public_dns=$(echo $json | jq '.Reservations[0].Instances[0].PublicDnsName' --raw-output)
     if [[ $public_dns == "null" ]]; then
@@ -51,7 +54,7 @@ sleep 20
 mesos_master_ip="null"
 while [[ 1 ]]; do
     ret=0
-    json=$(aws --region us-east-1 ec2 describe-instances --filters "Name=tag:Deploy,Values=mesos_master" "Name=instance-state-name,Values=running") || ret=$?  mesos_master_ip=$(echo $json | jq '.Reservations[0].Instances[0].PrivateIpAddress' --raw-output)
+    json=$(aws --region ${region} ec2 describe-instances --filters "Name=tag:Deploy,Values=mesos_master" "Name=instance-state-name,Values=running") || ret=$?  mesos_master_ip=$(echo $json | jq '.Reservations[0].Instances[0].PrivateIpAddress' --raw-output)
     mesos_master_ip=$(echo $json | jq '.Reservations[0].Instances[0].PrivateIpAddress' --raw-output)
     if [[ $mesos_master_ip == "null" ]]; then
         echo "No Mesos master instances found yet, waiting and retrying"
@@ -80,7 +83,7 @@ cp singularity_config.yml singularityservice
 tar cvzf $singularity_bundle singularityservice
 # Upload it to a bucket
 marathon_deploy_bucket="leafme-infra-marathon-deploy-bucket"
-aws s3 mb s3://${marathon_deploy_bucket} --region us-east-1
+aws s3 mb s3://${marathon_deploy_bucket} --region ${region}
 # Upload the file
 
 echo "Uploading $singularity_bundle"
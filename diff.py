@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Structurally compares two templates and works out what CloudFormation will do to
+# every resource when the stack is updated from one to the other: add it, remove it,
+# update it in place (with or without interrupting it) or replace it.
+#
+# What a property change does comes from REPLACEMENT and INTERRUPTION, which follow
+# the "Update requires" notes of the CloudFormation resource reference. A resource
+# that is replaced gets a new physical id, so everything referring to it changes too.
+#
+#     python diff.py deployed.template infra.template
+#
+# Fn::If whose condition can be decided from the template alone (parameter defaults,
+# mappings, Fn::Equals and friends) is compared as the branch it picks, and a property
+# that comes out as AWS::NoValue as a property that isn't there. That assumes the
+# stack runs with the parameter defaults, like the checks in checks.py do.
+#
+# A parent stack is compared together with its nested stacks (see nesting.py) when
+# their templates sit next to it: load() puts the resources of the nested templates
+# back into one template, with the values passed between the stacks filled in. A
+# resource that moves to another stack is created in the new one and deleted from
+# the old one, which counts as a replacement.
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+
+ADDED = 'Add'
+REMOVED = 'Remove'
+REPLACEMENT = 'Replacement'
+INTERRUPTION = 'Some interruption'
+NO_INTERRUPTION = 'No interruption'
+UNKNOWN = 'Unknown'
+
+# ALL means any change to the resource replaces it
+ALL = '*'
+
+# Properties that can't be changed without replacing the resource
+REPLACEMENT_RULES = {
+    'AWS::AutoScaling::AutoScalingGroup': set(['AutoScalingGroupName', 'InstanceId']),
+    'AWS::AutoScaling::LaunchConfiguration': ALL,
+    'AWS::AutoScaling::ScalingPolicy': set(['AutoScalingGroupName']),
+    'AWS::CloudFormation::Stack': set(),
+    'AWS::CloudWatch::Alarm': set(['AlarmName']),
+    'AWS::EC2::EIP': set(['Domain']),
+    'AWS::EC2::Instance': set(['AvailabilityZone', 'BlockDeviceMappings', 'ImageId', 'KeyName', 'NetworkInterfaces',
+                               'PlacementGroupName', 'PrivateIpAddress', 'SecurityGroups', 'SubnetId', 'Tenancy']),
+    'AWS::EC2::InternetGateway': set(),
+    'AWS::EC2::NatGateway': set(['AllocationId', 'SubnetId']),
+    'AWS::EC2::Route': set(['DestinationCidrBlock', 'RouteTableId']),
+    'AWS::EC2::RouteTable': set(['VpcId']),
+    'AWS::EC2::SecurityGroup': set(['GroupDescription', 'GroupName', 'VpcId']),
+    'AWS::EC2::SecurityGroupEgress': ALL,
+    'AWS::EC2::SecurityGroupIngress': ALL,
+    'AWS::EC2::Subnet': set(['AvailabilityZone', 'CidrBlock', 'VpcId']),
+    'AWS::EC2::SubnetRouteTableAssociation': set(['SubnetId']),
+    'AWS::EC2::VPC': set(['CidrBlock', 'InstanceTenancy']),
+    'AWS::EC2::VPCEndpoint': set(['ServiceName', 'VpcId']),
+    'AWS::EC2::VPCGatewayAttachment': set(['VpcId']),
+    'AWS::IAM::InstanceProfile': set(['InstanceProfileName', 'Path']),
+    'AWS::IAM::ManagedPolicy': set(['Description', 'ManagedPolicyName', 'Path']),
+    'AWS::IAM::Role': set(['Path', 'RoleName']),
+    'AWS::RDS::DBInstance': set(['AvailabilityZone', 'CharacterSetName', 'DBClusterIdentifier', 'DBInstanceIdentifier',
+                                 'DBName', 'DBSnapshotIdentifier', 'DBSubnetGroupName', 'KmsKeyId', 'MasterUsername',
+                                 'SourceDBInstanceIdentifier', 'StorageEncrypted']),
+    'AWS::RDS::DBSubnetGroup': set(['DBSubnetGroupName']),
+    'AWS::Redshift::Cluster': set(['AvailabilityZone', 'ClusterIdentifier', 'ClusterSubnetGroupName', 'DBName',
+                                   'Encrypted', 'KmsKeyId', 'MasterUsername', 'OwnerAccount', 'Port',
+                                   'SnapshotClusterIdentifier', 'SnapshotIdentifier']),
+    'AWS::Redshift::ClusterParameterGroup': set(['Description', 'ParameterGroupFamily']),
+    'AWS::Redshift::ClusterSubnetGroup': set(),
+    'AWS::S3::Bucket': set(['BucketName']),
+    'AWS::SNS::Topic': set(['TopicName']),
+    'AWS::SQS::Queue': set(['FifoQueue', 'QueueName']),
+    'AWS::SQS::QueuePolicy': set(),
+}
+
+# Properties that are updated in place but interrupt the resource (a reboot or a
+# short outage), anything else in REPLACEMENT_RULES updates without interruption
+INTERRUPTION_RULES = {
+    'AWS::EC2::Instance': set(['EbsOptimized', 'InstanceType', 'UserData']),
+    'AWS::RDS::DBInstance': set(['AllocatedStorage', 'DBInstanceClass', 'DBParameterGroupName', 'EngineVersion',
+                                 'Iops', 'MultiAZ', 'StorageType']),
+    'AWS::Redshift::Cluster': set(['ClusterParameterGroupName', 'ClusterType', 'NodeType', 'NumberOfNodes']),
+}
+
+# Worst first
+SEVERITY = [REPLACEMENT, UNKNOWN, INTERRUPTION, NO_INTERRUPTION]
+
+# Keys of a resource that aren't properties
+ATTRIBUTES = ('Condition', 'CreationPolicy', 'DeletionPolicy', 'DependsOn', 'Metadata', 'UpdatePolicy')
+
+# What a resource that moves to another stack is listed with
+MOVED = 'Stack'
+
+
+def classify(resource_type, prop):
+    """Returns what changing prop of a resource of resource_type does"""
+    if resource_type not in REPLACEMENT_RULES:
+        return UNKNOWN
+    rules = REPLACEMENT_RULES[resource_type]
+    if rules == ALL or prop in rules:
+        return REPLACEMENT
+    if prop in INTERRUPTION_RULES.get(resource_type, ()):
+        return INTERRUPTION
+    return NO_INTERRUPTION
+
+
+def _worst(effects):
+    return min(effects, key=SEVERITY.index) if effects else NO_INTERRUPTION
+
+
+def _refers_to(value, names):
+    """Returns True if value refers to any of names through Ref or Fn::GetAtt"""
+    if isinstance(value, dict):
+        if 'Ref' in value and len(value) == 1 and value['Ref'] in names:
+            return True
+        if 'Fn::GetAtt' in value and value['Fn::GetAtt'][0] in names:
+            return True
+        return any(_refers_to(v, names) for v in value.values())
+    if isinstance(value, list):
+        return any(_refers_to(v, names) for v in value)
+    return False
+
+
+# The value of everything _evaluate() can't work out without a stack
+UNDECIDED = object()
+
+NO_VALUE = {'Ref': 'AWS::NoValue'}
+
+
+def _evaluate(value, tdict):
+    """Returns what value (a literal or an intrinsic function) evaluates to, or UNDECIDED"""
+    if not isinstance(value, (dict, list)):
+        return value
+    if not isinstance(value, dict) or len(value) != 1:
+        return UNDECIDED
+    function, args = value.items()[0]
+    if function == 'Ref':
+        return tdict.get('Parameters', {}).get(args, {}).get('Default', UNDECIDED)
+    if function == 'Condition':
+        return _evaluate(tdict.get('Conditions', {}).get(args, UNDECIDED), tdict)
+    if function == 'Fn::FindInMap':
+        keys = [_evaluate(a, tdict) for a in args]
+        if UNDECIDED in keys:
+            return UNDECIDED
+        mapping = tdict.get('Mappings', {}).get(keys[0], {})
+        return mapping.get(str(keys[1]), {}).get(str(keys[2]), UNDECIDED)
+
+    values = [_evaluate(a, tdict) for a in args] if isinstance(args, list) else [UNDECIDED]
+    if UNDECIDED in values:
+        return UNDECIDED
+    if function == 'Fn::Equals':
+        return str(values[0]) == str(values[1])
+    if function == 'Fn::Not':
+        return not values[0]
+    if function == 'Fn::And':
+        return all(values)
+    if function == 'Fn::Or':
+        return any(values)
+    return UNDECIDED
+
+
+def _resolve(value, tdict):
+    """Returns value with every Fn::If whose condition is decided replaced by its branch
+    and AWS::NoValue properties and list items left out"""
+    if isinstance(value, dict):
+        if len(value) == 1 and 'Fn::If' in value:
+            condition = _evaluate({'Condition': value['Fn::If'][0]}, tdict)
+            if condition is not UNDECIDED:
+                return _resolve(value['Fn::If'][1 if condition else 2], tdict)
+        resolved = dict((k, _resolve(v, tdict)) for k, v in value.items())
+        return dict((k, v) for k, v in resolved.items() if v != NO_VALUE)
+    if isinstance(value, list):
+        return [v for v in (_resolve(v, tdict) for v in value) if v != NO_VALUE]
+    return value
+
+
+def _resolved_resources(tdict):
+    return _resolve(tdict.get('Resources', {}), tdict)
+
+
+def _rewrite(value, rewrite):
+    """Returns a copy of value where every dict has been passed through rewrite first"""
+    if isinstance(value, dict):
+        value = rewrite(value)
+        if isinstance(value, dict):
+            return dict((k, _rewrite(v, rewrite)) for k, v in value.items())
+        return value
+    if isinstance(value, list):
+        return [_rewrite(v, rewrite) for v in value]
+    return value
+
+
+def nested_template(resource, directory):
+    """Returns the file name of a nested stack's template when it can be found in directory"""
+    url = resource.get('Properties', {}).get('TemplateURL')
+    if isinstance(url, dict) and 'Fn::Join' in url:
+        url = url['Fn::Join'][1][-1]
+    if isinstance(url, basestring):
+        filename = os.path.join(directory, url.rsplit('/', 1)[-1])
+        if os.path.exists(filename):
+            return filename
+    return None
+
+
+def flatten(parent, directory):
+    """Returns the parent template with the resources of the nested stack templates in
+    directory in place of the stacks, and title -> stack for the resources that came
+    from a nested stack"""
+    resources = parent.get('Resources', {})
+    stacks = {}
+    for title, resource in sorted(resources.items()):
+        filename = nested_template(resource, directory) if resource['Type'] == 'AWS::CloudFormation::Stack' else None
+        if filename:
+            with open(filename, 'r') as f:
+                stacks[title] = json.load(f)
+    if not stacks:
+        return parent, {}
+
+    def output(d):
+        """Replaces a nested stack output with the value the stack outputs"""
+        if 'Fn::GetAtt' in d and d['Fn::GetAtt'][0] in stacks and d['Fn::GetAtt'][1].startswith('Outputs.'):
+            return stacks[d['Fn::GetAtt'][0]]['Outputs'][d['Fn::GetAtt'][1][len('Outputs.'):]]['Value']
+        return d
+
+    # the parameters that only say where the nested templates are go away with the stacks
+    urls = set()
+    for title in stacks:
+        _rewrite(resources[title]['Properties'].get('TemplateURL'), lambda d: urls.add(d.get('Ref')) or d)
+    flat = {
+        'AWSTemplateFormatVersion': parent.get('AWSTemplateFormatVersion'),
+        'Description': parent.get('Description'),
+        'Parameters': dict((k, v) for k, v in parent.get('Parameters', {}).items() if k not in urls),
+        'Conditions': dict(parent.get('Conditions', {})),
+        'Mappings': dict(parent.get('Mappings', {})),
+        'Resources': dict((t, r) for t, r in resources.items() if t not in stacks),
+        'Outputs': _rewrite(parent.get('Outputs', {}), output),
+    }
+
+    locations = {}
+    for title, child in sorted(stacks.items()):
+        passed = dict((k, _rewrite(v, output)) for k, v in resources[title]['Properties'].get('Parameters', {}).items())
+
+        def inline(d):
+            if 'Ref' in d and len(d) == 1 and d['Ref'] in passed:
+                return passed[d['Ref']]
+            return d
+
+        flat['Conditions'].update(_rewrite(child.get('Conditions', {}), inline))
+        flat['Mappings'].update(child.get('Mappings', {}))
+        for name, resource in child.get('Resources', {}).items():
+            flat['Resources'][name] = _rewrite(resource, inline)
+            locations[name] = title
+    return flat, locations
+
+
+def load(filename):
+    """Reads a template and the nested stack templates next to it, see flatten()"""
+    with open(filename, 'r') as f:
+        tdict = json.load(f)
+    return flatten(tdict, os.path.dirname(os.path.abspath(filename)))
+
+
+def _changed_properties(old, new):
+    old_props, new_props = old.get('Properties', {}), new.get('Properties', {})
+    return sorted(p for p in set(old_props) | set(new_props) if old_props.get(p) != new_props.get(p))
+
+
+def _changed_attributes(old, new):
+    return sorted(a for a in ATTRIBUTES if old.get(a) != new.get(a))
+
+
+def diff(old, new, old_locations=None, new_locations=None):
+    """Compares two templates. Returns a dict of title -> change, where a change has
+    the effect (ADDED, REMOVED or the worst effect of its properties), the changed
+    properties with their effect and the changed resource attributes. Changes that
+    only come from a resource they refer to being replaced list it in 'caused_by'.
+    The locations map titles to the nested stack a resource is in (see flatten()),
+    a resource that moves gets 'moved' with the old and new stack."""
+    old_resources, new_resources = _resolved_resources(old), _resolved_resources(new)
+    old_locations, new_locations = old_locations or {}, new_locations or {}
+    changes = {}
+
+    for title in sorted(set(new_resources) - set(old_resources)):
+        changes[title] = {'type': new_resources[title]['Type'], 'effect': ADDED}
+    for title in sorted(set(old_resources) - set(new_resources)):
+        changes[title] = {'type': old_resources[title]['Type'], 'effect': REMOVED}
+
+    for title in sorted(set(old_resources) & set(new_resources)):
+        old_resource, new_resource = old_resources[title], new_resources[title]
+        moved = (old_locations.get(title), new_locations.get(title))
+        if moved[0] != moved[1]:
+            changes[title] = {'type': new_resource['Type'], 'effect': REPLACEMENT, 'properties': {}, 'moved': moved}
+            continue
+        if old_resource == new_resource:
+            continue
+        if old_resource['Type'] != new_resource['Type']:
+            changes[title] = {'type': new_resource['Type'], 'effect': REPLACEMENT, 'properties': {'Type': REPLACEMENT}}
+            continue
+        properties = dict((p, classify(new_resource['Type'], p)) for p in _changed_properties(old_resource, new_resource))
+        changes[title] = {
+            'type': new_resource['Type'],
+            'effect': _worst(properties.values()),
+            'properties': properties,
+            'attributes': _changed_attributes(old_resource, new_resource),
+        }
+
+    # A replaced (or re-added) resource gets a new physical id, which changes every
+    # property that refers to it
+    while True:
+        replaced = set(t for t, c in changes.items() if c['effect'] in (REPLACEMENT, ADDED, REMOVED))
+        cascaded = False
+        for title in sorted(set(old_resources) & set(new_resources)):
+            resource = new_resources[title]
+            change = changes.get(title)
+            if change and change['effect'] == REPLACEMENT:
+                continue
+            for prop, value in sorted(resource.get('Properties', {}).items()):
+                if change and prop in change.get('properties', {}):
+                    continue
+                causes = sorted(r for r in replaced if r != title and _refers_to(value, set([r])))
+                if not causes:
+                    continue
+                if change is None:
+                    change = changes[title] = {'type': resource['Type'], 'properties': {}, 'attributes': []}
+                change['properties'][prop] = classify(resource['Type'], prop)
+                change.setdefault('caused_by', [])
+                change['caused_by'] = sorted(set(change['caused_by']) | set(causes))
+                change['effect'] = _worst(change['properties'].values())
+                cascaded = True
+        if not cascaded:
+            break
+
+    return changes
+
+
+def diff_sections(old, new):
+    """Returns section -> (added, removed, modified) names for the non resource sections"""
+    result = {}
+    for section in ('Parameters', 'Conditions', 'Mappings', 'Outputs'):
+        o, n = old.get(section, {}), new.get(section, {})
+        added = sorted(set(n) - set(o))
+        removed = sorted(set(o) - set(n))
+        modified = sorted(k for k in set(o) & set(n) if o[k] != n[k])
+        if added or removed or modified:
+            result[section] = (added, removed, modified)
+    return result
+
+
+def print_diff(old, new, stream, old_locations=None, new_locations=None):
+    """Prints what updating a stack from the old to the new template does"""
+    changes = diff(old, new, old_locations, new_locations)
+    sections = diff_sections(old, new)
+    if not changes and not sections:
+        print("No changes", file=stream)
+        return changes
+
+    order = [ADDED, REMOVED] + SEVERITY
+    for effect in order:
+        titles = sorted(t for t, c in changes.items() if c['effect'] == effect)
+        if not titles:
+            continue
+        print("\n{0} ({1}):".format(effect, len(titles)), file=stream)
+        for title in titles:
+            change = changes[title]
+            print("  {0} [{1}]".format(title, change['type']), file=stream)
+            if change.get('moved'):
+                print("      moves from {0} to {1}".format(*[s or 'the parent stack' for s in change['moved']]), file=stream)
+            for prop, prop_effect in sorted(change.get('properties', {}).items()):
+                print("      {0}: {1}".format(prop, prop_effect), file=stream)
+            for attribute in change.get('attributes', []):
+                print("      {0} (attribute)".format(attribute), file=stream)
+            if change.get('caused_by'):
+                print("      because {0} is replaced".format(', '.join(change['caused_by'])), file=stream)
+
+    for section, (added, removed, modified) in sorted(sections.items()):
+        print("\n{0}: {1} added, {2} removed, {3} modified".format(
+            section, len(added), len(removed), len(modified)), file=stream)
+        for name in added:
+            print("  + {0}".format(name), file=stream)
+        for name in removed:
+            print("  - {0}".format(name), file=stream)
+        for name in modified:
+            print("  ~ {0}".format(name), file=stream)
+
+    counts = dict((e, sum(1 for c in changes.values() if c['effect'] == e)) for e in order)
+    print("\n" + ', '.join("{0} {1}".format(counts[e], e.lower()) for e in order if counts[e]), file=stream)
+    return changes
+
+
+def _create_parser():
+    parser = argparse.ArgumentParser(prog='diff.py')
+    parser.add_argument('previous', help='The template the stack was last deployed with')
+    parser.add_argument('current', help='The template to update the stack to')
+    return parser
+
+
+if __name__ == '__main__':
+    args = _create_parser().parse_args()
+    previous, previous_locations = load(args.previous)
+    current, current_locations = load(args.current)
+    changes = print_diff(previous, current, sys.stdout, previous_locations, current_locations)
+    sys.exit(1 if any(c['effect'] in (REPLACEMENT, REMOVED) for c in changes.values()) else 0)
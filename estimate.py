@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Estimates how long CloudFormation takes to create a stack from a generated template,
+# without talking to AWS. The resources are replayed in dependency order (see
+# dependencies.py) and every resource takes as long as the latency of its type.
+# Nested stacks are estimated from their template when it sits next to the parent.
+#
+#     python estimate.py infra.template
+#     python estimate.py a.template b.template --latencies latencies.yml
+#
+# A latencies file is a YAML mapping of resource type (or resource title, which wins)
+# to seconds, merged over LATENCIES.
+
+from __future__ import print_function
+
+import argparse
+import heapq
+import json
+import os
+import sys
+
+import yaml
+
+import dependencies
+import diff
+
+# Rough creation times in seconds, as seen in our stack events
+LATENCIES = {
+    'AWS::AutoScaling::AutoScalingGroup': 120,
+    'AWS::AutoScaling::LaunchConfiguration': 2,
+    'AWS::AutoScaling::ScalingPolicy': 2,
+    'AWS::CloudFormation::Stack': 30,
+    'AWS::CloudWatch::Alarm': 2,
+    'AWS::EC2::EIP': 20,
+    'AWS::EC2::Instance': 90,
+    'AWS::EC2::InternetGateway': 15,
+    'AWS::EC2::NatGateway': 100,
+    'AWS::EC2::Route': 20,
+    'AWS::EC2::RouteTable': 5,
+    'AWS::EC2::SecurityGroup': 5,
+    'AWS::EC2::SecurityGroupIngress': 2,
+    'AWS::EC2::Subnet': 5,
+    'AWS::EC2::SubnetRouteTableAssociation': 5,
+    'AWS::EC2::VPC': 15,
+    'AWS::EC2::VPCEndpoint': 10,
+    'AWS::EC2::VPCGatewayAttachment': 15,
+    'AWS::IAM::InstanceProfile': 120,
+    'AWS::IAM::ManagedPolicy': 10,
+    'AWS::IAM::Role': 15,
+    'AWS::RDS::DBInstance': 600,
+    'AWS::RDS::DBSubnetGroup': 2,
+    'AWS::Redshift::Cluster': 900,
+    'AWS::Redshift::ClusterParameterGroup': 2,
+    'AWS::Redshift::ClusterSubnetGroup': 2,
+    'AWS::S3::Bucket': 5,
+    'AWS::SNS::Topic': 5,
+    'AWS::SQS::Queue': 2,
+    'AWS::SQS::QueuePolicy': 5,
+}
+
+# For resource types not in the table
+DEFAULT_LATENCY = 10
+
+
+def latency_of(title, resource, latencies, directory=None, concurrency=None):
+    """Returns the seconds a resource takes. A nested stack takes as long as the
+    estimate of its template, created with the same concurrency as the parent."""
+    if title in latencies:
+        return latencies[title]
+    if resource['Type'] == 'AWS::CloudFormation::Stack' and directory is not None:
+        filename = diff.nested_template(resource, directory)
+        if filename:
+            nested = estimate_file(filename, latencies, concurrency)
+            return latencies.get(resource['Type'], DEFAULT_LATENCY) + nested['seconds']
+    return latencies.get(resource['Type'], DEFAULT_LATENCY)
+
+
+def simulate(tdict, latency, concurrency=None):
+    """Replays the creation of tdict. latency(title, resource) is the time a resource
+    takes and concurrency, if set, caps how many resources are created at once.
+    Returns title -> (start, finish)."""
+    resources = tdict.get('Resources', {})
+    edges = dependencies.graph(tdict)
+    waiting = dict((t, set(d for d in edges[t][0] | set(edges[t][1]) if d in resources)) for t in resources)
+    dependents = {}
+    for title, needs in waiting.items():
+        for need in needs:
+            dependents.setdefault(need, []).append(title)
+
+    ready = [(0, title) for title in sorted(resources) if not waiting[title]]
+    running, schedule, now = [], {}, 0
+    while ready or running:
+        while ready and (concurrency is None or len(running) < concurrency):
+            became_ready, title = heapq.heappop(ready)
+            start = max(now, became_ready)
+            finish = start + latency(title, resources[title])
+            schedule[title] = (start, finish)
+            heapq.heappush(running, (finish, title))
+        now, title = heapq.heappop(running)
+        for dependent in dependents.get(title, []):
+            waiting[dependent].discard(title)
+            if not waiting[dependent]:
+                heapq.heappush(ready, (now, dependent))
+
+    if len(schedule) != len(resources):
+        raise Exception("Circular dependency between {0}".format(', '.join(sorted(set(resources) - set(schedule)))))
+    return schedule
+
+
+def scheduled_chain(tdict, schedule):
+    """Returns the titles that were created one after the other in schedule, ending with
+    the one that finishes last. Each waited for the one before it: a dependency, or
+    with a concurrency cap the resource whose place it took, finishing as it started."""
+    resources = tdict.get('Resources', {})
+    edges = dependencies.graph(tdict)
+    title = max(sorted(schedule), key=lambda t: schedule[t][1])
+    chain = [title]
+    while schedule[title][0] > 0:
+        start = schedule[title][0]
+        needs = [d for d in edges[title][0] | set(edges[title][1]) if d in resources and schedule[d][1] == start]
+        freed = [t for t, (s, f) in schedule.items() if f == start and s < start]
+        previous = sorted(needs or freed)
+        if not previous:
+            break
+        title = previous[0]
+        chain.append(title)
+    return list(reversed(chain))
+
+
+def max_concurrency(schedule):
+    """Returns the most resources that are being created at the same time"""
+    events = sorted([(s, 1) for s, f in schedule.values()] + [(f, -1) for s, f in schedule.values()])
+    current = peak = 0
+    for _, change in events:
+        current += change
+        peak = max(peak, current)
+    return peak
+
+
+def estimate(tdict, latencies=None, concurrency=None, directory=None):
+    """Estimates the creation of tdict, returns a dict with the total seconds, the
+    critical chain of (title, type, seconds) and the maximum concurrency"""
+    table = dict(LATENCIES)
+    table.update(latencies or {})
+    cache = {}
+
+    def latency(title, resource):
+        if title not in cache:
+            cache[title] = latency_of(title, resource, table, directory, concurrency)
+        return cache[title]
+
+    schedule = simulate(tdict, latency, concurrency)
+    seconds, chain = dependencies.critical_path(tdict, weight=latency)
+    if concurrency is not None and schedule:
+        # with a cap, resources also wait for a free place, so the chain that takes
+        # longest comes from the schedule rather than the dependencies alone
+        seconds = max(f for s, f in schedule.values())
+        chain = scheduled_chain(tdict, schedule)
+    resources = tdict.get('Resources', {})
+    return {
+        'seconds': seconds,
+        'resources': len(resources),
+        'max_concurrency': max_concurrency(schedule),
+        'critical_chain': [(title, resources[title]['Type'], latency(title, resources[title])) for title in chain],
+    }
+
+
+def estimate_file(filename, latencies=None, concurrency=None):
+    with open(filename, 'r') as f:
+        tdict = json.load(f)
+    return estimate(tdict, latencies, concurrency, directory=os.path.dirname(os.path.abspath(filename)))
+
+
+def _format_seconds(seconds):
+    return '{0}m{1:02d}s'.format(int(seconds) // 60, int(seconds) % 60)
+
+
+def print_estimate(name, result, stream):
+    print("{0}: {1} ({2} resources, at most {3} at once)".format(
+        name, _format_seconds(result['seconds']), result['resources'], result['max_concurrency']), file=stream)
+    for title, resource_type, seconds in result['critical_chain']:
+        print("    {0:>6}  {1:<40} {2}".format(_format_seconds(seconds), title, resource_type), file=stream)
+
+
+def _create_parser():
+    parser = argparse.ArgumentParser(prog='estimate.py')
+    parser.add_argument('templates', nargs='+', help='The generated templates to estimate')
+    parser.add_argument('--latencies', type=str, help='A YAML file of resource type (or title) to seconds')
+    parser.add_argument('--concurrency', type=int, help='The most resources CloudFormation creates at once (default: no limit)')
+    parser.add_argument('--report', type=str, help='Write the estimates as JSON to this file')
+    return parser
+
+
+if __name__ == '__main__':
+    args = _create_parser().parse_args()
+
+    latencies = {}
+    if args.latencies:
+        with open(args.latencies, 'r') as f:
+            latencies = yaml.load(f) or {}
+
+    results = {}
+    for filename in args.templates:
+        results[filename] = estimate_file(filename, latencies, args.concurrency)
+        print_estimate(filename, results[filename], sys.stdout)
+
+    if len(results) > 1:
+        fastest = min(results, key=lambda f: results[f]['seconds'])
+        print("\nFastest: {0}".format(fastest))
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This module caches what each emitter (network, core and the components) adds to
+# the template, so unchanged emitters can be spliced back in instead of re-run.
+#
+# A fragment is keyed by the emitter's source, the contents of the templates it
+# rendered from lib/templates and the values of the config names its source refers
+# to (which includes state published by earlier emitters, like the VPC). The
+# templates an emitter renders are only known after it has run, so they are kept
+# in a per-emitter manifest that is consulted before looking the fragment up.
+
+import ast
+import hashlib
+import json
+import os
+import tempfile
+import types
+
+import troposphere
+from troposphere import AWSHelperFn, BaseAWSObject, Template, awsencode
+
+import cidr
+import config as cfn
+import scaling
+import userdata
+
+# The cache directory, fragment caching is disabled while this is None
+cache_dir = None
+
+fragment_cache_stats = {'hits': 0, 'misses': 0}
+
+# Template sections an emitter may add to
+SECTIONS = ('parameters', 'conditions', 'resources', 'outputs', 'mappings')
+
+# Module level state in config that emitters publish for the ones after them
+STATE = ('vpcs', 'vpc_subnets', 'keyname', 'alert_topic', 'private_route_tables', 's3_buckets', 'deploy_roles')
+
+_IGNORED_CONFIG_NAMES = ('template', 'template_cache_stats', 'template_reads', 'address_space')
+
+
+class CachedObject(BaseAWSObject):
+    """A parameter, resource or output spliced in from the fragment cache. It renders
+    exactly as the original did and can be Ref'd by title like any other object."""
+    props = {}
+
+    def __init__(self, title, data):
+        self.data = data
+        super(CachedObject, self).__init__(title)
+
+    def JSONrepr(self):
+        return self.data
+
+
+class CachedFunction(AWSHelperFn):
+    """A function like Join that was published as config state, spliced back in from
+    the fragment cache"""
+    def __init__(self, data):
+        self.data = data
+
+    def JSONrepr(self):
+        return self.data
+
+
+def configure(directory):
+    """Enables the fragment cache, storing fragments in directory"""
+    global cache_dir
+    cache_dir = directory
+    if directory and not os.path.isdir(os.path.join(directory, 'manifests')):
+        os.makedirs(os.path.join(directory, 'manifests'))
+
+
+def _hash(*parts):
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else part.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _file_hash(filename):
+    with open(filename, 'rb') as f:
+        return _hash(f.read())
+
+
+def _dump_state(value):
+    """Turns config values (including troposphere objects) into something JSON can hold"""
+    if isinstance(value, BaseAWSObject):
+        return {'title': value.title}
+    if isinstance(value, AWSHelperFn):
+        # functions like the Join of a bucket name come back as the JSON they render to
+        return {'json': json.loads(json.dumps(value, cls=awsencode))}
+    if isinstance(value, dict):
+        items = [[_dump_state(k), _dump_state(v)] for k, v in value.items()]
+        return {'dict': sorted(items, key=lambda item: json.dumps(item, sort_keys=True))}
+    if isinstance(value, (list, tuple)):
+        return {'list': [_dump_state(v) for v in value]}
+    if isinstance(value, int) and not isinstance(value, bool):
+        # IntEnums like SubnetTypes are stored by value
+        return {'value': int(value)}
+    return {'value': value}
+
+
+def _load_state(dumped, current=None):
+    """The inverse of _dump_state. Dicts are merged into current so that containers
+    like config.vpc_subnets keep their defaultdict behaviour."""
+    if 'title' in dumped:
+        title = dumped['title']
+        return cfn.template.resources.get(title) or cfn.template.parameters.get(title)
+    if 'json' in dumped:
+        return CachedFunction(dumped['json'])
+    if 'list' in dumped:
+        return [_load_state(v) for v in dumped['list']]
+    if 'dict' in dumped:
+        result = current if current is not None else {}
+        for k, v in dumped['dict']:
+            key = _load_state(k)
+            existing = result[key] if isinstance(v, dict) and 'dict' in v else None
+            result[key] = _load_state(v, existing)
+        return result
+    return dumped['value']
+
+
+def _config_names(source):
+    """Finds the names an emitter's source reads from config, either through
+    'from config import X' or through attributes of the imported config module"""
+    tree = ast.parse(source)
+    aliases = set()
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            aliases.update(a.asname or a.name for a in node.names if a.name == 'config')
+        elif isinstance(node, ast.ImportFrom) and node.module == 'config':
+            names.update(a.name for a in node.names)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id in aliases:
+            names.add(node.attr)
+
+    # Helpers like get_asg_azs() read config values themselves, and may call other helpers
+    pending = list(names)
+    while pending:
+        value = getattr(cfn, pending.pop(), None)
+        if isinstance(value, types.FunctionType):
+            new = set(value.__code__.co_names) - names
+            names.update(new)
+            pending.extend(new)
+
+    return sorted(n for n in names if not n.startswith('_') and n not in _IGNORED_CONFIG_NAMES)
+
+
+def _config_values(names):
+    values = {}
+    for name in names:
+        value = getattr(cfn, name, None)
+        if isinstance(value, (types.FunctionType, types.ModuleType, type, Template)):
+            continue
+        values[name] = _dump_state(value)
+    return values
+
+
+def _generator_hash():
+    own_source = os.path.splitext(__file__)[0] + '.py'
+    config_source = os.path.splitext(cfn.__file__)[0] + '.py'
+    cidr_source = os.path.splitext(cidr.__file__)[0] + '.py'
+    scaling_source = os.path.splitext(scaling.__file__)[0] + '.py'
+    userdata_source = os.path.splitext(userdata.__file__)[0] + '.py'
+    return _hash(troposphere.__version__, _file_hash(own_source), _file_hash(config_source), _file_hash(cidr_source),
+                 _file_hash(scaling_source), _file_hash(userdata_source))
+
+
+def _fragment_key(source, config_values, templates):
+    template_hashes = [(t, _file_hash(os.path.join(cfn.TEMPLATE_DIR, t))) for t in templates]
+    return _hash(json.dumps({
+        'generator': _generator_hash(),
+        'source': _hash(source),
+        'templates': template_hashes,
+        'config': config_values,
+    }, sort_keys=True))
+
+
+def _write_json(filename, data):
+    # Several generators may share a cache (generate.py --matrix), so write atomically
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, sort_keys=True)
+    os.rename(tmpname, filename)
+
+
+def _read_json(filename):
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def _snapshot():
+    template = cfn.template
+    sections = dict((s, set(getattr(template, s).keys())) for s in SECTIONS)
+    state = dict((s, _dump_state(getattr(cfn, s))) for s in STATE)
+    return sections, state
+
+
+def _capture(before):
+    """Builds the fragment for everything that was added since the before snapshot"""
+    sections, state = before
+    template = cfn.template
+    fragment = {}
+    for section in SECTIONS:
+        added = dict((k, v) for k, v in getattr(template, section).items() if k not in sections[section])
+        fragment[section] = json.loads(json.dumps(added, cls=awsencode))
+    fragment['state'] = dict(
+        (s, _dump_state(getattr(cfn, s))) for s in STATE if _dump_state(getattr(cfn, s)) != state[s]
+    )
+    return fragment
+
+
+def _splice(fragment):
+    template = cfn.template
+    for title, data in fragment['parameters'].items():
+        template.add_parameter(CachedObject(title, data))
+    for title, data in fragment['resources'].items():
+        template.add_resource(CachedObject(title, data))
+    for title, data in fragment['outputs'].items():
+        template.add_output(CachedObject(title, data))
+    for name, data in fragment['conditions'].items():
+        template.add_condition(name, data)
+    for name, data in fragment['mappings'].items():
+        template.add_mapping(name, data)
+
+    for name, dumped in fragment['state'].items():
+        current = getattr(cfn, name)
+        if isinstance(current, dict):
+            _load_state(dumped, current)
+        elif isinstance(current, list):
+            current[:] = _load_state(dumped)
+        else:
+            setattr(cfn, name, _load_state(dumped))
+
+
+def emit(name, source_file, emitter):
+    """Runs emitter (which adds the configuration for name to the template), or
+    splices its previous output back in if nothing it depends on changed"""
+    if not cache_dir:
+        return emitter()
+
+    with open(source_file, 'r') as f:
+        source = f.read()
+
+    # The config has to be captured before the emitter runs and publishes its state
+    config_values = _config_values(_config_names(source))
+
+    manifest_file = os.path.join(cache_dir, 'manifests', '{0}.json'.format(name))
+    manifest = _read_json(manifest_file)
+    if manifest is not None:
+        fragment = _read_json(os.path.join(cache_dir, '{0}.json'.format(
+            _fragment_key(source, config_values, manifest['templates']))))
+        if fragment is not None:
+            fragment_cache_stats['hits'] += 1
+            _splice(fragment)
+            return
+
+    fragment_cache_stats['misses'] += 1
+    before = _snapshot()
+    cfn.template_reads = set()
+    try:
+        emitter()
+        templates = sorted(cfn.template_reads)
+    finally:
+        cfn.template_reads = None
+
+    key = _fragment_key(source, config_values, templates)
+    _write_json(os.path.join(cache_dir, '{0}.json'.format(key)), _capture(before))
+    _write_json(manifest_file, {'templates': templates})
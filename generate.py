@@ -1,77 +1,419 @@
 from __future__ import print_function
+import time
+
+# Recorded before anything else is imported so --startup-time can report on imports
+_START = time.time()
+
 import argparse
 import os
-import pkgutil
 import sys
+from contextlib import contextmanager
 
 import yaml
 
 import network
+import checks
 import config
+import dependencies
+import diff
+import fragments
+import nesting
+import policies
+import timings
+import userdata
+import writer
 
 
 def _create_parser():
     parser = argparse.ArgumentParser(prog='generate.py')
     parser.add_argument('-c', '--config', type=str, help='The configuration YAML file to use to generate the Cloudformation template')
     parser.add_argument('-o', '--outfile', type=str, help='The file to write the Cloudformation template to')
+    parser.add_argument('--minify', action='store_true', help='Write the template without any indentation or whitespace')
+    parser.add_argument('--diff', type=str, metavar='PREVIOUS',
+                        help='Compare the template with the one the stack was last deployed with and list the resources that will be replaced')
+    parser.add_argument('--keep-depends-on', action='store_true',
+                        help='Keep DependsOn entries that are already implied by references or other dependencies')
+    parser.add_argument('--share-policies', action='store_true',
+                        help='Replace the inline copies of a policy document several roles have with one managed policy')
+    parser.add_argument('--nested-stacks', choices=['auto', 'always', 'never'], default='auto',
+                        help='Split the template into nested stacks: only when it exceeds the CloudFormation limits (auto, the default), always or never')
+    parser.add_argument('--nested-template-url', type=str,
+                        help='The default for the URL (ending in a slash) the nested stack templates are uploaded under')
+    parser.add_argument('--max-resources', type=int, default=nesting.MAX_RESOURCES,
+                        help='The number of resources a stack may hold before it is split (default: {0})'.format(nesting.MAX_RESOURCES))
+    parser.add_argument('--max-template-bytes', type=int, default=nesting.MAX_TEMPLATE_BYTES,
+                        help='The template size before it is split (default: {0})'.format(nesting.MAX_TEMPLATE_BYTES))
+    parser.add_argument('--bytecode-cache', type=str, help='A directory to persist compiled Jinja templates in between runs')
+    parser.add_argument('--fragment-cache', type=str,
+                        help='A directory to cache the output of each component in, so only components that changed are regenerated')
+    parser.add_argument('--timings', action='store_true',
+                        help='Report wall time, resources, template bytes and peak memory for every component')
+    parser.add_argument('--timings-report', type=str, help='Write the --timings report as JSON to this file')
+    parser.add_argument('--profile', type=str, metavar='DIR', help='Run every component under cProfile and dump the stats to DIR')
+    parser.add_argument('--matrix', type=str, nargs='+', metavar='CONFIG',
+                        help='Generate a template for every combination of these configuration files, '
+                        '--envs and --regions. --outfile is treated as the output directory')
+    parser.add_argument('--envs', type=str, nargs='+', help='Environments to generate in --matrix mode (default: the env in each config)')
+    parser.add_argument('--regions', type=str, nargs='+', help='Regions to generate in --matrix mode (default: the region in each config)')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='Number of templates to generate concurrently in --matrix mode (default: one per CPU)')
+    parser.add_argument('--startup-time', action='store_true',
+                        help='Report how long startup took and which modules were imported')
     return parser
 
+
+def _load_config(filename, env=None, region=None):
+    """Loads a configuration YAML file, optionally overriding its env and region"""
+    with open(filename, 'r') as yfile:
+        ymlfile = yaml.load(yfile)
+
+    if 'components' not in ymlfile:
+        raise Exception("Configuration file {0} must include the 'components' field".format(filename))
+
+    infra = ymlfile['infra'][0]
+    if env:
+        infra['env'] = env
+    if region:
+        infra['region'] = region
+    return ymlfile
+
+
+def _component_emitter(package, module_name):
+    """Returns a function that imports a component and emits its configuration.
+    Importing is deferred so components that come from the fragment cache are never imported."""
+    def emitter():
+        mod = __import__("{0}.{1}".format(package, module_name))
+        cls = getattr(mod, module_name)
+        cls.emit_configuration()
+    return emitter
+
+
+def _component_registry(package):
+    """Maps the names of the components in package to their source files without
+    importing any of them. Only the components a configuration asks for get imported."""
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), package)
+    registry = {}
+    for filename in os.listdir(directory):
+        name, ext = os.path.splitext(filename)
+        if ext == '.py' and name != '__init__':
+            registry[name] = os.path.join(directory, filename)
+    return registry
+
+
+@contextmanager
+def _owned_by(name):
+    """Records name as the owner of every resource that is added to the template while active"""
+    before = set(config.template.resources)
+    try:
+        yield
+    finally:
+        for title in set(config.template.resources) - before:
+            config.resource_owners[title] = name
+
+
 def _emit_component_configurations(package, components=None):
-    # Get all submodules in components
-    for loader, module_name, ispkg in pkgutil.iter_modules([package]):
-        if module_name not in sys.modules:
-            if (components and module_name in components) or not components:
-                mod = __import__("{0}.{1}".format(package, module_name))
-                # Determine if EMIT is set to a non-True value (if module has one).
-                cls = getattr(mod, module_name)
-
-                # generate configuration for module if it doesn't have the EMIT
-                # property set or if it's set to something 'true'
-                #if (hasattr(cls, 'EMIT') and cls.EMIT) or not hasattr(cls, 'EMIT'):
-                print("Generating configuration for {0} module".format(module_name), file=sys.stderr)
-                try:
-                    cls.emit_configuration()
-                except Exception, ae:
-                    #print("Could not generate configuration for {0} module as it's missing emit_configuration".format(module_name), file=sys.stderr)
-                    print("Could not generation configuration for {0}: {1}".format(module_name, ae), file=sys.stderr)
-                #else:
-                #    print("Skipping configuration for {0} module because EMIT was set to False".format(module_name), file=sys.stderr)
-        else:
-            print("Not generating configuration for {0} module because it's not in your components list".format(module_name), file=sys.stderr)
-
-
-def generate_cloudformation_template(outfile, components):
+    registry = _component_registry(package)
+    for module_name in sorted(set(components or []) - set(registry)):
+        print("Not generating configuration for {0} because there is no such module in {1}".format(module_name, package), file=sys.stderr)
+
+    for module_name in sorted(registry):
+        if components and module_name not in components:
+            continue
+
+        print("Generating configuration for {0} module".format(module_name), file=sys.stderr)
+        try:
+            with timings.measure(module_name), _owned_by(module_name):
+                fragments.emit(module_name, registry[module_name], _component_emitter(package, module_name))
+        except Exception, ae:
+            print("Could not generation configuration for {0}: {1}".format(module_name, ae), file=sys.stderr)
+
+
+def _configure_generator(options):
+    """Applies the caching and instrumentation options shared by single and --matrix runs"""
+    if options.get('bytecode_cache'):
+        config.configure_template_cache(bytecode_dir=options['bytecode_cache'])
+    if options.get('fragment_cache'):
+        fragments.configure(options['fragment_cache'])
+    if options.get('timings') or options.get('timings_report') or options.get('profile'):
+        timings.configure(profile=options.get('profile'))
+
+
+def _generator_options(args):
+    return {
+        'bytecode_cache': args.bytecode_cache,
+        'fragment_cache': args.fragment_cache,
+        'minify': args.minify,
+        'timings': args.timings,
+        'timings_report': args.timings_report,
+        'profile': args.profile,
+        'diff': args.diff,
+        'prune_dependencies': not args.keep_depends_on,
+        'share_policies': args.share_policies,
+        'nested_stacks': args.nested_stacks,
+        'nested_template_url': args.nested_template_url,
+        'max_resources': args.max_resources,
+        'max_template_bytes': args.max_template_bytes,
+    }
+
+
+def emit_template(components):
+    """Adds the network, core and the given components to config.template"""
     # network has to be emitted first since it sets a lot of state that everything else
     # depends on
     try:
         print("Emitting network configuration", file=sys.stderr)
-        network.emit_configuration()
+        with timings.measure('network'), _owned_by('network'):
+            fragments.emit('network', os.path.splitext(network.__file__)[0] + '.py', network.emit_configuration)
+        if config.address_space is None:
+            # a fragment cache hit skips the subnet allocation, which is cheap and comes
+            # out the same for the inputs the fragment is keyed on, so it is redone to
+            # report the address space and save the allocations
+            network.allocate_subnets(config.get_availability_zones())
+        if config.address_space:
+            print("Address space {0}".format(config.address_space.report()), file=sys.stderr)
     except e:
         print(e)
 
     _emit_component_configurations('core')
     _emit_component_configurations('components', components=components)
 
+    # the VPC endpoints come last, the components declare the buckets they use
+    if config.VPC_ENDPOINTS:
+        print("Emitting VPC endpoints", file=sys.stderr)
+        with timings.measure('vpc-endpoints'), _owned_by('network'):
+            fragments.emit('vpc-endpoints', os.path.splitext(network.__file__)[0] + '.py', network.emit_vpc_endpoints)
+
+
+def _write_nested_stacks(outfile, tdict, options):
+    """Splits the template into a parent stack (written to outfile) and nested stacks
+    that are written next to it"""
+    base = os.path.splitext(os.path.basename(outfile))[0]
+
+    def template_name(stack):
+        return '{0}.{1}.template'.format(base, stack)
+
+    parent, children = nesting.split(tdict, config.resource_owners, template_name)
+    if options.get('nested_template_url'):
+        parent['Parameters'][nesting.BASE_URL_PARAMETER]['Default'] = options['nested_template_url']
+
+    stacks = [(outfile, parent)] + [
+        (os.path.join(os.path.dirname(outfile), template_name(stack)), children[stack]) for stack in sorted(children)
+    ]
+    print("Splitting the template into {0} nested stacks".format(len(children)), file=sys.stderr)
+    for filename, stack in stacks:
+        with open(filename, 'w') as ofile:
+            writer.write_template(nesting.as_template(stack), ofile, minify=options.get('minify'))
+        resources, size = nesting.measure(stack)
+        print("  {0:<50} {1:>5} resources {2:>9} bytes".format(filename, resources, size), file=sys.stderr)
+        for problem in nesting.check_limits(filename, stack, options['max_resources'], options['max_template_bytes']):
+            print("WARNING: {0}".format(problem), file=sys.stderr)
+
+
+def _prune_dependencies(tdict):
+    """Drops the DependsOn entries that are already implied and reports the critical path"""
+    dropped = dependencies.prune(tdict)
+    length, path = dependencies.critical_path(tdict)
+    waves = dependencies.levels(tdict)
+    print("Dropped {0} redundant DependsOn, {1} resources are created in {2} waves (at most {3} at once)".format(
+        dropped, len(tdict['Resources']), len(waves), max(waves or [0])), file=sys.stderr)
+    print("Critical path ({0} resources): {1}".format(length, ' -> '.join(path)), file=sys.stderr)
+
+
+def _share_policies(tdict):
+    """Moves the policy documents several roles have inline into managed policies"""
+    created, saved = policies.share(tdict)
+    for title, roles in sorted(created.items()):
+        print("{0} replaces the inline copies in {1}".format(title, ', '.join(roles)), file=sys.stderr)
+    if created:
+        print("Managed policies replace {0} inline policies, saving {1} bytes".format(
+            sum(len(roles) for roles in created.values()), saved), file=sys.stderr)
+
+
+def _write_output(outfile, options):
+    """Checks and writes config.template (or its nested stacks), returns the template data"""
+    mode = options.get('nested_stacks') or 'auto'
+
+    template, tdict = config.template, nesting.template_dict(config.template)
+    if options.get('share_policies'):
+        _share_policies(tdict)
+        template = nesting.as_template(tdict)
+    if options.get('prune_dependencies', True):
+        _prune_dependencies(tdict)
+        template = nesting.as_template(tdict)
+
+    for warning in checks.run(tdict):
+        print("WARNING: {0}".format(warning), file=sys.stderr)
+
+    if mode != 'never':
+        options = dict(options)
+        options['max_resources'] = options.get('max_resources') or nesting.MAX_RESOURCES
+        options['max_template_bytes'] = options.get('max_template_bytes') or nesting.MAX_TEMPLATE_BYTES
+
+        if mode == 'always' or nesting.exceeds_limits(tdict, options['max_resources'], options['max_template_bytes']):
+            if outfile:
+                _write_nested_stacks(outfile, tdict, options)
+                return tdict
+            print("WARNING: the template exceeds the CloudFormation limits, but nested stacks can only be written with --outfile", file=sys.stderr)
+
     if outfile:
         with open(outfile, 'w') as ofile:
-            print(config.template.to_json(), file=ofile)
+            writer.write_template(template, ofile, minify=options.get('minify'))
     else:
-        print(config.template.to_json())
+        writer.write_template(template, sys.stdout, minify=options.get('minify'))
+    return tdict
+
+
+def _print_diff(previous, tdict, outfile=None):
+    """Prints what updating a stack deployed from the previous template file to tdict
+    (written to outfile) does. Both are compared with their nested stacks, if any."""
+    old, old_locations = diff.load(previous)
+    new, new_locations = diff.load(outfile) if outfile else (tdict, {})
+    print("\nChanges against {0}:".format(previous), file=sys.stderr)
+    diff.print_diff(old, new, sys.stderr, old_locations, new_locations)
+
+
+def _print_user_data_sizes(tdict):
+    """Prints how much user data every instance and launch configuration gets"""
+    sizes = userdata.sizes(tdict)
+    if not sizes:
+        return
+    print("User data ({0}):".format(config.USER_DATA_FORMAT), file=sys.stderr)
+    for title, size in sizes:
+        print("  {0:<40} {1:>6} bytes".format(title, size if size is not None else '?'), file=sys.stderr)
+    print("  {0:<40} {1:>6} bytes".format('total', sum(size or 0 for _, size in sizes)), file=sys.stderr)
+
+
+def generate_cloudformation_template(outfile, components, options=None):
+    """Generates the template for components and writes it to outfile (or stdout).
+    options are the generator options, see _generator_options()."""
+    options = options or {}
+    emit_template(components)
+
+    with timings.measure('output'):
+        tdict = _write_output(outfile, options)
+
+    if options.get('diff'):
+        _print_diff(options['diff'], tdict, outfile)
+    _print_user_data_sizes(tdict)
+
+    stats = config.template_cache_stats
+    print("Template cache: {0} hits, {1} misses".format(stats['hits'], stats['misses']), file=sys.stderr)
+    if fragments.cache_dir:
+        stats = fragments.fragment_cache_stats
+        print("Fragment cache: {0} hits, {1} misses".format(stats['hits'], stats['misses']), file=sys.stderr)
+
+    if timings.enabled:
+        timings.print_report(sys.stderr)
+        if options.get('timings_report'):
+            timings.write_report(options['timings_report'])
+
+
+def _matrix_combinations(config_files, envs=None, regions=None):
+    """Expands configuration files and the env/region axes into one entry per template"""
+    for filename in config_files:
+        # several configs may share a cloudname, so outputs are named after the file
+        stem = os.path.basename(filename).split('.')[0]
+        for env in (envs or [None]):
+            for region in (regions or [None]):
+                infra = _load_config(filename, env=env, region=region)['infra'][0]
+                yield '.'.join([stem, infra['env'], infra['region']]), filename, env, region
+
+
+def _generate_matrix_entry(job):
+    """Generates a single template of the matrix. This runs in its own worker process
+    since config and the components keep their state at module level."""
+    name, filename, env, region, outfile, options = job
+    start = time.time()
+    try:
+        ymlfile = _load_config(filename, env=env, region=region)
+        config.initialize(ymlfile)
+
+        # every template gets its own timing report and profiles
+        options = dict(options)
+        if options.get('profile'):
+            options['profile'] = os.path.join(options['profile'], name)
+        if options.get('timings') or options.get('timings_report'):
+            options['timings_report'] = '{0}.timings.json'.format(os.path.splitext(outfile)[0])
+        if options.get('diff'):
+            # in matrix mode --diff is the directory of the previously generated templates
+            previous = os.path.join(options['diff'], os.path.basename(outfile))
+            options['diff'] = previous if os.path.exists(previous) else None
+        _configure_generator(options)
+
+        generate_cloudformation_template(outfile, ymlfile['components'], options)
+        error = None
+    except Exception, e:
+        error = str(e)
+    return name, outfile, time.time() - start, error
+
+
+def generate_matrix(config_files, outdir, envs=None, regions=None, jobs=None, options=None):
+    """Generates the templates for every config file/env/region combination on a
+    process pool. options are the generator options (see _generator_options).
+    Returns the list of (name, outfile, seconds, error) results."""
+    import multiprocessing
+
+    outdir = outdir or '.'
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    work = [
+        (name, filename, env, region, os.path.join(outdir, '{0}.template'.format(name)), options or {})
+        for name, filename, env, region in _matrix_combinations(config_files, envs, regions)
+    ]
+
+    start = time.time()
+    # Every combination gets a fresh process because the generator state is global
+    pool = multiprocessing.Pool(processes=jobs, maxtasksperchild=1)
+    try:
+        results = list(pool.imap_unordered(_generate_matrix_entry, work))
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+
+    print("\nGenerated {0} templates in {1:.2f}s (sum of individual runs: {2:.2f}s)".format(
+        len(results), elapsed, sum(r[2] for r in results)), file=sys.stderr)
+    for name, outfile, seconds, error in sorted(results, key=lambda r: r[2], reverse=True):
+        status = 'FAILED: {0}'.format(error) if error else outfile
+        print("  {0:<40} {1:>7.2f}s  {2}".format(name, seconds, status), file=sys.stderr)
+
+    return results
+
+
+def _print_startup_report(startup, total):
+    """Prints how long it took to get to the first component and what got imported on the way"""
+    loaded = sorted(m for m in sys.modules if sys.modules[m] is not None)
+    print("\nStartup took {0:.1f}ms, generation finished after {1:.1f}ms".format(startup * 1000, total * 1000), file=sys.stderr)
+    print("{0} modules were imported".format(len(loaded)), file=sys.stderr)
+    for prefix in ('troposphere', 'jinja2', 'components', 'core'):
+        names = [m for m in loaded if m == prefix or m.startswith(prefix + '.')]
+        print("  {0}: {1}".format(prefix, ', '.join(names) if names else 'not imported'), file=sys.stderr)
+
 
 if __name__ == '__main__':
     arg_parser = _create_parser()
     args = arg_parser.parse_args()
 
+    if args.matrix:
+        results = generate_matrix(args.matrix, args.outfile, envs=args.envs, regions=args.regions,
+                                  jobs=args.jobs, options=_generator_options(args))
+        sys.exit(1 if any(r[3] for r in results) else 0)
+
     print('Creating cloudformation template using config file: {0} '.format(args.config), file=sys.stderr)
 
     if args.config:
         print("Initializing with external YAML configuration", file=sys.stderr)
-        with open(args.config, 'r') as yfile:
-            ymlfile = yaml.load(yfile)
+        ymlfile = _load_config(args.config)
 
         config.initialize(ymlfile)
+        _configure_generator(_generator_options(args))
     else:
         raise Exception("You must supply a configuration file that includes the 'components' field")
 
+    startup = time.time() - _START
+
+    generate_cloudformation_template(args.outfile, ymlfile["components"], _generator_options(args))
 
-    generate_cloudformation_template(args.outfile, ymlfile["components"])
+    if args.startup_time:
+        _print_startup_report(startup, time.time() - _START)
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This module splits a template that is too large for a single CloudFormation stack
+# into a parent stack and several nested stacks (network, data tier and one per
+# compute component).
+#
+# Resources are grouped by the emitter that created them (see config.resource_owners).
+# A resource that refers to a resource in another nested stack gets that value as a
+# parameter, the stack that owns it exports it as an output and the parent wires the
+# two together with Fn::GetAtt, which also orders the stacks. Stacks that end up
+# referring to each other are merged, so the parent never has a cycle.
+
+import json
+
+from troposphere import Template, awsencode
+
+import config as cfn
+import writer
+
+# CloudFormation limits for a template that is uploaded to S3
+MAX_RESOURCES = 500
+MAX_TEMPLATE_BYTES = 1024 * 1024
+MAX_PARAMETERS = 200
+MAX_OUTPUTS = 200
+
+# The parent parameter holding the URL the nested templates are uploaded under
+BASE_URL_PARAMETER = 'NestedTemplateBaseURL'
+
+NETWORK_STACK = 'Network'
+DATA_STACK = 'Data'
+
+# Components whose resources make up the data tier, everything else that isn't
+# part of the network gets a nested stack of its own
+DATA_TIER = ('queues', 'farragut_queues', 'postgres', 'redshift', 'deployer')
+
+
+def template_dict(template):
+    """Returns the template as plain JSON data"""
+    return json.loads(json.dumps(writer.template_sections(template), cls=awsencode))
+
+
+def measure(tdict):
+    """Returns the number of resources in a template and its size in bytes once minified"""
+    return len(tdict.get('Resources', {})), len(json.dumps(tdict, separators=(',', ':')))
+
+
+def exceeds_limits(tdict, max_resources=MAX_RESOURCES, max_bytes=MAX_TEMPLATE_BYTES):
+    resources, size = measure(tdict)
+    return resources > max_resources or size > max_bytes
+
+
+def as_template(tdict):
+    """Turns template data back into a Template that writer.write_template can write"""
+    template = Template()
+    template.description = tdict.get('Description')
+    template.version = tdict.get('AWSTemplateFormatVersion')
+    template.conditions = tdict.get('Conditions', {})
+    template.mappings = tdict.get('Mappings', {})
+    template.outputs = tdict.get('Outputs', {})
+    template.parameters = tdict.get('Parameters', {})
+    template.resources = tdict.get('Resources', {})
+    return template
+
+
+def stack_for(owner):
+    """Names the nested stack the resources of an emitter go to"""
+    if owner is None or owner == 'network':
+        return NETWORK_STACK
+    if owner in DATA_TIER:
+        return DATA_STACK
+    return cfn.sanitize_id(owner.title())
+
+
+def _walk(value, visit):
+    """Calls visit on every dict in value"""
+    if isinstance(value, dict):
+        visit(value)
+        for v in value.values():
+            _walk(v, visit)
+    elif isinstance(value, list):
+        for v in value:
+            _walk(v, visit)
+
+
+def _rewrite(value, rewrite):
+    """Returns a copy of value where every dict has been passed through rewrite first"""
+    if isinstance(value, dict):
+        value = rewrite(value)
+        if isinstance(value, dict):
+            return dict((k, _rewrite(v, rewrite)) for k, v in value.items())
+        return value
+    if isinstance(value, list):
+        return [_rewrite(v, rewrite) for v in value]
+    return value
+
+
+def _depends_on(resource):
+    depends = resource.get('DependsOn', [])
+    return [depends] if not isinstance(depends, list) else depends
+
+
+def references(value):
+    """Returns the (name, attribute) pairs value refers to through Ref (attribute is
+    None) and Fn::GetAtt, plus the condition and mapping names it uses"""
+    refs, conditions, mappings = set(), set(), set()
+
+    def visit(d):
+        if 'Ref' in d and len(d) == 1:
+            refs.add((d['Ref'], None))
+        elif 'Fn::GetAtt' in d:
+            refs.add((d['Fn::GetAtt'][0], d['Fn::GetAtt'][1]))
+        elif 'Fn::FindInMap' in d:
+            mappings.add(d['Fn::FindInMap'][0])
+        elif 'Fn::If' in d:
+            conditions.add(d['Fn::If'][0])
+        # both the Condition function and the Condition attribute of resources
+        if 'Condition' in d and not isinstance(d['Condition'], (dict, list)):
+            conditions.add(d['Condition'])
+
+    _walk(value, visit)
+    return refs, conditions, mappings
+
+
+def _export_name(name, attribute):
+    return cfn.sanitize_id(name, attribute or '')
+
+
+def _merge_cycles(assignment, edges):
+    """Merges stacks that depend on each other (Tarjan's strongly connected components)"""
+    index, lowlink, stack, on_stack, merged = {}, {}, [], set(), {}
+    counter = [0]
+
+    def connect(node):
+        index[node] = lowlink[node] = counter[0]
+        counter[0] += 1
+        stack.append(node)
+        on_stack.add(node)
+        for other in sorted(edges.get(node, ())):
+            if other not in index:
+                connect(other)
+                lowlink[node] = min(lowlink[node], lowlink[other])
+            elif other in on_stack:
+                lowlink[node] = min(lowlink[node], index[other])
+        if lowlink[node] == index[node]:
+            component = []
+            while True:
+                other = stack.pop()
+                on_stack.discard(other)
+                component.append(other)
+                if other == node:
+                    break
+            name = ''.join(sorted(component))
+            for other in component:
+                merged[other] = name
+
+    for node in sorted(set(assignment.values())):
+        if node not in index:
+            connect(node)
+    return dict((title, merged[stack]) for title, stack in assignment.items())
+
+
+def _stack_edges(resources, assignment):
+    edges = {}
+    for title, resource in resources.items():
+        refs = references(resource)[0]
+        targets = set(name for name, _ in refs) | set(_depends_on(resource))
+        for target in targets:
+            if target in assignment and assignment[target] != assignment[title]:
+                edges.setdefault(assignment[title], set()).add(assignment[target])
+    return edges
+
+
+def split(tdict, owners, template_url):
+    """Splits template data into a parent and nested stacks.
+
+    owners maps resource titles to the emitter that created them and template_url
+    is called with a stack name to get the file name its template will be stored as
+    (relative to the NestedTemplateBaseURL parameter). Returns the parent template
+    data and a dict of stack name to nested template data."""
+    resources = tdict.get('Resources', {})
+    parameters = tdict.get('Parameters', {})
+    conditions = tdict.get('Conditions', {})
+    mappings = tdict.get('Mappings', {})
+
+    assignment = dict((title, stack_for(owners.get(title))) for title in resources)
+    assignment = _merge_cycles(assignment, _stack_edges(resources, assignment))
+    stacks = sorted(set(assignment.values()))
+
+    children = dict((s, {
+        'AWSTemplateFormatVersion': tdict.get('AWSTemplateFormatVersion', '2010-09-09'),
+        'Description': 'The {0} resources of the {1} cloud'.format(s, cfn.VPC_NAME),
+        'Parameters': {}, 'Conditions': {}, 'Mappings': {}, 'Resources': {}, 'Outputs': {},
+    }) for s in stacks)
+    # parameters of every nested stack and the parent values passed to them
+    passed = dict((s, {}) for s in stacks)
+    stack_depends = dict((s, set()) for s in stacks)
+
+    def export(name, attribute):
+        """Makes the stack that owns name output it, returns the parent's GetAtt for it"""
+        owner = assignment[name]
+        output = _export_name(name, attribute)
+        value = {'Ref': name} if attribute is None else {'Fn::GetAtt': [name, attribute]}
+        children[owner]['Outputs'][output] = {'Value': value}
+        return {'Fn::GetAtt': [owner + 'Stack', 'Outputs.{0}'.format(output)]}
+
+    def import_into(stack, data):
+        """Copies data into stack, turning references to other stacks into parameters"""
+        child = children[stack]
+        refs, used_conditions, used_mappings = references(data)
+
+        # conditions can refer to parameters, mappings and other conditions
+        pending = list(used_conditions)
+        while pending:
+            name = pending.pop()
+            if name in child['Conditions'] or name not in conditions:
+                continue
+            child['Conditions'][name] = conditions[name]
+            condition_refs, nested, condition_mappings = references(conditions[name])
+            refs |= condition_refs
+            used_mappings |= condition_mappings
+            pending.extend(nested)
+
+        for name in used_mappings:
+            if name in mappings:
+                child['Mappings'][name] = mappings[name]
+
+        for name, attribute in refs:
+            if name in parameters:
+                child['Parameters'][name] = parameters[name]
+                passed[stack][name] = {'Ref': name}
+            elif name in assignment and assignment[name] != stack:
+                parameter = name if attribute is None else _export_name(name, attribute)
+                child['Parameters'][parameter] = {
+                    'Type': 'String',
+                    'Description': 'Passed in from the {0} stack'.format(assignment[name]),
+                }
+                passed[stack][parameter] = export(name, attribute)
+
+        def localize(d):
+            if 'Fn::GetAtt' in d and d['Fn::GetAtt'][0] in assignment and assignment[d['Fn::GetAtt'][0]] != stack:
+                return {'Ref': _export_name(*d['Fn::GetAtt'])}
+            return d
+
+        return _rewrite(data, localize)
+
+    for title in sorted(resources):
+        stack = assignment[title]
+        resource = import_into(stack, resources[title])
+
+        # DependsOn can't cross stacks, the nested stacks depend on each other instead
+        crossing = [d for d in _depends_on(resource) if assignment.get(d, stack) != stack]
+        if crossing:
+            stack_depends[stack].update(assignment[d] for d in crossing)
+            local = [d for d in _depends_on(resource) if d not in crossing]
+            if local:
+                resource['DependsOn'] = local
+            else:
+                del resource['DependsOn']
+        children[stack]['Resources'][title] = resource
+
+    parent = {
+        'AWSTemplateFormatVersion': tdict.get('AWSTemplateFormatVersion', '2010-09-09'),
+        'Description': tdict.get('Description'),
+        'Parameters': dict(parameters),
+        'Resources': {},
+    }
+    parent['Parameters'][BASE_URL_PARAMETER] = {
+        'Type': 'String',
+        'Description': 'The URL (ending in a slash) the nested stack templates were uploaded under',
+    }
+
+    def parent_value(d):
+        if 'Ref' in d and len(d) == 1 and d['Ref'] in assignment:
+            return export(d['Ref'], None)
+        if 'Fn::GetAtt' in d and d['Fn::GetAtt'][0] in assignment:
+            return export(*d['Fn::GetAtt'])
+        return d
+
+    if tdict.get('Outputs'):
+        parent['Outputs'] = _rewrite(tdict['Outputs'], parent_value)
+        output_conditions = [c for c in references(tdict['Outputs'])[1] if c in conditions]
+        if output_conditions:
+            parent['Conditions'] = dict((c, conditions[c]) for c in output_conditions)
+
+    for stack in stacks:
+        child = children[stack]
+        for section in ('Parameters', 'Conditions', 'Mappings', 'Outputs'):
+            if not child[section]:
+                del child[section]
+
+        nested = {
+            'Type': 'AWS::CloudFormation::Stack',
+            'Properties': {
+                'TemplateURL': {'Fn::Join': ['', [{'Ref': BASE_URL_PARAMETER}, template_url(stack)]]},
+            },
+        }
+        if passed[stack]:
+            nested['Properties']['Parameters'] = passed[stack]
+        # stacks that are referenced through GetAtt are already waited for
+        referenced = set(d['Fn::GetAtt'][0][:-len('Stack')] for d in passed[stack].values() if 'Fn::GetAtt' in d)
+        depends = sorted(s + 'Stack' for s in stack_depends[stack] - referenced)
+        if depends:
+            nested['DependsOn'] = depends
+        parent['Resources'][stack + 'Stack'] = nested
+
+    return parent, children
+
+
+def check_limits(name, tdict, max_resources=MAX_RESOURCES, max_bytes=MAX_TEMPLATE_BYTES):
+    """Returns a list of the CloudFormation limits tdict doesn't fit in"""
+    resources, size = measure(tdict)
+    problems = []
+    if resources > max_resources:
+        problems.append('{0} has {1} resources (limit {2})'.format(name, resources, max_resources))
+    if size > max_bytes:
+        problems.append('{0} is {1} bytes (limit {2})'.format(name, size, max_bytes))
+    if len(tdict.get('Parameters', {})) > MAX_PARAMETERS:
+        problems.append('{0} has {1} parameters (limit {2})'.format(name, len(tdict['Parameters']), MAX_PARAMETERS))
+    if len(tdict.get('Outputs', {})) > MAX_OUTPUTS:
+        problems.append('{0} has {1} outputs (limit {2})'.format(name, len(tdict['Outputs']), MAX_OUTPUTS))
+    return problems
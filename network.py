@@ -3,27 +3,101 @@
 
 # This module initializes the VPCs necessary for the rest of cloud formation
 
+import json
+from collections import OrderedDict
 from itertools import chain
 
-from troposphere import Parameter, Ref, Tags, Join, Output, Select, FindInMap
+from troposphere import AWSObject, Parameter, Ref, Tags, Join, Output, Select, FindInMap, GetAtt, awsencode
 import troposphere.ec2 as ec2
 
+import cidr
 import config as cfn
 from config import CLOUDNAME
 
+# The subnets every availability zone gets, with their default size and the third
+# octet (and step between zones) they were laid out at before sizes were configurable.
+# Those stay the preferred place of a subnet, so existing VPCs keep their layout.
+SUBNET_LAYOUT = OrderedDict([
+    ('platform', (24, 10, 1)),
+    ('database', (24, 20, 1)),
+    ('vpn', (24, 60, 1)),
+    ('public', (24, 80, 1)),
+    ('master', (24, 90, 1)),
+    ('worker', (22, 100, 4)),
+])
+
+# The services that can have a gateway VPC endpoint, with the name used in its title
+ENDPOINT_SERVICES = OrderedDict([
+    ('s3', 'S3'),
+    ('dynamodb', 'DynamoDB'),
+])
+
+
+class VPCEndpoint(AWSObject):
+    """A gateway VPC endpoint (the troposphere we use doesn't know them yet)"""
+    resource_type = 'AWS::EC2::VPCEndpoint'
+
+    props = {
+        'PolicyDocument': (dict, False),
+        'RouteTableIds': (list, False),
+        'ServiceName': (basestring, True),
+        'VpcId': (basestring, True),
+    }
+
+
+# How the private subnets reach the internet: through a NAT instance or a managed
+# NAT gateway in every availability zone
+NAT_MODES = ('instance', 'gateway')
+
+
+class NatGateway(AWSObject):
+    """A managed NAT gateway (the troposphere we use doesn't know them yet)"""
+    resource_type = 'AWS::EC2::NatGateway'
+
+    props = {
+        'AllocationId': (basestring, True),
+        'SubnetId': (basestring, True),
+    }
+
+
+class Route(ec2.Route):
+    """ec2.Route with the NatGatewayId troposphere doesn't know yet"""
+    props = dict(ec2.Route.props, NatGatewayId=(basestring, False))
+
+
+def allocate_subnets(zones):
+    """Lays out the subnets of every type and availability zone in the VPC's /16.
+    Returns '<type>-<zone>' -> CIDR block."""
+    space = cidr.AddressSpace('{0}.0.0/16'.format(cfn.CIDR_PREFIX))
+    requests = []
+    for idx, zone in enumerate(zones):
+        for kind, (size, offset, step) in SUBNET_LAYOUT.items():
+            prefix = cfn.SUBNET_SIZES.get(kind, size)
+            third = offset + idx * step
+            preferred = '{0}.{1}.0/{2}'.format(cfn.CIDR_PREFIX, third, prefix) if prefix == size and third < 256 else None
+            requests.append(('{0}-{1}'.format(kind, zone), prefix, preferred))
+
+    # read by config.initialize, so the fragment cache sees when the file changes
+    space.reserve_saved(cfn.saved_subnet_allocations, dict((name, prefix) for name, prefix, _ in requests))
+    allocations = space.allocate_all(requests)
+    if cfn.SUBNET_ALLOCATIONS:
+        space.save(cfn.SUBNET_ALLOCATIONS)
+
+    cfn.address_space = space
+    return allocations
+
+
 def emit_configuration():
     # Build the VPC here
     template = cfn.template
 
+    if cfn.NAT_MODE not in NAT_MODES:
+        raise Exception("nat has to be one of {0}, not {1}".format(', '.join(NAT_MODES), cfn.NAT_MODE))
+    use_nat_instances = cfn.NAT_MODE == 'instance'
+
     # Parameters here
-    nat_instance_class = template.add_parameter(
-        Parameter(
-            'NatInstanceType', Type='String', Default='t2.micro',
-            Description='NAT instance type',
-            AllowedValues=cfn.usable_instances(),
-            ConstraintDescription='Instance size must be a valid instance type'
-        )
-    )
+    if use_nat_instances:
+        nat_instance_class = cfn.instance_type_parameter('Nat', cfn.NAT_INSTANCE_TYPE, 'NAT instance type')
 
     keyname_param = template.add_parameter(
         Parameter(
@@ -50,8 +124,7 @@ def emit_configuration():
     gateway = template.add_resource(
         ec2.InternetGateway(
             'InternetGateway',
-            Tags=Tags(Name='InternetGateway-{0}'.format(CLOUDNAME)),
-            DependsOn=vpc.title
+            Tags=Tags(Name='InternetGateway-{0}'.format(CLOUDNAME))
         )
     )
 
@@ -84,29 +157,30 @@ def emit_configuration():
     )
 
     # Define the Security Group for the NATs
-    nat_ingress_rules = [
-        ec2.SecurityGroupRule(
-            IpProtocol='tcp', CidrIp=cfn.DEFAULT_ROUTE, FromPort=p, ToPort=p
-        ) for p in [22, 80, 443, 11371]
-    ]
-
-    nat_egress_rules = [
-        ec2.SecurityGroupRule(
-            IpProtocol='-1', CidrIp=cfn.DEFAULT_ROUTE, FromPort=0, ToPort=65535,
-        )
-    ]
+    if use_nat_instances:
+        nat_ingress_rules = [
+            ec2.SecurityGroupRule(
+                IpProtocol='tcp', CidrIp=cfn.DEFAULT_ROUTE, FromPort=p, ToPort=p
+            ) for p in [22, 80, 443, 11371]
+        ]
+
+        nat_egress_rules = [
+            ec2.SecurityGroupRule(
+                IpProtocol='-1', CidrIp=cfn.DEFAULT_ROUTE, FromPort=0, ToPort=65535,
+            )
+        ]
 
 
-    nat_security_group = template.add_resource(
-        ec2.SecurityGroup(
-            'NATSecurityGroup',
-            GroupDescription='Security Group for NAT instances',
-            VpcId=Ref(vpc),
-            SecurityGroupIngress=nat_ingress_rules,
-            SecurityGroupEgress=nat_egress_rules,
-            DependsOn=vpc.title
+        nat_security_group = template.add_resource(
+            ec2.SecurityGroup(
+                'NATSecurityGroup',
+                GroupDescription='Security Group for NAT instances',
+                VpcId=Ref(vpc),
+                SecurityGroupIngress=nat_ingress_rules,
+                SecurityGroupEgress=nat_egress_rules,
+                DependsOn=vpc.title
+            )
         )
-    )
 
     platform_subnets = list()
     master_subnets = list()
@@ -115,6 +189,9 @@ def emit_configuration():
     worker_subnets = list()
     database_subnets = list()
     subnet_identifier = 'private'
+    private_routing_tables = dict()
+    subnet_zones = dict()
+    subnet_cidrs = allocate_subnets(cfn.get_availability_zones())
 
     for idx, zone in enumerate(cfn.get_availability_zones()):
         region = Ref('AWS::Region')
@@ -125,7 +202,7 @@ def emit_configuration():
             ec2.Subnet(
                 '{0}PublicSubnet{1}'.format(cfn.VPC_NAME, zone),
                 VpcId=Ref(vpc),
-                CidrBlock='{0}.{1}.0/24'.format(cfn.CIDR_PREFIX, 80 + idx),
+                CidrBlock=subnet_cidrs['public-{0}'.format(zone)],
                 AvailabilityZone=full_region_descriptor,
                 DependsOn=vpc.title,
                 Tags=Tags(Name=Join('-', [cfn.VPC_NAME, 'public-subnet', full_region_descriptor]))
@@ -143,47 +220,69 @@ def emit_configuration():
             )
         )
 
-        # Create the NAT instance in the public subnet
-        nat_name = '{0}Nat{1}'.format(cfn.VPC_NAME, zone)
-        nat_instance = template.add_resource(
-            ec2.Instance(
-                nat_name,
-                DependsOn=vpc.title,
-                InstanceType=Ref(nat_instance_class),
-                KeyName=Ref(keyname_param),
-                SourceDestCheck=False,
-                ImageId=FindInMap('RegionMap', region, int(cfn.Amis.NAT)),
-                NetworkInterfaces=[
-                    ec2.NetworkInterfaceProperty(
-                        Description='Network interface for {0}'.format(nat_name),
-                        GroupSet=[Ref(nat_security_group)],
-                        SubnetId=Ref(public_subnet),
-                        AssociatePublicIpAddress=True,
-                        DeviceIndex=0,
-                        DeleteOnTermination=True
-                    )
-                ],
-                Tags=Tags(Name=Join('-', [cfn.VPC_NAME, 'nat', full_region_descriptor]))
+        if use_nat_instances:
+            # Create the NAT instance in the public subnet
+            nat_name = '{0}Nat{1}'.format(cfn.VPC_NAME, zone)
+            nat_instance = template.add_resource(
+                ec2.Instance(
+                    nat_name,
+                    DependsOn=vpc.title,
+                    InstanceType=Ref(nat_instance_class),
+                    KeyName=Ref(keyname_param),
+                    SourceDestCheck=False,
+                    ImageId=FindInMap('RegionMap', region, int(cfn.Amis.NAT)),
+                    NetworkInterfaces=[
+                        ec2.NetworkInterfaceProperty(
+                            Description='Network interface for {0}'.format(nat_name),
+                            GroupSet=[Ref(nat_security_group)],
+                            SubnetId=Ref(public_subnet),
+                            AssociatePublicIpAddress=True,
+                            DeviceIndex=0,
+                            DeleteOnTermination=True
+                        )
+                    ],
+                    Tags=Tags(Name=Join('-', [cfn.VPC_NAME, 'nat', full_region_descriptor]))
+                )
+            )
+        else:
+            # A managed NAT gateway with an Elastic IP of its own
+            nat_eip = template.add_resource(
+                ec2.EIP(
+                    '{0}NatEip{1}'.format(cfn.VPC_NAME, zone),
+                    Domain='vpc',
+                    DependsOn=gateway_attachment.title
+                )
+            )
+            nat_gateway = template.add_resource(
+                NatGateway(
+                    '{0}NatGateway{1}'.format(cfn.VPC_NAME, zone),
+                    AllocationId=GetAtt(nat_eip, 'AllocationId'),
+                    SubnetId=Ref(public_subnet)
+                )
             )
-        )
 
         # Associate the private routing table with the NAT
         private_routing_table = template.add_resource(
             ec2.RouteTable(
                 '{0}PrivateRouteTable{1}'.format(cfn.VPC_NAME, zone),
                 VpcId=Ref(vpc),
-                DependsOn=nat_instance.title,
                 Tags=Tags(Name=Join('-', [cfn.VPC_NAME, 'private-route-table', full_region_descriptor]))
             )
         )
+        private_routing_tables[zone] = private_routing_table
+        cfn.private_route_tables.append(private_routing_table)
 
+        if use_nat_instances:
+            nat_target = dict(InstanceId=Ref(nat_instance))
+        else:
+            nat_target = dict(NatGatewayId=Ref(nat_gateway))
         template.add_resource(
-            ec2.Route(
+            Route(
                 'PrivateRoute{0}'.format(zone.upper()),
                 RouteTableId=Ref(private_routing_table),
                 DestinationCidrBlock=cfn.DEFAULT_ROUTE,
-                InstanceId=Ref(nat_instance),
-                DependsOn=private_routing_table.title
+                DependsOn=private_routing_table.title,
+                **nat_target
             )
         )
 
@@ -191,7 +290,7 @@ def emit_configuration():
         worker_subnet = ec2.Subnet(
             '{0}{1}WorkerSubnet{2}'.format(cfn.VPC_NAME, subnet_identifier, zone.upper()),
             VpcId=Ref(vpc),
-            CidrBlock='{0}.{1}.0/22'.format(cfn.CIDR_PREFIX, 100 + (idx * 4)),
+            CidrBlock=subnet_cidrs['worker-{0}'.format(zone)],
             AvailabilityZone=full_region_descriptor,
             DependsOn=vpc.title,
             Tags=Tags(Name=Join('-', [cfn.VPC_NAME, '{0}-worker-subnet'.format(subnet_identifier), full_region_descriptor]))
@@ -201,7 +300,7 @@ def emit_configuration():
         platform_subnet = ec2.Subnet(
             '{0}{1}PlatformSubnet{2}'.format(cfn.VPC_NAME, subnet_identifier, zone.upper()),
             VpcId=Ref(vpc),
-            CidrBlock='{0}.{1}.0/24'.format(cfn.CIDR_PREFIX, 10 + idx),
+            CidrBlock=subnet_cidrs['platform-{0}'.format(zone)],
             AvailabilityZone=full_region_descriptor,
             DependsOn=vpc.title,
             Tags=Tags(Name=Join('-', [cfn.VPC_NAME, '{0}-platform-subnet'.format(subnet_identifier), full_region_descriptor]))
@@ -210,7 +309,7 @@ def emit_configuration():
 
         master_subnet = ec2.Subnet('{0}{1}MasterSubnet{2}'.format(cfn.VPC_NAME, subnet_identifier, zone.upper()),
             VpcId=Ref(vpc),
-            CidrBlock='{0}.{1}.0/24'.format(cfn.CIDR_PREFIX, 90 + idx),
+            CidrBlock=subnet_cidrs['master-{0}'.format(zone)],
             AvailabilityZone=full_region_descriptor,
             DependsOn=vpc.title,
             Tags=Tags(Name=Join('-', [cfn.VPC_NAME, '{0}-master-subnet'.format(subnet_identifier), full_region_descriptor]))
@@ -220,7 +319,7 @@ def emit_configuration():
         vpn_subnet = ec2.Subnet(
             '{0}VpnSubnet{1}'.format(cfn.VPC_NAME, zone),
             VpcId=Ref(vpc),
-            CidrBlock='{0}.{1}.0/24'.format(cfn.CIDR_PREFIX, 60 + idx),
+            CidrBlock=subnet_cidrs['vpn-{0}'.format(zone)],
             AvailabilityZone=full_region_descriptor,
             DependsOn=vpc.title,
             Tags=Tags(Name=Join('.', [full_region_descriptor, cfn.CLOUDNAME, cfn.CLOUDENV, "vpn-client"]))
@@ -230,20 +329,25 @@ def emit_configuration():
         database_subnet = ec2.Subnet(
             '{0}DatabaseSubnet{1}'.format(cfn.VPC_NAME, zone),
             VpcId=Ref(vpc),
-            CidrBlock='{0}.{1}.0/24'.format(cfn.CIDR_PREFIX, 20 + idx),
+            CidrBlock=subnet_cidrs['database-{0}'.format(zone)],
             AvailabilityZone=full_region_descriptor,
             DependsOn=vpc.title,
             Tags=Tags(Name=Join('-', [cfn.VPC_NAME, subnet_identifier, 'database-subnet', full_region_descriptor]))
         )
         database_subnets.append(database_subnet)
 
-    # Associate a routing table with each of the master/platform/worker subnets
-    if cfn.USE_PRIVATE_SUBNETS:
-        routing_table = private_routing_table
-    else:
-        routing_table = public_routing_table
+        for sn in (worker_subnet, platform_subnet, master_subnet, database_subnet):
+            subnet_zones[sn.title] = zone
 
+    # Associate a routing table with each of the master/platform/worker subnets. Private
+    # subnets route through the NAT in their own availability zone, so egress never
+    # crosses zones and every NAT only carries its own zone's traffic.
     for sn in chain(worker_subnets, master_subnets, platform_subnets, database_subnets):
+        if cfn.USE_PRIVATE_SUBNETS:
+            routing_table = private_routing_tables[subnet_zones[sn.title]]
+        else:
+            routing_table = public_routing_table
+
         template.add_resource(sn)
         template.add_resource(
             ec2.SubnetRouteTableAssociation(
@@ -273,3 +377,56 @@ def emit_configuration():
     cfn.add_vpc_subnets(vpc, cfn.SubnetTypes.WORKER, worker_subnets)
     cfn.add_vpc_subnets(vpc, cfn.SubnetTypes.VPN, vpn_subnets)
     cfn.add_vpc_subnets(vpc, cfn.SubnetTypes.DATABASE, database_subnets)
+
+    # every instance pulls its bootstrap files (like validator.pem) from here
+    cfn.add_s3_bucket(Join('.', ['cloudstrap', cfn.CLOUDNAME, Ref('AWS::Region'), cfn.CLOUDENV, 'leafme']))
+
+
+def _bucket_arns(buckets):
+    """Returns the ARNs of the buckets and of the objects in them, each bucket once"""
+    arns = []
+    seen = set()
+    for bucket in buckets:
+        key = json.dumps(bucket, cls=awsencode, sort_keys=True)
+        if key in seen:
+            continue
+        seen.add(key)
+        arns.append(Join('', ['arn:aws:s3:::', bucket]))
+        arns.append(Join('', ['arn:aws:s3:::', bucket, '/*']))
+    return arns
+
+
+def emit_vpc_endpoints():
+    """Adds a gateway VPC endpoint for every service in VPC_ENDPOINTS to the private
+    route tables, so that traffic to it doesn't go through the NAT instances. This runs
+    after the components because the S3 endpoint only lets through the buckets they
+    declared (plus VPC_ENDPOINT_BUCKETS)."""
+    unknown = sorted(set(cfn.VPC_ENDPOINTS) - set(ENDPOINT_SERVICES))
+    if unknown:
+        raise Exception("There are no gateway VPC endpoints for {0}, only for {1}".format(
+            ', '.join(unknown), ', '.join(ENDPOINT_SERVICES)))
+
+    template = cfn.template
+    vpc = cfn.vpcs[0]
+
+    for service, name in ENDPOINT_SERVICES.items():
+        if service not in cfn.VPC_ENDPOINTS:
+            continue
+
+        endpoint = VPCEndpoint(
+            '{0}{1}Endpoint'.format(cfn.VPC_NAME, name),
+            ServiceName=Join('.', ['com.amazonaws', Ref('AWS::Region'), service]),
+            VpcId=Ref(vpc),
+            RouteTableIds=[Ref(rt) for rt in cfn.private_route_tables]
+        )
+        if service == 's3':
+            endpoint.PolicyDocument = {
+                'Version': '2012-10-17',
+                'Statement': [{
+                    'Effect': 'Allow',
+                    'Principal': '*',
+                    'Action': ['s3:*'],
+                    'Resource': _bucket_arns(cfn.s3_buckets + cfn.VPC_ENDPOINT_BUCKETS),
+                }]
+            }
+        template.add_resource(endpoint)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This module moves policy documents that several roles have inline into a single
+# AWS::IAM::ManagedPolicy. Every component inlines default_policy.json.j2 into its
+# role, so without this the template (and IAM, while the stack is created) gets the
+# same document once per role.
+#
+# Documents are compared as plain JSON data, so only copies that are exactly the same
+# are shared. A role refers to the managed policies it gets through ManagedPolicyArns,
+# which makes IAM attach them before the role is handed to an instance profile, like
+# the inline policies they replace.
+#
+# This is off unless generate.py gets --share-policies: switching an existing stack
+# over updates every role, and the managed policies have to be created before the
+# roles, which adds a step to the chain of resources that are created one by one.
+
+import hashlib
+import json
+import re
+
+# A document has to be inlined in at least this many roles to be shared
+MIN_ROLES = 2
+
+
+def _canonical(document):
+    return json.dumps(document, sort_keys=True, separators=(',', ':'))
+
+
+def _size(tdict):
+    return len(json.dumps(tdict, separators=(',', ':')))
+
+
+def _common_suffix(names):
+    """Returns the words (as in CamelCase) that all names end with"""
+    words = [re.findall('[A-Z][a-z0-9]*|[a-z0-9]+', name) for name in names]
+    suffix = []
+    while all(len(w) > len(suffix) for w in words) and len(set(w[-len(suffix) - 1] for w in words)) == 1:
+        suffix.insert(0, words[0][-len(suffix) - 1])
+    return ''.join(suffix)
+
+
+def duplicates(tdict, min_roles=MIN_ROLES):
+    """Returns a list of (document, [(role, policy name)]) for every policy document
+    that at least min_roles roles have inline, most widely used first"""
+    found = {}
+    for title, resource in sorted(tdict.get('Resources', {}).items()):
+        if resource['Type'] != 'AWS::IAM::Role':
+            continue
+        for policy in resource.get('Properties', {}).get('Policies', []):
+            key = _canonical(policy['PolicyDocument'])
+            found.setdefault(key, (policy['PolicyDocument'], []))[1].append((title, policy['PolicyName']))
+    shared = [(document, users) for document, users in found.values() if len(set(r for r, _ in users)) >= min_roles]
+    return sorted(shared, key=lambda s: (-len(s[1]), s[1]))
+
+
+def _policy_title(document, users):
+    """Names the managed policy of a document after the policies it replaces and its
+    content, so a title always stands for the same document. A document that changes
+    gets a new managed policy instead of rewriting one that roles still have, and roles
+    that start or stop sharing a document don't touch the others."""
+    suffix = _common_suffix([name for _, name in users]) or 'Policy'
+    return 'Shared{0}{1}'.format(suffix, hashlib.sha1(_canonical(document)).hexdigest()[:8])
+
+
+def share(tdict, min_roles=MIN_ROLES):
+    """Replaces the inline policy documents that several roles have with managed
+    policies. Returns the managed policies (title -> roles) and the bytes saved."""
+    before = _size(tdict)
+    resources = tdict.get('Resources', {})
+    created = {}
+    for document, users in duplicates(tdict, min_roles):
+        title = _policy_title(document, users)
+        roles = sorted(set(role for role, _ in users))
+        resources[title] = {
+            'Type': 'AWS::IAM::ManagedPolicy',
+            'Properties': {
+                'PolicyDocument': document,
+            },
+        }
+
+        key = _canonical(document)
+        for role in roles:
+            properties = resources[role]['Properties']
+            properties['Policies'] = [p for p in properties['Policies'] if _canonical(p['PolicyDocument']) != key]
+            if not properties['Policies']:
+                del properties['Policies']
+            properties.setdefault('ManagedPolicyArns', []).append({'Ref': title})
+        created[title] = roles
+    return created, before - _size(tdict)
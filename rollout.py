@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Rolls a configuration out to several regions: generates a template per region,
+# then uploads and deploys them, the canary region first and the others
+# concurrently. Once a region fails no further regions are started.
+#
+#     python rollout.py -c environments/leaf-dev.conf.yml --stack-name infratest \
+#         --regions us-east-1 us-west-1 us-west-2 --template-bucket 'leafme-infra-cfn-templates-{region}' \
+#         --parameter KeyName=infra
+#
+# At the end a single timeline of every region's generate, upload and deploy steps
+# is printed (and written as JSON with --report).
+
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import deploy
+import generate
+import upload
+
+DEFAULT_REGIONS = ['us-east-1', 'us-west-1', 'us-west-2']
+
+
+class _RegionStream(object):
+    """Prefixes every line written to stream with the region, whole lines at a time so
+    the output of concurrent regions doesn't get mixed up"""
+    _lock = threading.Lock()
+
+    def __init__(self, stream, region):
+        self.stream = stream
+        self.region = region
+        self._buffer = ''
+
+    def write(self, data):
+        self._buffer += data
+        while '\n' in self._buffer:
+            line, self._buffer = self._buffer.split('\n', 1)
+            with self._lock:
+                self.stream.write('[{0}] {1}\n'.format(self.region, line))
+
+
+class Timeline(object):
+    """Records the steps of every region with their start, end and outcome"""
+    def __init__(self):
+        self.start = time.time()
+        self.steps = []
+        self._lock = threading.Lock()
+
+    def record(self, region, step, start, error=None, **details):
+        entry = dict(details, region=region, step=step, start=start - self.start,
+                     seconds=time.time() - start, error=error)
+        with self._lock:
+            self.steps.append(entry)
+        return entry
+
+    def print_report(self, stream):
+        print("\n{0:<12} {1:<10} {2:>9} {3:>9}  {4}".format('region', 'step', 'start', 'seconds', 'result'), file=stream)
+        for s in sorted(self.steps, key=lambda s: (s['start'], s['region'])):
+            print("{0:<12} {1:<10} {2:>8.0f}s {3:>8.0f}s  {4}".format(
+                s['region'], s['step'], s['start'], s['seconds'], s['error'] or s.get('status') or 'ok'), file=stream)
+        print("{0:<12} {1:<10} {2:>9} {3:>8.0f}s".format('total', '', '', time.time() - self.start), file=stream)
+
+    def write_report(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'steps': self.steps}, f, indent=4, sort_keys=True)
+
+
+def _deploy_region(region, template, options, timeline):
+    """Uploads and deploys the template of one region, returns True if it succeeded"""
+    stream = _RegionStream(sys.stderr, region)
+
+    start = time.time()
+    try:
+        s3 = upload.client(region, options.get('s3_endpoint_url'))
+        bucket = options['template_bucket'].format(region=region)
+        templates = upload.template_artifacts(template, bucket, options['stack_name'])
+        if options.get('create_buckets'):
+            upload.ensure_bucket(s3, bucket, region)
+        upload.upload(s3, templates, stream=stream)
+        template_url = upload.https_url(s3, templates[0])
+    except Exception, e:
+        timeline.record(region, 'upload', start, error=str(e))
+        return False
+    timeline.record(region, 'upload', start)
+
+    parameters = dict(options.get('parameters') or {})
+    if len(templates) > 1:
+        parameters['NestedTemplateBaseURL'] = template_url.rsplit('/', 1)[0] + '/'
+
+    start = time.time()
+    try:
+        cf = deploy.client(region, options.get('cloudformation_endpoint_url'))
+        status, durations = deploy.deploy(cf, options['stack_name'], parameters, template_url=template_url,
+                                          execute=options.get('execute', True), stream=stream)
+    except Exception, e:
+        timeline.record(region, 'deploy', start, error=str(e))
+        return False
+    timeline.record(region, 'deploy', start, status=status or 'No changes', resources=durations,
+                    error=status if status in deploy.FAILED else None)
+    return status not in deploy.FAILED
+
+
+def rollout(templates, canary, options, max_parallel=None, timeline=None):
+    """Deploys the region -> template file mapping, the canary first and the other
+    regions max_parallel at a time. Returns region -> True/False/None (not started)."""
+    timeline = timeline or Timeline()
+    results = dict((region, None) for region in templates)
+    halted = threading.Event()
+
+    def run(region):
+        if halted.is_set():
+            print("Skipping {0}, an earlier region failed".format(region), file=sys.stderr)
+            return
+        results[region] = _deploy_region(region, templates[region], options, timeline)
+        if not results[region]:
+            halted.set()
+
+    if canary:
+        run(canary)
+    others = [r for r in sorted(templates) if r != canary]
+    if others and not halted.is_set():
+        pool = ThreadPool(processes=max_parallel or len(others))
+        try:
+            pool.map(run, others)
+        finally:
+            pool.close()
+            pool.join()
+    return results
+
+
+def _create_parser():
+    parser = argparse.ArgumentParser(prog='rollout.py')
+    parser.add_argument('-c', '--config', type=str, required=True, help='The configuration YAML file to roll out')
+    parser.add_argument('--stack-name', type=str, required=True, help='The stack to create or update in every region')
+    parser.add_argument('--regions', nargs='+', default=DEFAULT_REGIONS,
+                        help='The regions to deploy to (default: {0})'.format(' '.join(DEFAULT_REGIONS)))
+    parser.add_argument('--canary', type=str, help='The region that is deployed on its own before all others (default: the first region)')
+    parser.add_argument('--max-parallel', type=int, help='The most regions deployed at once after the canary (default: all of them)')
+    parser.add_argument('--template-bucket', type=str, required=True,
+                        help='The bucket the templates are uploaded to, {region} is replaced with the region')
+    parser.add_argument('--create-buckets', action='store_true', help='Create the template buckets that are missing')
+    parser.add_argument('--parameter', action='append', metavar='KEY=VALUE', help='A stack parameter, can be repeated')
+    parser.add_argument('--outdir', type=str, default='templates', help='The directory to generate the templates in (default: templates)')
+    parser.add_argument('--no-execute', action='store_true', help='Only create and print the change sets')
+    parser.add_argument('--report', type=str, help='Write the timeline as JSON to this file')
+    parser.add_argument('--s3-endpoint-url', type=str, help='Talk to this S3 endpoint, e.g. a local moto_server')
+    parser.add_argument('--cloudformation-endpoint-url', type=str, help='Talk to this CloudFormation endpoint')
+    return parser
+
+
+if __name__ == '__main__':
+    args = _create_parser().parse_args()
+    canary = args.canary or args.regions[0]
+    if canary not in args.regions:
+        raise Exception("The canary region {0} isn't one of {1}".format(canary, ', '.join(args.regions)))
+
+    timeline = Timeline()
+    start = time.time()
+    generated = generate.generate_matrix([args.config], args.outdir, regions=args.regions)
+    templates = {}
+    for name, outfile, seconds, error in generated:
+        region = name.rsplit('.', 1)[1]
+        timeline.steps.append({'region': region, 'step': 'generate', 'start': start - timeline.start,
+                               'seconds': seconds, 'error': error})
+        templates[region] = outfile
+    if any(error for _, _, _, error in generated):
+        timeline.print_report(sys.stderr)
+        sys.exit(1)
+
+    results = rollout(templates, canary, {
+        'stack_name': args.stack_name,
+        'template_bucket': args.template_bucket,
+        'create_buckets': args.create_buckets,
+        'parameters': deploy.parse_parameters(args.parameter),
+        'execute': not args.no_execute,
+        's3_endpoint_url': args.s3_endpoint_url,
+        'cloudformation_endpoint_url': args.cloudformation_endpoint_url,
+    }, max_parallel=args.max_parallel, timeline=timeline)
+
+    timeline.print_report(sys.stderr)
+    if args.report:
+        timeline.write_report(args.report)
+    for region in sorted(results):
+        print("{0}: {1}".format(region, {True: 'deployed', False: 'FAILED', None: 'not started'}[results[region]]),
+              file=sys.stderr)
+    sys.exit(0 if all(results.values()) else 1)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This module builds the scaling policies and alarms of an auto scaling group from the
+# scaling section of the YAML (see config.add_scaling_policies()):
+#
+#     scaling:
+#       MesosWorker:
+#         min_size: 3
+#         max_size: 12
+#         cooldown: 300
+#         warmup: 300
+#         target_tracking:
+#           - metric: cpu
+#             target: 60
+#         step:
+#           - metric: network_in
+#             scale_out:
+#               - {above: 100000000, add: 1}
+#               - {above: 200000000, add: 3}
+#             scale_in:
+#               - {below: 10000000, remove: 1}
+#
+# Target tracking keeps a metric at its target by adding and removing instances on its
+# own. Step policies get an alarm per direction, and add or remove the number of
+# instances of the band the metric is in. cpu, network_in and network_out are the
+# metrics EC2 publishes for the group, anything else is a custom metric published to
+# namespace (with an AutoScalingGroupName dimension, unless dimensions are given).
+# Nothing in these templates publishes custom metrics, that has to happen elsewhere.
+
+from troposphere import Ref
+from troposphere.autoscaling import ScalingPolicy as BaseScalingPolicy
+from troposphere.cloudwatch import Alarm, MetricDimension
+
+# alias -> (namespace, metric name, predefined target tracking metric)
+METRICS = {
+    'cpu': ('AWS/EC2', 'CPUUtilization', 'ASGAverageCPUUtilization'),
+    'network_in': ('AWS/EC2', 'NetworkIn', 'ASGAverageNetworkIn'),
+    'network_out': ('AWS/EC2', 'NetworkOut', 'ASGAverageNetworkOut'),
+}
+
+# New instances are left out of the group's metrics for this long after they launch
+DEFAULT_WARMUP = 300
+
+
+class ScalingPolicy(BaseScalingPolicy):
+    """autoscaling.ScalingPolicy with the target tracking and step scaling properties
+    troposphere doesn't know yet"""
+    props = dict(BaseScalingPolicy.props,
+                 AdjustmentType=(basestring, False),
+                 ScalingAdjustment=(basestring, False),
+                 PolicyType=(basestring, False),
+                 EstimatedInstanceWarmup=(int, False),
+                 MetricAggregationType=(basestring, False),
+                 StepAdjustments=(list, False),
+                 TargetTrackingConfiguration=(dict, False))
+
+
+def _title(metric):
+    """The part of a policy's title naming its metric, like CPUUtilization for cpu"""
+    metric = METRICS[metric][1] if metric in METRICS else metric
+    return ''.join(word[:1].upper() + word[1:] for word in metric.replace('-', '_').split('_'))
+
+
+def _metric(asg, spec):
+    """Returns the namespace, metric name and dimensions a policy spec watches"""
+    if spec['metric'] in METRICS:
+        namespace, name, _ = METRICS[spec['metric']]
+    elif spec.get('namespace'):
+        namespace, name = spec['namespace'], spec['metric']
+    else:
+        raise Exception("{0} is a custom metric, it needs a namespace".format(spec['metric']))
+    dimensions = spec.get('dimensions') or {'AutoScalingGroupName': Ref(asg)}
+    return namespace, name, [{'Name': k, 'Value': v} for k, v in sorted(dimensions.items())]
+
+
+def target_tracking_policy(name, asg, spec, warmup):
+    """Returns the policy keeping spec['metric'] at spec['target']"""
+    if 'target' not in spec:
+        raise Exception("Target tracking on {0} for {1} needs a target".format(spec['metric'], name))
+    configuration = {
+        'TargetValue': float(spec['target']),
+        'DisableScaleIn': not spec.get('scale_in', True),
+    }
+    if spec['metric'] in METRICS and not spec.get('dimensions'):
+        configuration['PredefinedMetricSpecification'] = {'PredefinedMetricType': METRICS[spec['metric']][2]}
+    else:
+        namespace, metric, dimensions = _metric(asg, spec)
+        configuration['CustomizedMetricSpecification'] = {
+            'Namespace': namespace,
+            'MetricName': metric,
+            'Dimensions': dimensions,
+            'Statistic': spec.get('statistic', 'Average'),
+        }
+    return ScalingPolicy(
+        '{0}{1}Target'.format(name, _title(spec['metric'])),
+        AutoScalingGroupName=Ref(asg),
+        PolicyType='TargetTrackingScaling',
+        EstimatedInstanceWarmup=spec.get('warmup', warmup),
+        TargetTrackingConfiguration=configuration,
+    )
+
+
+def _step_adjustments(steps, sign):
+    """Turns thresholds (ascending for scale out, descending for scale in) into step
+    adjustments relative to the alarm threshold, the first one"""
+    threshold = steps[0][0]
+    adjustments = []
+    for idx, (value, change) in enumerate(steps):
+        adjustment = {'ScalingAdjustment': sign * int(change)}
+        limits = [value - threshold, steps[idx + 1][0] - threshold if idx + 1 < len(steps) else None]
+        if sign < 0:
+            limits.reverse()
+        for key, limit in zip(('MetricIntervalLowerBound', 'MetricIntervalUpperBound'), limits):
+            if limit is not None:
+                adjustment[key] = float(limit)
+        adjustments.append(adjustment)
+    return threshold, adjustments
+
+
+def step_policies(name, asg, spec, warmup):
+    """Returns the policies and alarms of step scaling on spec['metric']"""
+    namespace, metric, dimensions = _metric(asg, spec)
+    directions = [
+        ('ScaleOut', 'High', 'GreaterThanOrEqualToThreshold', 1,
+         sorted((s['above'], s['add']) for s in spec.get('scale_out') or [])),
+        ('ScaleIn', 'Low', 'LessThanOrEqualToThreshold', -1,
+         sorted(((s['below'], s['remove']) for s in spec.get('scale_in') or []), reverse=True)),
+    ]
+    if not any(steps for _, _, _, _, steps in directions):
+        raise Exception("Step scaling on {0} for {1} needs scale_out or scale_in steps".format(spec['metric'], name))
+
+    resources = []
+    for direction, level, comparison, sign, steps in directions:
+        if not steps:
+            continue
+        threshold, adjustments = _step_adjustments(steps, sign)
+        policy = ScalingPolicy(
+            '{0}{1}{2}'.format(name, _title(spec['metric']), direction),
+            AutoScalingGroupName=Ref(asg),
+            PolicyType='StepScaling',
+            AdjustmentType='ChangeInCapacity',
+            MetricAggregationType=spec.get('statistic', 'Average'),
+            EstimatedInstanceWarmup=spec.get('warmup', warmup),
+            StepAdjustments=adjustments,
+        )
+        alarm = Alarm(
+            '{0}{1}{2}Alarm'.format(name, _title(spec['metric']), level),
+            AlarmDescription='{0} {1} {2} {3}'.format(name, metric, '>=' if sign > 0 else '<=', threshold),
+            Namespace=namespace,
+            MetricName=metric,
+            Dimensions=[MetricDimension(**d) for d in dimensions],
+            Statistic=spec.get('statistic', 'Average'),
+            Period=str(spec.get('period', 60)),
+            EvaluationPeriods=str(spec.get('evaluation_periods', 2)),
+            Threshold=str(threshold),
+            ComparisonOperator=comparison,
+            AlarmActions=[Ref(policy)],
+        )
+        resources.extend([policy, alarm])
+    return resources
+
+
+def policies(name, asg, spec):
+    """Returns every scaling policy and alarm spec asks for"""
+    warmup = spec.get('warmup', DEFAULT_WARMUP)
+    resources = [target_tracking_policy(name, asg, s, warmup) for s in spec.get('target_tracking') or []]
+    for s in spec.get('step') or []:
+        resources.extend(step_policies(name, asg, s, warmup))
+    return resources
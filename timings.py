@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This module records where generation time and memory go, per emitter (network,
+# core and every component).
+
+from __future__ import print_function
+
+import cProfile
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+from troposphere import awsencode
+
+import config as cfn
+
+try:
+    import tracemalloc
+except ImportError:
+    # Not available before Python 3.4, fall back to the peak RSS of the process
+    tracemalloc = None
+
+# Timings are only recorded once enabled
+enabled = False
+
+# If set, a cProfile dump for every emitter is written to this directory
+profile_dir = None
+
+# One dict per measured step, in the order they ran
+records = []
+
+SECTIONS = ('parameters', 'conditions', 'resources', 'outputs')
+
+
+def configure(profile=None):
+    """Enables recording. If profile is a directory, every step is also run under cProfile"""
+    global enabled
+    global profile_dir
+    enabled = True
+    profile_dir = profile
+    if profile_dir and not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    if tracemalloc is not None and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def _template_keys():
+    return dict((s, set(getattr(cfn.template, s).keys())) for s in SECTIONS)
+
+
+def _contributed(before):
+    """Counts the resources and JSON bytes added to the template since before"""
+    added = {}
+    for section in SECTIONS:
+        entries = getattr(cfn.template, section)
+        added[section] = dict((k, entries[k]) for k in entries if k not in before[section])
+    if not any(added.values()):
+        return 0, 0
+    encoded = json.dumps(added, cls=awsencode, sort_keys=True, separators=(',', ':'))
+    return len(added['resources']), len(encoded)
+
+
+def _peak_memory():
+    if tracemalloc is not None:
+        return tracemalloc.get_traced_memory()[1] // 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+@contextmanager
+def measure(name):
+    """Records wall time, resources, template bytes and peak memory of the wrapped step"""
+    if not enabled:
+        yield
+        return
+
+    before = _template_keys()
+    if tracemalloc is not None and hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    memory_before = _peak_memory()
+    profiler = cProfile.Profile() if profile_dir else None
+    error = None
+    start = time.time()
+    try:
+        if profiler:
+            profiler.enable()
+        yield
+    except Exception, e:
+        error = str(e)
+        raise
+    finally:
+        elapsed = time.time() - start
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(profile_dir, '{0}.prof'.format(name)))
+        resources, size = _contributed(before)
+        records.append({
+            'name': name,
+            'seconds': elapsed,
+            'resources': resources,
+            'bytes': size,
+            'peak_memory_kb': _peak_memory(),
+            'memory_growth_kb': _peak_memory() - memory_before,
+            'error': error,
+        })
+
+
+def print_report(stream):
+    """Prints a table of the recorded steps, slowest first"""
+    total = sum(r['seconds'] for r in records)
+    print("\n{0:<24} {1:>9} {2:>7} {3:>10} {4:>10} {5:>12}".format(
+        'step', 'seconds', '%', 'resources', 'bytes', 'peak KB'), file=stream)
+    for r in sorted(records, key=lambda r: r['seconds'], reverse=True):
+        print("{0:<24} {1:>9.4f} {2:>6.1f}% {3:>10} {4:>10} {5:>12}{6}".format(
+            r['name'], r['seconds'], 100.0 * r['seconds'] / total if total else 0.0,
+            r['resources'], r['bytes'], r['peak_memory_kb'],
+            '  (failed: {0})'.format(r['error']) if r['error'] else ''), file=stream)
+    print("{0:<24} {1:>9.4f}".format('total', total), file=stream)
+
+
+def write_report(filename):
+    """Writes the recorded steps as JSON"""
+    with open(filename, 'w') as f:
+        json.dump({
+            'memory_source': 'tracemalloc' if tracemalloc is not None else 'ru_maxrss',
+            'steps': records,
+        }, f, indent=4, sort_keys=True)
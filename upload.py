@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Uploads the generated templates and the bootstrap artifacts to S3, skipping every
+# object that is already there with the same content.
+#
+#     python upload.py --template-bucket leafme-infra-cfn-templates --template infratest.template \
+#         --file bootstrap/primary=s3://zookeeper.test-cloud.us-east-1.infra.leafme/exhibitors/primary
+#
+# A template and the nested stack templates it refers to (written next to it) are
+# stored under a prefix named after the hash of their contents, so every version of
+# the templates gets URLs of its own. The URL of the parent template and the base URL
+# of the nested ones (for the NestedTemplateBaseURL parameter) are printed on stdout.
+#
+# Every object is stored with the SHA-256 of its content in its metadata; objects
+# without it are compared by their ETag, which is the MD5 of single part uploads.
+# Changed files are uploaded concurrently, large ones as multipart uploads.
+# --endpoint-url points the uploader at a local stand-in for S3 (e.g. moto_server).
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+from multiprocessing.pool import ThreadPool
+
+# Files larger than this are uploaded in parts of this size
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+
+HASH_METADATA = 'sha256'
+
+
+class Artifact(object):
+    """A local file and the S3 object it is uploaded to"""
+    def __init__(self, filename, bucket, key, acl=None):
+        self.filename = filename
+        self.bucket = bucket
+        self.key = key
+        self.acl = acl
+        self.sha256, self.md5 = file_hashes(filename)
+
+    @property
+    def url(self):
+        return 's3://{0}/{1}'.format(self.bucket, self.key)
+
+
+def file_hashes(filename):
+    """Returns the SHA-256 and MD5 hex digests of a file"""
+    sha256, md5 = hashlib.sha256(), hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+            md5.update(chunk)
+    return sha256.hexdigest(), md5.hexdigest()
+
+
+def client(region, endpoint_url=None):
+    """Returns an S3 client. boto3 is only needed for uploading, so it is imported here
+    rather than for every run of the generator."""
+    import boto3
+    return boto3.client('s3', region_name=region, endpoint_url=endpoint_url)
+
+
+def nested_templates(template):
+    """Returns the files of the nested stack templates the template refers to"""
+    with open(template, 'r') as f:
+        resources = json.load(f).get('Resources', {})
+    filenames = []
+    for resource in resources.values():
+        url = resource.get('Properties', {}).get('TemplateURL') if resource['Type'] == 'AWS::CloudFormation::Stack' else None
+        if isinstance(url, dict) and 'Fn::Join' in url:
+            filenames.append(os.path.join(os.path.dirname(template), url['Fn::Join'][1][-1]))
+    return sorted(filenames)
+
+
+def template_artifacts(template, bucket, prefix=''):
+    """Returns the artifacts for a template and its nested stack templates, all stored
+    under <prefix>/<hash of their contents>/"""
+    filenames = [template] + nested_templates(template)
+
+    combined = hashlib.sha256()
+    for filename in filenames:
+        combined.update(os.path.basename(filename).encode('utf-8'))
+        combined.update(file_hashes(filename)[0].encode('utf-8'))
+    directory = '/'.join(p for p in [prefix.strip('/'), combined.hexdigest()[:16]] if p)
+
+    return [Artifact(f, bucket, '{0}/{1}'.format(directory, os.path.basename(f))) for f in filenames]
+
+
+def ensure_bucket(s3, bucket, region):
+    """Creates the bucket unless it already exists"""
+    from botocore.exceptions import ClientError
+    try:
+        s3.head_bucket(Bucket=bucket)
+        return False
+    except ClientError:
+        pass
+    if region == 'us-east-1':
+        s3.create_bucket(Bucket=bucket)
+    else:
+        s3.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': region})
+    return True
+
+
+def is_current(s3, artifact):
+    """Returns True if the artifact's object already exists with the same content"""
+    from botocore.exceptions import ClientError
+    try:
+        head = s3.head_object(Bucket=artifact.bucket, Key=artifact.key)
+    except ClientError:
+        return False
+    stored = head.get('Metadata', {}).get(HASH_METADATA)
+    if stored:
+        return stored == artifact.sha256
+    return head.get('ETag', '').strip('"') == artifact.md5
+
+
+def _upload(s3, artifact, threshold):
+    from boto3.s3.transfer import TransferConfig
+    extra = {'Metadata': {HASH_METADATA: artifact.sha256}}
+    if artifact.acl:
+        extra['ACL'] = artifact.acl
+    s3.upload_file(artifact.filename, artifact.bucket, artifact.key, ExtraArgs=extra,
+                   Config=TransferConfig(multipart_threshold=threshold, multipart_chunksize=threshold))
+
+
+def upload(s3, artifacts, jobs=8, threshold=MULTIPART_THRESHOLD, stream=sys.stderr):
+    """Uploads the artifacts whose objects are missing or differ, jobs at a time.
+    Returns the artifacts that were uploaded."""
+    pool = ThreadPool(processes=jobs)
+    try:
+        current = pool.map(lambda a: is_current(s3, a), artifacts)
+        changed = [a for a, c in zip(artifacts, current) if not c]
+        for artifact in artifacts:
+            print("{0:<10} {1} -> {2}".format('upload' if artifact in changed else 'unchanged',
+                                              artifact.filename, artifact.url), file=stream)
+        pool.map(lambda a: _upload(s3, a, threshold), changed)
+    finally:
+        pool.close()
+        pool.join()
+    return changed
+
+
+def https_url(s3, artifact):
+    """Returns the https URL CloudFormation reads the artifact from"""
+    endpoint = s3.meta.endpoint_url.rstrip('/')
+    return '{0}/{1}/{2}'.format(endpoint, artifact.bucket, artifact.key)
+
+
+def _file_artifact(value, acl=None):
+    """Turns LOCAL=s3://BUCKET/KEY into artifacts, LOCAL may be a directory when KEY ends in a slash"""
+    if '=' not in value or '=s3://' not in value:
+        raise Exception("Files are passed as LOCAL=s3://BUCKET/KEY, not {0}".format(value))
+    local, url = value.split('=', 1)
+    bucket, key = url[len('s3://'):].split('/', 1)
+    if os.path.isdir(local):
+        return [Artifact(os.path.join(local, f), bucket, key.rstrip('/') + '/' + f, acl)
+                for f in sorted(os.listdir(local)) if os.path.isfile(os.path.join(local, f))]
+    return [Artifact(local, bucket, key, acl)]
+
+
+def _create_parser():
+    parser = argparse.ArgumentParser(prog='upload.py')
+    parser.add_argument('--template', type=str, help='The generated template, the nested stack templates it refers to are uploaded too')
+    parser.add_argument('--template-bucket', type=str, help='The bucket to upload the templates to')
+    parser.add_argument('--template-prefix', type=str, default='', help='The key prefix the templates are stored under')
+    parser.add_argument('--template-acl', type=str, help='A canned ACL for the templates, e.g. public-read')
+    parser.add_argument('--file', action='append', metavar='LOCAL=s3://BUCKET/KEY',
+                        help='Another file (or directory, when KEY ends in a slash) to upload, can be repeated')
+    parser.add_argument('--create-buckets', action='store_true', help='Create the buckets that are missing')
+    parser.add_argument('--region', type=str, default='us-east-1', help='The region of the buckets (default: us-east-1)')
+    parser.add_argument('--endpoint-url', type=str, help='Talk to this S3 endpoint, e.g. a local moto_server')
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='The number of concurrent uploads (default: 8)')
+    return parser
+
+
+if __name__ == '__main__':
+    args = _create_parser().parse_args()
+    if args.template and not args.template_bucket:
+        raise Exception("--template needs a --template-bucket")
+
+    artifacts = []
+    templates = []
+    if args.template:
+        templates = template_artifacts(args.template, args.template_bucket, args.template_prefix)
+        for artifact in templates:
+            artifact.acl = args.template_acl
+        artifacts.extend(templates)
+    for value in args.file or []:
+        artifacts.extend(_file_artifact(value))
+
+    s3 = client(args.region, args.endpoint_url)
+    if args.create_buckets:
+        for bucket in sorted(set(a.bucket for a in artifacts)):
+            if ensure_bucket(s3, bucket, args.region):
+                print("Created bucket {0}".format(bucket), file=sys.stderr)
+
+    changed = upload(s3, artifacts, jobs=args.jobs)
+    print("Uploaded {0} of {1} files".format(len(changed), len(artifacts)), file=sys.stderr)
+
+    if templates:
+        url = https_url(s3, templates[0])
+        print(url)
+        print(url.rsplit('/', 1)[0] + '/')
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This module builds the user data of instances. By default that is the rendered init
+# script wrapped in Fn::Base64. With 'user_data: gzip' it is a gzip-compressed cloud-init
+# multipart archive instead: a cloud-config part that writes the settings of the deploy
+# role to SETTINGS_FILE and the init script, which is the same for every role then.
+
+import base64
+import gzip
+import io
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+# EC2 refuses user data larger than this, before it is base64 encoded
+MAX_USER_DATA = 16384
+
+# The file the cloud-config part writes the role's settings to, for the script to source
+SETTINGS_FILE = '/etc/default/leaf-deploy'
+
+# Fixed, so the same parts always give the same archive
+BOUNDARY = '==leaf-user-data=='
+
+def settings(variables):
+    """Returns the cloud-config part that writes variables (name -> value) as exports to SETTINGS_FILE"""
+    lines = ['#cloud-config', 'write_files:', '  - path: {0}'.format(SETTINGS_FILE),
+             "    permissions: '0644'", '    content: |']
+    lines.extend("      export {0}='{1}'".format(name, value) for name, value in sorted(variables.items()))
+    return '\n'.join(lines) + '\n'
+
+
+def multipart(parts):
+    """Returns the MIME multipart archive of a list of (subtype, content) parts, like
+    ('cloud-config', ...) or ('x-shellscript', ...)"""
+    message = MIMEMultipart(boundary=BOUNDARY)
+    for subtype, content in parts:
+        if BOUNDARY in content:
+            raise Exception("User data can't contain the boundary {0}".format(BOUNDARY))
+        message.attach(MIMEText(content, subtype))
+    return message.as_string()
+
+
+def compress(data):
+    """Gzips data without a timestamp, so unchanged user data stays the same"""
+    buf = io.BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buf, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def archive(parts):
+    """Returns the base64 encoded, gzipped multipart archive of parts, ready for UserData"""
+    return base64.b64encode(compress(multipart(parts)))
+
+
+def size(value):
+    """Returns the number of bytes EC2 gets for a UserData value, which is either the
+    string Fn::Base64 encodes or an already encoded archive. None if that isn't known
+    until the stack is created (e.g. a Join)."""
+    if isinstance(value, dict) and value.keys() == ['Fn::Base64']:
+        value = value['Fn::Base64']
+        return len(value.encode('utf-8')) if isinstance(value, basestring) else None
+    if isinstance(value, basestring):
+        return len(base64.b64decode(value))
+    return None
+
+
+def sizes(tdict):
+    """Returns (title, bytes) for every resource with user data, largest first"""
+    result = []
+    for title, resource in tdict.get('Resources', {}).items():
+        properties = resource.get('Properties', {})
+        if 'UserData' in properties:
+            result.append((title, size(properties['UserData'])))
+    return sorted(result, key=lambda r: (-(r[1] or 0), r[0]))
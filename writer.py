@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This module serializes a template to a stream one resource at a time, so the
+# whole template never has to exist as a single string. The pretty output is
+# byte for byte what Template.to_json() produces.
+
+import json
+
+from troposphere import awsencode
+
+
+def template_sections(template):
+    """Returns the top level sections of a template, the same way Template.to_json() lays them out"""
+    t = {}
+    if template.description:
+        t['Description'] = template.description
+    if template.conditions:
+        t['Conditions'] = template.conditions
+    if template.mappings:
+        t['Mappings'] = template.mappings
+    if template.outputs:
+        t['Outputs'] = template.outputs
+    if template.parameters:
+        t['Parameters'] = template.parameters
+    if template.version:
+        t['AWSTemplateFormatVersion'] = template.version
+    t['Resources'] = template.resources
+    return t
+
+
+def write_template(template, stream, minify=False):
+    """Writes template as JSON to stream with its keys sorted. Resources are encoded
+    and written one by one. minify drops all of the indentation and whitespace."""
+    if minify:
+        indent, separators, newline = None, (',', ':'), ''
+    else:
+        indent, separators, newline = 4, (',', ': '), '\n'
+
+    def pad(level):
+        return ' ' * (indent * level) if indent else ''
+
+    def dumps(value, level):
+        text = json.dumps(value, cls=awsencode, indent=indent, sort_keys=True, separators=separators)
+        # JSON strings never hold a raw newline, so this only shifts the structure
+        return text.replace('\n', '\n' + pad(level)) if indent else text
+
+    def write_members(items, level, write_value):
+        items = sorted(items, key=lambda item: item[0])
+        for idx, (key, value) in enumerate(items):
+            stream.write(pad(level) + json.dumps(key) + separators[1])
+            write_value(key, value, level)
+            stream.write((',' if idx < len(items) - 1 else '') + newline)
+
+    def write_section(key, value, level):
+        if key == 'Resources' and value:
+            stream.write('{' + newline)
+            write_members(value.items(), level + 1,
+                          lambda title, resource, l: stream.write(dumps(resource, l)))
+            stream.write(pad(level) + '}')
+        else:
+            stream.write(dumps(value, level))
+
+    stream.write('{' + newline)
+    write_members(template_sections(template).items(), 1, write_section)
+    stream.write('}\n')